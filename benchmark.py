@@ -0,0 +1,211 @@
+"""
+Performance benchmarks for Heritage Report Generator
+Run this on a render server to check how image preparation scales
+and what each report pays for fonts and styles
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+
+def create_test_photos(directory, count, size=(4000, 3000)):
+    """Create synthetic phone-sized JPEG photos"""
+    from PIL import Image
+
+    paths = []
+    for i in range(count):
+        img = Image.effect_noise(size, 30 + i % 20).convert('RGB')
+        path = os.path.join(directory, f"photo_{i+1}.jpg")
+        img.save(path, 'JPEG', quality=92)
+        paths.append(path)
+    return paths
+
+
+def benchmark_image_pool(photo_count=16):
+    """Measure image preparation time for increasing worker counts"""
+    print("\n" + "="*60)
+    print("Benchmark: Process-pool image preparation")
+    print("="*60)
+
+    from reportlab.lib.units import inch
+    from image_processor import ImageProcessor
+    from constants import ADDITIONAL_IMAGE_WIDTH, ADDITIONAL_IMAGE_HEIGHT
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f"\nCreating {photo_count} test photos...")
+        photos = create_test_photos(work_dir, photo_count)
+        batch = [(path, ADDITIONAL_IMAGE_WIDTH*inch, ADDITIONAL_IMAGE_HEIGHT*inch, True) for path in photos]
+
+        cpu_count = os.cpu_count() or 1
+        worker_counts = sorted({1, 2, 4, 8, 16, 32, cpu_count})
+        worker_counts = [w for w in worker_counts if w <= cpu_count]
+
+        baseline = None
+        print(f"\n{'Workers':>8} {'Seconds':>10} {'Images/s':>10} {'Speedup':>10}")
+        for workers in worker_counts:
+            output_dir = tempfile.mkdtemp(dir=work_dir)
+            processor = ImageProcessor(output_dir, workers=workers)
+
+            start = time.perf_counter()
+            processor.prepare_batch(batch)
+            elapsed = time.perf_counter() - start
+            processor.close()
+
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>10.2f} {photo_count / elapsed:>10.1f} {baseline / elapsed:>9.2f}x")
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark_builder_setup(report_count=20):
+    """Compare per-report font and style setup with and without the shared registry"""
+    print("\n" + "="*60)
+    print("Benchmark: Font and style setup per report")
+    print("="*60)
+
+    import reportlab
+    from reportlab.pdfbase.ttfonts import TTFont
+    import report_styles
+    from pdf_builder import PDFBuilder
+    from constants import ARABIC_FONT_PATH, ARABIC_FONT_NAME
+
+    font_path = ARABIC_FONT_PATH
+    if not os.path.exists(font_path):
+        # Much smaller than ARIALUNI.TTF, so the difference shown is a lower bound
+        font_path = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+    print(f"\nFont: {font_path} ({os.path.getsize(font_path) / (1024 * 1024):.1f} MB)")
+
+    # What every PDFBuilder did before: parse the font and build the stylesheet
+    start = time.perf_counter()
+    for _ in range(report_count):
+        TTFont(ARABIC_FONT_NAME, font_path)
+        report_styles._build_styles(ARABIC_FONT_NAME)
+    uncached = (time.perf_counter() - start) / report_count
+
+    report_styles.reset()
+    start = time.perf_counter()
+    PDFBuilder(os.devnull)
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(report_count):
+        PDFBuilder(os.devnull)
+    cached = (time.perf_counter() - start) / report_count
+
+    print(f"\n{'Setup':<28} {'ms/report':>10}")
+    print(f"{'Parse font + build styles':<28} {uncached * 1000:>10.2f}")
+    print(f"{'Registry, first builder':<28} {first * 1000:>10.2f}")
+    print(f"{'Registry, later builders':<28} {cached * 1000:>10.2f}")
+    print(f"\nSaved per report after the first: {(uncached - cached) * 1000:.2f} ms "
+          f"({uncached / max(cached, 1e-9):.0f}x less)")
+
+
+def benchmark_font_cache(load_count=5):
+    """Compare parsing the Unicode font with loading it from the font cache"""
+    print("\n" + "="*60)
+    print("Benchmark: Font loading at start-up")
+    print("="*60)
+
+    import reportlab
+    from reportlab.pdfbase.ttfonts import TTFont
+    from font_cache import FontCache
+    from constants import ARABIC_FONT_PATH, ARABIC_FONT_NAME
+
+    font_path = ARABIC_FONT_PATH
+    if not os.path.exists(font_path):
+        # Much smaller than ARIALUNI.TTF, so the difference shown is a lower bound
+        font_path = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+    print(f"\nFont: {font_path} ({os.path.getsize(font_path) / (1024 * 1024):.1f} MB)")
+
+    cache_dir = tempfile.mkdtemp(prefix='font_cache_bench_')
+    try:
+        start = time.perf_counter()
+        for _ in range(load_count):
+            TTFont(ARABIC_FONT_NAME, font_path)
+        parsed = (time.perf_counter() - start) / load_count
+
+        FontCache(cache_dir).load_font(ARABIC_FONT_NAME, font_path)
+        start = time.perf_counter()
+        for _ in range(load_count):
+            FontCache(cache_dir).load_font(ARABIC_FONT_NAME, font_path)
+        cached = (time.perf_counter() - start) / load_count
+
+        print(f"\n{'Load':<16} {'ms':>10}")
+        print(f"{'Parse file':<16} {parsed * 1000:>10.2f}")
+        print(f"{'Font cache':<16} {cached * 1000:>10.2f}")
+        print(f"\nFaster start by {(parsed - cached) * 1000:.2f} ms ({parsed / max(cached, 1e-9):.1f}x)")
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def benchmark_streaming_build(entry_counts=(25, 100, 400)):
+    """Compare peak memory of building a multi-entry PDF from one story and streamed entry by entry"""
+    print("\n" + "="*60)
+    print("Benchmark: Memory of multi-entry PDF builds")
+    print("="*60)
+
+    import tracemalloc
+    from pdf_builder import PDFBuilder
+
+    fields = {f"Field {i}": "Observed condition and notes " * 8 for i in range(12)}
+
+    def add_entry(builder, index):
+        if index:
+            builder.add_page_break()
+        for section in range(4):
+            builder.add_section(f"{section + 1}. Section of entry {index + 1}", fields)
+
+    def story_build(path, count):
+        builder = PDFBuilder(path)
+        for index in range(count):
+            add_entry(builder, index)
+        builder.generate()
+
+    def streaming_build(path, count):
+        builder = PDFBuilder(path)
+
+        def entries():
+            for index in range(count):
+                add_entry(builder, index)
+                yield None
+
+        builder.generate_streaming(entries())
+
+    # Text only: reportlab keeps the finished page streams until the file is saved, and
+    # embedded images add the same amount to both builds
+    work_dir = tempfile.mkdtemp()
+    try:
+        print(f"\n{'Entries':>8} {'Story MB':>10} {'Stream MB':>10} {'PDF MB':>8}")
+        for count in entry_counts:
+            peaks = []
+            for build in (story_build, streaming_build):
+                path = os.path.join(work_dir, f"{build.__name__}.pdf")
+                tracemalloc.start()
+                build(path, count)
+                peaks.append(tracemalloc.get_traced_memory()[1] / (1024 * 1024))
+                tracemalloc.stop()
+            pdf_mb = os.path.getsize(path) / (1024 * 1024)
+            print(f"{count:>8} {peaks[0]:>10.1f} {peaks[1]:>10.1f} {pdf_mb:>8.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    """Run all benchmarks"""
+    print("Heritage Report Generator - Benchmarks")
+    print("=" * 60)
+
+    photo_count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    benchmark_image_pool(photo_count)
+    benchmark_builder_setup()
+    benchmark_font_cache()
+    benchmark_streaming_build()
+
+
+if __name__ == "__main__":
+    main()
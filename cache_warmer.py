@@ -0,0 +1,140 @@
+"""
+Cache warming for Heritage Report Generator
+
+Downloads every image linked from a CSV (all rows, not only the latest
+assessment) into the shared image cache, without building a report. Used
+before a large batch of reports or before going offline in the field.
+Images already in the cache are skipped, so an interrupted run continues
+where it stopped when started again. Images found in the given folders or
+archives are copied into the cache instead of downloaded.
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Callable
+
+from constants import DOWNLOAD_MAX_CONCURRENCY, DOWNLOAD_BANDWIDTH_KBPS, USE_FAILED_LINK_CACHE, IMAGE_CACHE_DIR
+from data_loader import DataLoader
+from image_handler import ImageHandler
+from image_sources import create_image_source
+from link_cache import FailedLinkCache
+from link_index import LinkIndex
+from shared_cache import SharedImageCache
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    """Fetches every image referenced by a CSV into the shared cache"""
+
+    def __init__(self, csv_path: str, cache_dir: str, image_sources: Optional[List[str]] = None,
+                 bandwidth_kbps: Optional[float] = None, refresh_links: bool = False):
+        """
+        Initialize cache warmer
+
+        Args:
+            csv_path: Path to CSV file
+            cache_dir: Shared image cache folder to fill
+            image_sources: Folders or ZIP archives holding already downloaded images
+            bandwidth_kbps: Download speed cap in KB/s (default: DOWNLOAD_BANDWIDTH_KBPS, 0 for none)
+            refresh_links: Try links that failed on earlier runs again
+        """
+        self.csv_path = csv_path
+        self.cache = SharedImageCache(cache_dir)
+        self.sources = [create_image_source(path) for path in image_sources or []]
+        failed_links = None
+        if USE_FAILED_LINK_CACHE:
+            failed_links = FailedLinkCache(os.path.join(IMAGE_CACHE_DIR, 'failed_links.json'),
+                                           refresh=refresh_links)
+
+        # Every image goes into the cache in full, so any later report can use it
+        self.image_handler = ImageHandler(
+            sources=self.sources,
+            plan_downloads=False,
+            bandwidth_kbps=DOWNLOAD_BANDWIDTH_KBPS if bandwidth_kbps is None else bandwidth_kbps,
+            failed_links=failed_links,
+            thumbnail_url=None,
+            shared_cache=self.cache
+        )
+        self.stats = {
+            'total': 0,
+            'already_cached': 0,
+            'downloaded': 0,
+            'copied': 0,
+            'failed': 0
+        }
+
+    def warm(self, on_progress: Optional[Callable[[int, int, str, bool], None]] = None) -> Dict[str, int]:
+        """
+        Download all images that are not cached yet
+
+        Args:
+            on_progress: Called after each file with (files done, total files, file ID, success)
+
+        Returns:
+            Dict[str, int]: Number of files found, already cached, downloaded, copied from
+            the image sources and failed
+        """
+        links = LinkIndex(DataLoader(self.csv_path).load_data()).links
+        self.stats['total'] = len(links)
+
+        pending = {}
+        for file_id, link in links.items():
+            if self.cache.contains(file_id):
+                self.stats['already_cached'] += 1
+            else:
+                pending[file_id] = link
+
+        logger.info(f"{len(links)} images referenced, {self.stats['already_cached']} already cached, "
+                    f"{len(pending)} to download")
+
+        done = self.stats['already_cached']
+        executor = ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_CONCURRENCY, len(pending))))
+        try:
+            futures = {
+                executor.submit(self._fetch, file_id, link): file_id
+                for file_id, link in pending.items()
+            }
+            for future in as_completed(futures):
+                file_id = futures[future]
+                outcome = future.result()
+                self.stats[outcome] += 1
+                ok = outcome != 'failed'
+                done += 1
+                if on_progress:
+                    on_progress(done, len(links), file_id, ok)
+        finally:
+            # On interruption, queued downloads are dropped; the next run picks them up
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return dict(self.stats)
+
+    def cleanup(self):
+        """Clean up temporary files"""
+        self.image_handler.cleanup()
+
+    def _fetch(self, file_id: str, link: str) -> str:
+        """
+        Get one file into the cache and release the in-memory copy
+
+        Returns:
+            str: 'downloaded', 'copied' (from an image source) or 'failed'
+        """
+        try:
+            # The handler only puts downloads into the shared cache, so files from a source are copied here
+            local = any(source.contains(file_id) for source in self.sources)
+            image = self.image_handler.download_drive_image(link, file_id)
+            if image is None:
+                return 'failed'
+            if local:
+                with self.cache.lock(file_id):
+                    if not self.cache.contains(file_id):
+                        self.cache.put(file_id, image)
+                return 'copied'
+            return 'downloaded'
+        except Exception as e:
+            logger.error(f"Error caching {file_id}: {e}")
+            return 'failed'
+        finally:
+            self.image_handler.forget_image(file_id)
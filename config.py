@@ -42,6 +42,30 @@ ADDITIONAL_IMAGE_HEIGHT = 2
 # Number of images per row in grid
 IMAGES_PER_ROW = 2
 
+# Reports with more additional images than this show them as numbered thumbnails
+# on contact sheets (a few page-sized images with an index) instead of a grid.
+# 0 always uses the grid.
+CONTACT_SHEET_THRESHOLD = 0
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_ROWS = 5
+
+# Resample images to the size they are drawn at before embedding
+DOWNSAMPLE_IMAGES = True
+
+# Resolution of embedded images (dots per inch of the drawn size)
+IMAGE_TARGET_DPI = 150
+
+# Worker processes used to resample images (0 = use all CPU cores)
+IMAGE_WORKERS = 0
+
+# Memory one image may take while it is decoded (MB). Larger photos and scans are
+# decoded at reduced size, or a strip at a time. Images that cannot be (such as large
+# PNG scans) are decoded in a separate process limited to DECODE_ISOLATED_MAX_MEMORY_MB,
+# so running out of memory there cannot stop the report. Lower these on computers
+# with little memory.
+DECODE_MAX_MEMORY_MB = 256
+DECODE_ISOLATED_MAX_MEMORY_MB = 2048
+
 # ==============================================================================
 # DOWNLOAD SETTINGS
 # ==============================================================================
@@ -55,6 +79,58 @@ CHUNK_SIZE = 8192
 # Maximum download retry attempts
 MAX_RETRIES = 3
 
+# Parallel downloads: starting and maximum number of simultaneous transfers.
+# Concurrency is raised while downloads go well and halved when Google Drive throttles.
+DOWNLOAD_INITIAL_CONCURRENCY = 2
+DOWNLOAD_MAX_CONCURRENCY = 8
+
+# Retry backoff (seconds): waits grow 1, 2, 4, ... up to the maximum, with random jitter
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Pause all downloads after this many consecutive failures, for the cooldown (seconds)
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+
+# Start downloading the images of the newest assessment while the CSV is still being read,
+# once no newer assessment has turned up for PREFETCH_SETTLE_SECONDS (a CSV sorted by date
+# finds a newer one on every row, and prefetching each of them would waste requests)
+PREFETCH_IMAGES = True
+PREFETCH_SETTLE_SECONDS = 0.2
+
+# Before downloading, ask for each file's size and type (HEAD request), skip links that
+# are not images, and start the largest files first so no big file is left running alone.
+# The lookups are an extra round trip before the first download starts, so this only pays
+# off for fields with many links of very different sizes; fields with fewer than
+# PLAN_MIN_LINKS links still to download are never looked up
+PLAN_DOWNLOADS = False
+PLAN_MIN_LINKS = 3
+PLAN_TIMEOUT = 10
+
+# Cap on the total download speed in KB/s, shared by all parallel downloads, so a
+# shared satellite or cellular link stays usable for others. 0 = no limit.
+# Up to DOWNLOAD_BURST_KB may arrive at full speed after a pause.
+DOWNLOAD_BANDWIDTH_KBPS = 0
+DOWNLOAD_BURST_KB = 256
+
+# When the server takes longer to start sending a file than it did for 95% of recent
+# files (HEDGE_PERCENTILE), send the same request again and use whichever answers first.
+# Starts after HEDGE_MIN_SAMPLES files, never sooner than HEDGE_MIN_DELAY seconds.
+HEDGE_DOWNLOADS = True
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MIN_DELAY = 1.0
+
+# A transfer that receives less than STALL_MIN_KBPS over STALL_WINDOW seconds is
+# dropped and continued with a new request from where it stopped. 0 = never.
+STALL_MIN_KBPS = 2
+STALL_WINDOW = 15
+
+# Download additional images as thumbnails rendered by Google Drive at the size they
+# are printed, instead of the full-resolution originals. Falls back to the original
+# when no thumbnail is available. The primary photo is always downloaded in full.
+USE_DRIVE_THUMBNAILS = True
+
 # ==============================================================================
 # PAGE SETTINGS
 # ==============================================================================
@@ -98,6 +174,10 @@ BOLD_FONT = 'Helvetica-Bold'
 ARABIC_FONT_PATH = 'ARIALUNI.TTF'
 ARABIC_FONT_NAME = 'ArialUnicode'
 
+# Keep the parsed Arabic font in the cache folder (IMAGE_CACHE_DIR/fonts), so later
+# runs start without parsing the font file again. Replacing the font file is detected.
+USE_FONT_CACHE = True
+
 # ==============================================================================
 # ADVANCED SETTINGS
 # ==============================================================================
@@ -108,12 +188,53 @@ DEBUG_MODE = False
 # Save downloaded images after report generation
 KEEP_DOWNLOADED_IMAGES = False
 
+# Keep downloaded images in memory instead of the temporary folder.
+# Images larger than SPOOL_MAX_MEMORY_MB, or beyond SPOOL_TOTAL_MEMORY_MB in total,
+# are written to the temporary folder instead.
+SPOOL_IMAGES = True
+SPOOL_MAX_MEMORY_MB = 16
+SPOOL_TOTAL_MEMORY_MB = 256
+
 # Image quality (1-100, higher is better quality but larger file size)
 IMAGE_QUALITY = 85
 
+# Reuse resampled images from earlier runs
+USE_DERIVATIVE_CACHE = True
+
+# Folder for cached images (default: .heritage_report_cache in the user's home folder)
+# IMAGE_CACHE_DIR = 'C:/HeritageReportCache'
+
+# Maximum size of the resampled image cache (MB)
+DERIVATIVE_CACHE_MAX_MB = 500
+
+# Remember links that are deleted, not shared or not images, and skip them on later
+# runs until FAILED_LINK_TTL_HOURS have passed (use --refresh-links to try them all)
+USE_FAILED_LINK_CACHE = True
+FAILED_LINK_TTL_HOURS = 24
+
+# Folder where downloaded images are kept and shared by several copies of the program
+# running at once (on one computer or a shared drive); each image is downloaded once.
+# Empty = off. Can also be given with --shared-cache.
+SHARED_IMAGE_CACHE_DIR = ''
+
+# How --export-images places files: 'auto' clones them (copy-on-write file systems) or
+# hard links them when the output folder is on the same drive, which takes no time or
+# space; 'copy' always makes real copies. Hard linked files share their contents with
+# the downloaded copy, so use 'copy' if exported images are edited in place.
+EXPORT_LINK_MODE = 'auto'
+EXPORT_WORKERS = 4
+
 # Maximum PDF file size warning (MB)
 MAX_PDF_SIZE_WARNING = 50
 
+# Target size for the finished PDF (MB), e.g. to fit an email attachment limit.
+# Images are given lower resolution and JPEG quality until the report fits;
+# the primary photo keeps its quality longest. 0 turns the budget off.
+PDF_SIZE_BUDGET_MB = 0
+
+# Resolution (DPI) and JPEG quality steps tried, from best to smallest
+SIZE_BUDGET_LEVELS = [(150, 85), (150, 75), (120, 70), (100, 65), (85, 55), (72, 45)]
+
 # ==============================================================================
 # CUSTOM FIELD MAPPINGS
 # ==============================================================================
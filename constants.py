@@ -2,6 +2,8 @@
 Constants and configuration for Heritage Report Generator
 """
 
+import os
+
 from reportlab.lib.pagesizes import A4, letter
 from reportlab.lib.units import inch
 
@@ -30,10 +32,71 @@ ADDITIONAL_IMAGE_WIDTH = 3
 ADDITIONAL_IMAGE_HEIGHT = 2
 IMAGES_PER_ROW = 2
 
+# Contact sheets: above this many additional images, they are shown as numbered
+# thumbnails composited into page-sized images (0 = never)
+CONTACT_SHEET_THRESHOLD = 0
+CONTACT_SHEET_COLUMNS = 4
+CONTACT_SHEET_ROWS = 5
+
+# Image preprocessing settings
+DOWNSAMPLE_IMAGES = True
+IMAGE_TARGET_DPI = 150
+IMAGE_QUALITY = 85
+IMAGE_WORKERS = 0  # worker processes for resampling, 0 = all CPU cores
+DECODE_MAX_MEMORY_MB = 256  # decoded pixels of one image; larger images are reduced while decoding
+DECODE_ISOLATED_MAX_MEMORY_MB = 2048  # hard cap of the separate process that decodes images no reduction fits
+
+# In-memory image buffers (temp files are used above these sizes)
+SPOOL_IMAGES = True
+SPOOL_MAX_MEMORY_MB = 16  # per image
+SPOOL_TOTAL_MEMORY_MB = 256  # all images together
+SPOOL_MMAP_THRESHOLD_MB = 64  # larger spilled files are memory-mapped
+
+# Derivative cache settings
+USE_DERIVATIVE_CACHE = True
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.heritage_report_cache')
+DERIVATIVE_CACHE_MAX_MB = 500
+USE_FAILED_LINK_CACHE = True
+FAILED_LINK_TTL_HOURS = 24  # dead links are tried again after this
+SHARED_IMAGE_CACHE_DIR = ''  # downloads shared between processes, '' = off
+EXPORT_LINK_MODE = 'auto'  # 'auto' = reflink or hard link exported images if possible, 'copy' = always copy
+EXPORT_WORKERS = 4
+
+# PDF size settings
+MAX_PDF_SIZE_WARNING = 50  # MB
+PDF_SIZE_BUDGET_MB = 0  # 0 = no budget
+SIZE_BUDGET_LEVELS = [(150, 85), (150, 75), (120, 70), (100, 65), (85, 55), (72, 45)]  # (dpi, JPEG quality)
+PRIMARY_IMAGE_WEIGHT = 3  # the primary photo is reduced this many times later than others
+
 # Download settings
 DOWNLOAD_TIMEOUT = 30  # seconds
 CHUNK_SIZE = 8192  # bytes
 MAX_RETRIES = 3
+DRIVE_DOWNLOAD_URL = "https://drive.google.com/uc?export=download&id={file_id}"
+
+# Download rate control
+DOWNLOAD_INITIAL_CONCURRENCY = 2
+DOWNLOAD_MAX_CONCURRENCY = 8
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 60.0  # seconds
+CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive failures
+CIRCUIT_BREAKER_COOLDOWN = 60  # seconds
+PREFETCH_IMAGES = True  # start downloads while the CSV is still loading
+PREFETCH_SETTLE_SECONDS = 0.2  # a row is prefetched once no newer row was found for this long
+PLAN_DOWNLOADS = False  # look up file sizes first and download the largest first
+PLAN_MIN_LINKS = 3  # fewer remote links than this are downloaded without the lookups
+PLAN_TIMEOUT = 10  # seconds, for each size lookup
+DOWNLOAD_BANDWIDTH_KBPS = 0  # total for all downloads, 0 = unlimited
+DOWNLOAD_BURST_KB = 256  # received at full speed after an idle period
+HEDGE_DOWNLOADS = True  # send a second request when the server is slow to answer the first
+HEDGE_PERCENTILE = 95  # of recent answer times, after which the second request is sent
+HEDGE_MIN_SAMPLES = 5  # answers seen before hedging starts
+HEDGE_MIN_DELAY = 1.0  # seconds
+STALL_MIN_KBPS = 2  # transfers slower than this are restarted where they stopped, 0 = never
+STALL_WINDOW = 15  # seconds over which the transfer speed is measured
+USE_DRIVE_THUMBNAILS = True  # fetch small server-rendered versions of additional images
+DRIVE_THUMBNAIL_URL = "https://drive.google.com/thumbnail?id={file_id}&sz=s{size}"
+THUMBNAIL_FILL_MARGIN = 2.0  # extra size for images cropped to fill their slot
 
 # Page settings
 PAGE_SIZE = A4
@@ -58,6 +121,7 @@ DEFAULT_FONT = 'Helvetica'
 BOLD_FONT = 'Helvetica-Bold'
 ARABIC_FONT_PATH = 'ARIALUNI.TTF'
 ARABIC_FONT_NAME = 'ArialUnicode'
+USE_FONT_CACHE = True  # keep parsed fonts in IMAGE_CACHE_DIR/fonts for a faster start
 
 # Try to load custom config and override defaults
 try:
@@ -0,0 +1,120 @@
+"""
+Contact sheets for Heritage Report Generator
+
+Composites many image thumbnails into one page-sized JPEG, so reports with
+hundreds of additional images embed a handful of images instead of one
+image object per photo. Each thumbnail is numbered; the PDF builder prints
+an index of the numbers below each sheet.
+"""
+
+import io
+import logging
+from typing import List, Tuple
+
+from PIL import Image as PILImage, ImageOps, ImageDraw, ImageFont
+
+from image_buffers import ImageRef, open_image_source
+from exceptions import ImageTooLargeError
+from image_processor import decode_bounded, decode_isolated
+
+logger = logging.getLogger(__name__)
+
+# Gap around each thumbnail, as a fraction of the cell width
+CELL_PADDING = 0.04
+
+# Height of the number strip under each thumbnail, as a fraction of the cell height
+LABEL_HEIGHT = 0.14
+
+SHEET_BACKGROUND = 'white'
+PLACEHOLDER_COLOR = '#dddddd'
+LABEL_COLOR = '#333333'
+
+
+def load_thumbnail(image: ImageRef, max_size: Tuple[int, int]) -> PILImage.Image:
+    """
+    Decode an image at thumbnail size
+
+    JPEGs are decoded at a reduced scale (draft mode), and other large images
+    a strip at a time, so large photos are never decoded at full resolution
+    here. Images that cannot be are decoded in a separate process.
+
+    Args:
+        image: Image path or spooled image
+        max_size: Largest (width, height) of the thumbnail
+
+    Returns:
+        PILImage.Image: RGB thumbnail
+    """
+    source = open_image_source(image)
+    try:
+        try:
+            decoded = decode_bounded(source, max_size)
+        except ImageTooLargeError:
+            decoded = decode_isolated(image, max_size)
+        with decoded as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(max_size, PILImage.Resampling.LANCZOS)
+
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                background = PILImage.new('RGB', img.size, SHEET_BACKGROUND)
+                background.paste(img, mask=img.getchannel('A'))
+                return background
+            return img.convert('RGB')
+    finally:
+        if source is not image:
+            source.close()
+
+
+def render_contact_sheet(images: List[ImageRef], columns: int, cell_size: Tuple[int, int],
+                         first_number: int = 1, quality: int = 85) -> bytes:
+    """
+    Composite numbered thumbnails into one JPEG
+
+    Args:
+        images: Images to place, left to right and top to bottom
+        columns: Thumbnails per row
+        cell_size: (width, height) of each cell in pixels, including its number
+        first_number: Number printed under the first thumbnail
+        quality: JPEG quality (1-100)
+
+    Returns:
+        bytes: Encoded contact sheet; unused rows are left off
+    """
+    cell_width, cell_height = cell_size
+    label_height = max(10, int(cell_height * LABEL_HEIGHT))
+    padding = max(2, int(cell_width * CELL_PADDING))
+    thumb_size = (cell_width - 2 * padding, cell_height - label_height - 2 * padding)
+
+    rows = (len(images) + columns - 1) // columns
+    sheet = PILImage.new('RGB', (columns * cell_width, rows * cell_height), SHEET_BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+
+    try:
+        font = ImageFont.load_default(size=int(label_height * 0.8))
+    except TypeError:
+        # Pillow before 10.1 only has the fixed-size bitmap font
+        font = ImageFont.load_default()
+
+    for i, image in enumerate(images):
+        x = (i % columns) * cell_width
+        y = (i // columns) * cell_height
+
+        try:
+            thumb = load_thumbnail(image, thumb_size)
+            sheet.paste(thumb, (x + (cell_width - thumb.width) // 2,
+                                y + padding + (thumb_size[1] - thumb.height) // 2))
+        except Exception as e:
+            logger.warning(f"Could not add {image} to contact sheet: {e}")
+            draw.rectangle([x + padding, y + padding, x + padding + thumb_size[0], y + padding + thumb_size[1]],
+                           fill=PLACEHOLDER_COLOR)
+
+        label = str(first_number + i)
+        left, top, right, bottom = draw.textbbox((0, 0), label, font=font)
+        draw.text((x + (cell_width - (right - left)) // 2 - left,
+                   y + cell_height - label_height + (label_height - (bottom - top)) // 2 - top),
+                  label, fill=LABEL_COLOR, font=font)
+
+    buffer = io.BytesIO()
+    sheet.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
@@ -5,7 +5,7 @@ This version uses Python's built-in csv module instead of pandas
 
 import csv
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Callable
 from datetime import datetime
 
 from exceptions import CSVLoadError, DataValidationError
@@ -14,6 +14,38 @@ from utils import safe_str
 
 logger = logging.getLogger(__name__)
 
+# Column used to pick the latest entry
+DATE_COLUMN = 'Date of Assessment'
+
+# Date formats tried in order when parsing the date column
+DATE_FORMATS = [
+    DATE_INPUT_FORMAT,  # From constants
+    '%Y/%m/%d', '%m/%d/%Y', '%d/%m/%Y',
+    '%Y-%m-%d', '%m-%d-%Y', '%d-%m-%Y'
+]
+
+
+def parse_entry_date(date_str: str) -> Optional[datetime]:
+    """
+    Parse an assessment date in any of the supported formats
+    
+    Args:
+        date_str: Date string from the CSV
+        
+    Returns:
+        Optional[datetime]: Parsed date or None
+    """
+    date_str = date_str.strip()
+    if not date_str:
+        return None
+    
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            continue
+    return None
+
 
 class DataLoader:
     """Handles CSV data loading without pandas dependency"""
@@ -25,8 +57,15 @@ class DataLoader:
         self.headers = []
         self.latest_entry = None
         
-    def load_data(self) -> List[Dict[str, str]]:
-        """Load CSV data using built-in csv module"""
+    def load_data(self, on_candidate: Optional[Callable[[Dict[str, str]], None]] = None) -> List[Dict[str, str]]:
+        """
+        Load CSV data using built-in csv module
+        
+        Args:
+            on_candidate: Called while rows stream in, each time a row with a newer
+                assessment date than all rows before it is read. The last call is for
+                the row get_latest_entry will select.
+        """
         try:
             logger.info(f"Loading CSV file: {self.csv_path}")
             
@@ -57,7 +96,18 @@ class DataLoader:
                         csvfile.seek(0)
                         reader = csv.DictReader(csvfile, delimiter=best_delimiter)
                         self.headers = reader.fieldnames or []
-                        self.data = [row for row in reader]
+                        self.data = []
+                        candidate_date = None
+                        
+                        for row in reader:
+                            self.data.append(row)
+                            if on_candidate is None:
+                                continue
+                            
+                            row_date = parse_entry_date(row.get(DATE_COLUMN) or '')
+                            if row_date and (candidate_date is None or row_date > candidate_date):
+                                candidate_date = row_date
+                                on_candidate(row)
                         
                         logger.info(f"Loaded with {encoding} encoding, {best_delimiter} delimiter")
                         break
@@ -86,7 +136,7 @@ class DataLoader:
             self.load_data()
         
         try:
-            date_column = 'Date of Assessment'
+            date_column = DATE_COLUMN
             
             if date_column not in self.headers:
                 logger.warning(f"Date column not found, using last row")
@@ -98,24 +148,7 @@ class DataLoader:
             latest_entry = None
             
             for row in self.data:
-                date_str = row.get(date_column, '').strip()
-                if not date_str:
-                    continue
-                
-                # Try to parse date
-                date_obj = None
-                date_formats = [
-                    DATE_INPUT_FORMAT,  # From constants
-                    '%Y/%m/%d', '%m/%d/%Y', '%d/%m/%Y',
-                    '%Y-%m-%d', '%m-%d-%Y', '%d-%m-%Y'
-                ]
-                
-                for fmt in date_formats:
-                    try:
-                        date_obj = datetime.strptime(date_str, fmt)
-                        break
-                    except ValueError:
-                        continue
+                date_obj = parse_entry_date(row.get(date_column) or '')
                 
                 if date_obj and (latest_date is None or date_obj > latest_date):
                     latest_date = date_obj
@@ -0,0 +1,457 @@
+"""
+Download rate control for Heritage Report Generator
+
+Keeps parallel downloads from getting throttled by Google Drive: each host
+gets a controller that adjusts how many transfers may run at once (AIMD),
+backs off exponentially with jitter, honours Retry-After and stops sending
+requests for a while after sustained failures (circuit breaker). A token
+bucket shared by all transfers can cap the total download bandwidth.
+Response and download times are kept for latency percentiles, which also
+decide when a slow request is hedged with a second one.
+"""
+
+import math
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, Iterable
+from urllib.parse import urlparse
+
+from exceptions import ImageDownloadError
+from constants import (DOWNLOAD_INITIAL_CONCURRENCY, DOWNLOAD_MAX_CONCURRENCY, BACKOFF_BASE,
+                       BACKOFF_MAX, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN,
+                       DOWNLOAD_BANDWIDTH_KBPS, DOWNLOAD_BURST_KB, HEDGE_PERCENTILE,
+                       HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY)
+
+logger = logging.getLogger(__name__)
+
+# Latency above this multiple of the best seen latency counts as congestion
+LATENCY_CONGESTION_FACTOR = 3.0
+
+# Multiplicative decrease applied on throttling or congestion
+DECREASE_FACTOR = 0.5
+
+# Most recent latencies kept for percentiles
+LATENCY_SAMPLES = 500
+
+
+def percentile(values: Iterable[float], pct: float) -> Optional[float]:
+    """
+    Get a percentile by the nearest-rank method
+
+    Args:
+        values: Samples
+        pct: Percentile (0-100)
+
+    Returns:
+        Optional[float]: Smallest sample that at least pct percent of samples do not exceed, or None if empty
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class LatencyTracker:
+    """Recent latency samples of one kind, for percentiles"""
+
+    def __init__(self, max_samples: int = LATENCY_SAMPLES):
+        """
+        Initialize latency tracker
+
+        Args:
+            max_samples: Samples kept; older ones are dropped
+        """
+        self.samples = deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.samples)
+
+    def record(self, seconds: float):
+        """Add a sample"""
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Get a percentile of the kept samples, or None if there are none"""
+        with self.lock:
+            return percentile(self.samples, pct)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the sample count and the median, 90th and 99th percentiles in seconds"""
+        with self.lock:
+            samples = list(self.samples)
+        stats = {'count': len(samples)}
+        for pct in (50, 90, 99):
+            value = percentile(samples, pct)
+            stats[f'p{pct}'] = round(value, 2) if value is not None else None
+        return stats
+
+
+class HostController:
+    """Adaptive concurrency, backoff and circuit breaker for one host"""
+
+    def __init__(self, host: str, initial_limit: int = DOWNLOAD_INITIAL_CONCURRENCY,
+                 max_limit: int = DOWNLOAD_MAX_CONCURRENCY):
+        """
+        Initialize host controller
+
+        Args:
+            host: Host name this controller applies to
+            initial_limit: Concurrent transfers allowed at start
+            max_limit: Upper bound for concurrent transfers
+        """
+        self.host = host
+        self.max_limit = max(1, max_limit)
+        self.limit = float(min(max(1, initial_limit), self.max_limit))
+        self.active = 0
+        self.blocked_until = 0.0
+        self.consecutive_failures = 0
+        self.consecutive_throttles = 0
+        self.circuit_open_until = 0.0
+        self.half_open_trial = False
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.response_times = LatencyTracker()
+        self.condition = threading.Condition()
+        self.stats = {
+            'requests': 0,
+            'throttled': 0,
+            'failures': 0,
+            'circuit_trips': 0,
+            'hedged': 0,
+            'hedge_wins': 0,
+            'stalls': 0
+        }
+
+    def acquire(self):
+        """
+        Wait for a transfer slot
+
+        Raises:
+            ImageDownloadError: If the circuit breaker is open
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+
+                if self.circuit_open_until > now:
+                    raise ImageDownloadError(
+                        f"Too many failures from {self.host}, pausing downloads for "
+                        f"{self.circuit_open_until - now:.0f}s"
+                    )
+
+                if self.circuit_open_until:
+                    # Cooldown over: let a single trial request through, others wait for its result
+                    if not self.half_open_trial and self.active == 0:
+                        self.half_open_trial = True
+                        break
+                elif self.blocked_until <= now and self.active < int(self.limit):
+                    break
+
+                wait = max(0.05, self.blocked_until - now) if self.blocked_until > now else None
+                self.condition.wait(timeout=wait)
+
+            self.active += 1
+            self.stats['requests'] += 1
+
+    def try_acquire(self) -> bool:
+        """
+        Take a transfer slot only if one is free now, for requests that can be skipped
+
+        Returns:
+            bool: Whether a slot was taken (free it with release())
+        """
+        with self.condition:
+            # No extra requests while the host is throttling or recovering
+            if self.circuit_open_until or self.blocked_until > time.monotonic() or \
+                    self.active >= int(self.limit):
+                return False
+            self.active += 1
+            self.stats['requests'] += 1
+            return True
+
+    def release(self):
+        """Free a transfer slot"""
+        with self.condition:
+            self.active = max(0, self.active - 1)
+            if self.half_open_trial:
+                # The trial got an answer that was neither success nor failure
+                self._close_circuit()
+            self.condition.notify_all()
+
+    def record_success(self, latency: float):
+        """
+        Record a successful response
+
+        Args:
+            latency: Seconds until the response headers arrived
+        """
+        self.response_times.record(latency)
+        with self.condition:
+            self._close_circuit()
+            self.consecutive_failures = 0
+            self.consecutive_throttles = 0
+
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+
+            if latency > self.best_latency * LATENCY_CONGESTION_FACTOR and latency > 1.0:
+                self._decrease("latency rising")
+            else:
+                # Additive increase: about one extra slot per window of successful transfers
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            self.condition.notify_all()
+
+    def record_throttle(self, retry_after: Optional[float] = None):
+        """
+        Record a rate-limit response (HTTP 429 or rate-limited 403)
+
+        Args:
+            retry_after: Seconds the server asked us to wait, if given
+        """
+        with self.condition:
+            self.stats['throttled'] += 1
+            self.consecutive_throttles += 1
+            self._decrease("throttled")
+
+            delay = retry_after if retry_after is not None else self.backoff_delay(self.consecutive_throttles)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+            if self.half_open_trial:
+                # The host is still refusing requests: keep the circuit open for another cooldown
+                self.half_open_trial = False
+                self.circuit_open_until = time.monotonic() + max(delay, CIRCUIT_BREAKER_COOLDOWN)
+                logger.warning(f"Trial request to {self.host} was throttled, pausing downloads for "
+                               f"{self.circuit_open_until - time.monotonic():.0f}s")
+            else:
+                logger.warning(f"Throttled by {self.host}, waiting {delay:.1f}s "
+                               f"(concurrency now {int(self.limit)})")
+            self.condition.notify_all()
+
+    def record_failure(self):
+        """Record a timeout, connection error or server error"""
+        with self.condition:
+            self.stats['failures'] += 1
+            self.consecutive_failures += 1
+            self._decrease("failures")
+
+            if self.half_open_trial or self.consecutive_failures >= CIRCUIT_BREAKER_THRESHOLD:
+                self.half_open_trial = False
+                self.circuit_open_until = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+                self.stats['circuit_trips'] += 1
+                logger.warning(f"{self.consecutive_failures} consecutive failures from {self.host}, "
+                               f"pausing downloads for {CIRCUIT_BREAKER_COOLDOWN}s")
+
+            self.condition.notify_all()
+
+    def record_hedge(self, won: bool):
+        """
+        Record that a second request was sent for a slow response
+
+        Args:
+            won: Whether the second request answered first
+        """
+        with self.condition:
+            self.stats['hedged'] += 1
+            if won:
+                self.stats['hedge_wins'] += 1
+
+    def record_stall(self):
+        """Record a transfer aborted for being too slow"""
+        with self.condition:
+            self.stats['stalls'] += 1
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Get how long to wait for a response before sending a second request
+
+        Returns:
+            Optional[float]: HEDGE_PERCENTILE of recent response times (at least HEDGE_MIN_DELAY),
+            or None until HEDGE_MIN_SAMPLES responses have been seen
+        """
+        if len(self.response_times) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, self.response_times.percentile(HEDGE_PERCENTILE))
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with full jitter
+
+        Args:
+            attempt: Retry number (1 for the first retry)
+
+        Returns:
+            float: Seconds to wait before retrying
+        """
+        ceiling = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get controller statistics"""
+        with self.condition:
+            stats = dict(self.stats)
+            stats['concurrency'] = int(self.limit)
+            return stats
+
+    def _decrease(self, reason: str):
+        """Multiplicative decrease, at most once per latency window"""
+        now = time.monotonic()
+        window = max(1.0, self.best_latency or 1.0)
+        if now - self.last_decrease < window:
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+        logger.debug(f"Reduced concurrency for {self.host} to {int(self.limit)} ({reason})")
+
+    def _close_circuit(self):
+        """Close the circuit after a successful trial request"""
+        if self.circuit_open_until:
+            logger.info(f"Downloads from {self.host} recovered")
+        self.circuit_open_until = 0.0
+        self.half_open_trial = False
+
+
+class BandwidthLimiter:
+    """Token bucket shared by all transfers, capping the total download rate"""
+
+    def __init__(self, rate_kbps: float = DOWNLOAD_BANDWIDTH_KBPS, burst_kb: float = DOWNLOAD_BURST_KB):
+        """
+        Initialize bandwidth limiter
+
+        Args:
+            rate_kbps: Average rate in KB per second (0 for no limit)
+            burst_kb: Bytes that may arrive at full speed after an idle period, in KB
+        """
+        self.rate = max(0.0, rate_kbps) * 1024
+        self.burst = max(1.0, burst_kb) * 1024
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.first_byte = None
+        self.last_byte = None
+        self.lock = threading.Lock()
+        self.stats = {
+            'bytes': 0,
+            'wait_time': 0.0
+        }
+
+    def consume(self, size: int) -> float:
+        """
+        Account for received bytes, sleeping if they exceed the rate
+
+        The bucket may go into debt for chunks larger than the burst; the caller
+        then sleeps until the debt is paid off, so the average rate holds.
+
+        Args:
+            size: Bytes just received
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        wait = 0.0
+        with self.lock:
+            now = time.monotonic()
+            if self.first_byte is None:
+                self.first_byte = now
+            self.stats['bytes'] += size
+
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= size
+                if self.tokens < 0:
+                    wait = -self.tokens / self.rate
+                    self.stats['wait_time'] += wait
+
+            self.last_byte = now + wait
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get bytes received, time spent waiting and the achieved throughput"""
+        with self.lock:
+            elapsed = (self.last_byte - self.first_byte) if self.first_byte is not None else 0.0
+            return {
+                'bytes': self.stats['bytes'],
+                'wait_time': round(self.stats['wait_time'], 2),
+                'limit_kbps': self.rate / 1024,
+                'throughput_kbps': round(self.stats['bytes'] / 1024 / elapsed, 1) if elapsed > 0 else 0.0
+            }
+
+
+class DownloadController:
+    """Hands out one HostController per host and owns the shared bandwidth limiter"""
+
+    def __init__(self, bandwidth_kbps: float = DOWNLOAD_BANDWIDTH_KBPS):
+        """
+        Initialize download controller
+
+        Args:
+            bandwidth_kbps: Total download rate in KB per second for all transfers (0 for no limit)
+        """
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.bandwidth = BandwidthLimiter(bandwidth_kbps)
+        self.download_times = LatencyTracker()
+
+    def for_url(self, url: str) -> HostController:
+        """
+        Get the controller for the host of a URL
+
+        Args:
+            url: Request URL
+
+        Returns:
+            HostController: Controller shared by all requests to that host
+        """
+        host = urlparse(url).netloc or url
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostController(host)
+            return self.hosts[host]
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get combined statistics for all hosts"""
+        totals = {'requests': 0, 'throttled': 0, 'failures': 0, 'circuit_trips': 0,
+                  'hedged': 0, 'hedge_wins': 0, 'stalls': 0}
+        with self.lock:
+            controllers = list(self.hosts.values())
+        for controller in controllers:
+            for key, value in controller.get_stats().items():
+                if key in totals:
+                    totals[key] += value
+        return totals
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given in seconds or as an HTTP date
+
+    Args:
+        value: Header value
+
+    Returns:
+        Optional[float]: Seconds to wait or None
+    """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,152 @@
+"""
+Download planning for Heritage Report Generator
+
+Before a batch of downloads starts, asks the server for the size and type of
+each file with HEAD requests, drops links that are clearly not images and
+orders the rest largest first. With a fixed number of parallel transfers,
+starting the longest ones first keeps a single large file from running on
+its own at the end of the batch.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple, Any
+
+import requests
+
+from constants import PLAN_TIMEOUT, DOWNLOAD_MAX_CONCURRENCY
+from download_control import DownloadController, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Types that may still turn out to be an image: Drive serves its virus scan page
+# as HTML, and some hosts do not know the type of the file
+UNKNOWN_CONTENT_TYPES = ('text/html', 'application/octet-stream', 'binary/octet-stream')
+
+
+def is_image_content_type(content_type: str) -> bool:
+    """
+    Check whether a Content-Type could be an image
+
+    Args:
+        content_type: Content-Type header value, possibly empty
+
+    Returns:
+        bool: False only if the type is known and is not an image
+    """
+    mime_type = content_type.split(';', 1)[0].strip().lower()
+    return not mime_type or mime_type.startswith('image/') or mime_type in UNKNOWN_CONTENT_TYPES
+
+
+class DownloadPlanner:
+    """Looks up remote file sizes and types and orders downloads largest first"""
+
+    def __init__(self, session: requests.Session, controller: Optional[DownloadController] = None,
+                 timeout: float = PLAN_TIMEOUT):
+        """
+        Initialize download planner
+
+        Args:
+            session: HTTP session shared with the downloads
+            controller: Download controller told about rate limiting
+            timeout: Timeout for each HEAD request (seconds)
+        """
+        self.session = session
+        self.controller = controller
+        self.timeout = timeout
+        self.remote_files = {}
+        self.skipped_urls = set()
+        self.lock = threading.Lock()
+        self.stats = {
+            'probed': 0,
+            'probe_failures': 0,
+            'skipped': 0
+        }
+
+    def probe(self, url: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the size and type of a remote file without downloading it
+
+        Args:
+            url: Direct download URL
+
+        Returns:
+            Optional[Dict[str, Any]]: 'size' (None if not reported) and 'content_type',
+            or None if the server did not answer the HEAD request
+        """
+        with self.lock:
+            if url in self.remote_files:
+                return self.remote_files[url]
+
+        remote_file = None
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            try:
+                if response.status_code == 429 and self.controller:
+                    self.controller.for_url(url).record_throttle(
+                        parse_retry_after(response.headers.get('retry-after'))
+                    )
+                elif response.status_code == 200:
+                    content_length = response.headers.get('content-length', '')
+                    remote_file = {
+                        'size': int(content_length) if content_length.isdigit() else None,
+                        'content_type': response.headers.get('content-type', '')
+                    }
+            finally:
+                response.close()
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"HEAD request failed for {url}: {e}")
+
+        with self.lock:
+            self.remote_files[url] = remote_file
+            self.stats['probed'] += 1
+            if remote_file is None:
+                self.stats['probe_failures'] += 1
+        return remote_file
+
+    def plan(self, urls: List[str]) -> Tuple[List[int], List[int]]:
+        """
+        Decide the order to download files in
+
+        Files whose size is unknown go first, in their original order, since
+        they may be the largest; the rest follow largest first.
+
+        Args:
+            urls: Direct download URLs
+
+        Returns:
+            Tuple[List[int], List[int]]: Indices of urls in download order, and indices skipped as not images
+        """
+        if not urls:
+            return [], []
+
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_CONCURRENCY, len(urls))),
+                                thread_name_prefix='plan') as executor:
+            remote_files = list(executor.map(self.probe, urls))
+
+        order, skipped = [], []
+        for i, remote_file in enumerate(remote_files):
+            if remote_file and not is_image_content_type(remote_file['content_type']):
+                skipped.append(i)
+            else:
+                order.append(i)
+
+        def sort_key(i):
+            size = remote_files[i]['size'] if remote_files[i] else None
+            return (size is not None, -(size or 0))
+
+        order.sort(key=sort_key)
+
+        with self.lock:
+            for i in skipped:
+                if urls[i] not in self.skipped_urls:
+                    self.skipped_urls.add(urls[i])
+                    logger.warning(f"Skipping link that is not an image "
+                                   f"({remote_files[i]['content_type']}): {urls[i]}")
+            self.stats['skipped'] = len(self.skipped_urls)
+
+        total = sum(remote_files[i]['size'] or 0 for i in order if remote_files[i])
+        logger.info(f"Planned {len(order)} downloads ({total / (1024 * 1024):.1f} MB known), "
+                    f"largest first; skipped {len(skipped)}")
+        return order, skipped
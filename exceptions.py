@@ -18,6 +18,21 @@ class ImageDownloadError(ReportGeneratorError):
     """Raised when image download fails"""
     pass
 
+class DownloadThrottledError(ImageDownloadError):
+    """Raised when the download server rate limits requests"""
+    
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class DownloadCancelledError(ImageDownloadError):
+    """Raised when a prefetch is stopped because its row is no longer needed"""
+    pass
+
+class ImageTooLargeError(ReportGeneratorError):
+    """Raised when an image cannot be decoded within the memory limit"""
+    pass
+
 class PDFGenerationError(ReportGeneratorError):
     """Raised when PDF generation fails"""
     pass
@@ -0,0 +1,212 @@
+"""
+Font metrics cache for Heritage Report Generator
+
+Parsing ARIALUNI.TTF (~23 MB) takes reportlab a noticeable part of every
+cold start. This cache stores the parsed font face (tables, glyph map and
+widths) on disk, keyed by a hash of the font file and the reportlab
+version, and rebuilds the font from it without parsing. The face keeps
+the raw file bytes, which are read again on load, so glyph subsetting when
+the PDF is saved works as with a freshly parsed font.
+
+Entries are plain JSON rather than pickles, so a cache directory that
+other users can write to cannot make this process run code.
+"""
+
+import os
+import sys
+import json
+import base64
+import hashlib
+import logging
+from array import array
+from weakref import WeakKeyDictionary
+from typing import Any, Dict, Optional
+
+import reportlab
+from reportlab import rl_config
+from reportlab.pdfbase.ttfonts import TTFont, TTFontFace, TTEncoding, TTFNameBytes
+
+from utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Glyph tables are long runs of numbers, stored packed rather than as JSON numbers (much faster to read)
+NUMBER_TYPECODES = {'ints': 'q', 'floats': 'd'}
+
+
+class FontCache:
+    """Parsed TrueType fonts stored on disk, keyed by file content"""
+
+    def __init__(self, cache_dir: str):
+        """
+        Initialize font cache
+
+        Args:
+            cache_dir: Directory holding the cached fonts
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def load_font(self, name: str, path: str) -> TTFont:
+        """
+        Load a TrueType font, from the cache when the file was parsed before
+
+        Args:
+            name: Font name used in styles
+            path: Path to the .ttf file
+
+        Returns:
+            TTFont: Font ready to register with pdfmetrics
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        cache_path = os.path.join(self.cache_dir, f"{self.make_key(data)}.json")
+
+        face = self._read(cache_path, path, data)
+        if face is not None:
+            self.hits += 1
+            logger.debug(f"Loaded font {name} from cache")
+            return _font_from_face(name, face)
+
+        self.misses += 1
+        font = TTFont(name, path)
+        self._write(cache_path, font.face)
+        return font
+
+    def make_key(self, data: bytes) -> str:
+        """Get the cache key of a font file: its content hash and the reportlab version"""
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        return f"{digest}-rl{reportlab.Version}"
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get cache statistics
+
+        Returns:
+            Dict[str, int]: Fonts loaded from the cache and parsed from their file
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _read(self, cache_path: str, path: str, data: bytes) -> Optional[TTFontFace]:
+        """Rebuild a face from the cache, or None if it is not cached or unreadable"""
+        if not os.path.exists(cache_path):
+            return None
+
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                state = json.load(f, object_hook=_decode_value)
+            if not isinstance(state, dict):
+                raise ValueError("not a font face")
+            face = TTFontFace.__new__(TTFontFace)
+            face.__dict__.update(state)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable font cache entry {cache_path}: {e}")
+            return None
+
+        # The raw tables are needed to subset the font when the PDF is saved
+        face._ttf_data = data
+        face.filename = path
+        return face
+
+    def _write(self, cache_path: str, face: TTFontFace):
+        """Store a parsed face without its raw file bytes, which are read from the font file on load"""
+        state = dict(face.__dict__)
+        state.pop('_ttf_data', None)
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            with atomic_write(cache_path) as tmp_path:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(_encode_value(state), f, separators=(',', ':'))
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not save font cache entry {cache_path}: {e}")
+
+
+def _font_from_face(name: str, face: TTFontFace) -> TTFont:
+    """Build a TTFont around an already parsed face (the same fields TTFont.__init__ sets)"""
+    font = TTFont.__new__(TTFont)
+    font.fontName = name
+    font.face = face
+    font.encoding = TTEncoding()
+    font.state = WeakKeyDictionary()
+    font._asciiReadable = rl_config.ttfAsciiReadable
+    return font
+
+
+def _encode_value(value: Any) -> Any:
+    """Convert face attributes to JSON, tagging the types JSON does not have"""
+    if isinstance(value, TTFNameBytes):
+        return {'name': value.ustr}
+    if isinstance(value, bytes):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, tuple):
+        return {'tuple': [_encode_value(item) for item in value]}
+    if isinstance(value, list):
+        packed = _pack_numbers(value)
+        if packed is not None:
+            return packed
+        widths = {len(item) if type(item) is tuple else None for item in value}
+        if value and len(widths) == 1 and None not in widths:
+            # Glyph metrics: (advance, bearing) for every glyph
+            width = widths.pop()
+            return {'tuples': [width, _encode_value([field for item in value for field in item])]}
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        if all(type(key) is int for key in value):
+            # Glyph tables keyed by code point
+            return {'int_keys': [_encode_value(list(value)), _encode_value(list(value.values()))]}
+        return {'dict': [[_encode_value(key), _encode_value(item)] for key, item in value.items()]}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"cannot store {type(value).__name__} in the font cache")
+
+
+def _decode_value(tagged: Dict[str, Any]) -> Any:
+    """Rebuild a value written by _encode_value (called by json for each object, innermost first)"""
+    if len(tagged) != 1:
+        raise ValueError("malformed font cache value")
+    (tag, value), = tagged.items()
+
+    if tag == 'name':
+        return TTFNameBytes(value.encode('utf-8'))
+    if tag == 'bytes':
+        return base64.b64decode(value)
+    if tag in NUMBER_TYPECODES:
+        return _unpack_numbers(NUMBER_TYPECODES[tag], value)
+    if tag == 'tuple':
+        return tuple(value)
+    if tag == 'tuples':
+        width, fields = value
+        return list(zip(*[iter(fields)] * width))
+    if tag == 'int_keys':
+        keys, items = value
+        return dict(zip(keys, items))
+    if tag == 'dict':
+        return {key: item for key, item in value}
+    raise ValueError(f"unknown font cache value type {tag}")
+
+
+def _pack_numbers(values: list) -> Optional[Dict[str, str]]:
+    """Store a list of only ints or only floats as little-endian machine numbers, or None if it is neither"""
+    for tag, typecode in NUMBER_TYPECODES.items():
+        number_type = float if typecode == 'd' else int
+        if values and all(type(item) is number_type for item in values):
+            try:
+                packed = array(typecode, values)
+            except OverflowError:
+                return None
+            if sys.byteorder == 'big':
+                packed.byteswap()
+            return {tag: base64.b64encode(packed.tobytes()).decode('ascii')}
+    return None
+
+
+def _unpack_numbers(typecode: str, text: str) -> list:
+    """Read a list stored by _pack_numbers"""
+    packed = array(typecode)
+    packed.frombytes(base64.b64decode(text))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tolist()
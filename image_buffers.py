@@ -0,0 +1,218 @@
+"""
+Spooled image buffers for Heritage Report Generator
+
+Keeps downloaded images in memory while they are small, spills them to a
+file in the temp directory above a size threshold and memory-maps large
+files for reading. Every stage that handles images accepts either a file
+path or a SpooledImage, through the helper functions at the end of this
+module.
+"""
+
+import io
+import os
+import mmap
+import shutil
+import logging
+import tempfile
+import threading
+from typing import Union, BinaryIO
+
+from constants import SPOOL_MAX_MEMORY_MB, SPOOL_TOTAL_MEMORY_MB, SPOOL_MMAP_THRESHOLD_MB
+
+logger = logging.getLogger(__name__)
+
+
+class _MemoryBudget:
+    """Process-wide count of bytes held in memory by spooled images"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int):
+        with self.lock:
+            self.used = max(0, self.used - size)
+
+
+memory_budget = _MemoryBudget(int(SPOOL_TOTAL_MEMORY_MB * 1024 * 1024))
+
+
+class SpooledImage:
+    """An image held in memory, or in a temp file once it grows too large"""
+
+    def __init__(self, name: str, temp_dir: str, max_memory_mb: float = SPOOL_MAX_MEMORY_MB):
+        """
+        Initialize spooled image
+
+        Args:
+            name: File name used for logging, extensions and exports
+            temp_dir: Directory for the file fallback
+            max_memory_mb: Size above which the image moves to disk
+        """
+        self.name = name
+        self.temp_dir = temp_dir
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.buffer = io.BytesIO()
+        self.reserved = 0
+        self.path = None
+        self.file = None
+        self.size = 0
+        self.data = None
+
+    def __repr__(self) -> str:
+        return f"<SpooledImage {self.name} ({'disk' if self.path else 'memory'}, {self.size} bytes)>"
+
+    __str__ = __repr__
+
+    def write(self, chunk: bytes):
+        """Append data, moving to disk if the memory limits would be exceeded"""
+        if self.path is None:
+            if self.size + len(chunk) > self.max_memory or not memory_budget.reserve(len(chunk)):
+                self._rollover()
+            else:
+                self.reserved += len(chunk)
+
+        if self.path is None:
+            self.buffer.write(chunk)
+        else:
+            self.file.write(chunk)
+        self.size += len(chunk)
+
+    def truncate(self):
+        """Discard all data written so far"""
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+        else:
+            self.buffer = io.BytesIO()
+            memory_budget.release(self.reserved)
+            self.reserved = 0
+        self.size = 0
+
+    def finish(self):
+        """Mark the image as complete; it is read-only afterwards"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        elif self.data is None:
+            self.data = self.buffer.getvalue()
+            self.buffer = None
+
+    def open(self) -> BinaryIO:
+        """
+        Open the image for reading
+
+        Returns:
+            BinaryIO: A new stream positioned at the start of the image
+        """
+        if self.path is None:
+            return io.BytesIO(self.getvalue())
+
+        if self.size >= SPOOL_MMAP_THRESHOLD_MB * 1024 * 1024:
+            with open(self.path, 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return open(self.path, 'rb')
+
+    def getvalue(self) -> bytes:
+        """Get the image bytes"""
+        if self.path is None:
+            return self.data if self.data is not None else self.buffer.getvalue()
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def save(self, dest_path: str):
+        """Write the image to a file"""
+        if self.path is not None:
+            shutil.copyfile(self.path, dest_path)
+        else:
+            with open(dest_path, 'wb') as f:
+                f.write(self.getvalue())
+
+    def close(self):
+        """Release memory and remove the temp file"""
+        memory_budget.release(self.reserved)
+        self.reserved = 0
+        self.buffer = None
+        self.data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logger.debug(f"Could not remove spooled file {self.path}: {e}")
+
+    def _rollover(self):
+        """Move the data written so far into a temp file"""
+        fd, self.path = tempfile.mkstemp(dir=self.temp_dir, suffix=f"_{self.name}")
+        self.file = os.fdopen(fd, 'w+b')
+        self.file.write(self.buffer.getvalue())
+        self.buffer = None
+        memory_budget.release(self.reserved)
+        self.reserved = 0
+        logger.debug(f"Spooled image moved to disk: {self.name}")
+
+
+# An image is either a path on disk or a spooled buffer
+ImageRef = Union[str, SpooledImage]
+
+
+def image_exists(image: ImageRef) -> bool:
+    """Check whether an image is available"""
+    if isinstance(image, SpooledImage):
+        return True
+    return bool(image) and os.path.exists(image)
+
+
+def image_size(image: ImageRef) -> int:
+    """Get the size of an image in bytes"""
+    if isinstance(image, SpooledImage):
+        return image.size
+    return os.path.getsize(image)
+
+
+def image_name(image: ImageRef) -> str:
+    """Get the file name of an image"""
+    if isinstance(image, SpooledImage):
+        return image.name
+    return os.path.basename(image)
+
+
+def image_file_path(image: ImageRef) -> Union[str, None]:
+    """Get a file path for an image, or None if it only exists in memory"""
+    if isinstance(image, SpooledImage):
+        return image.path
+    return image
+
+
+def open_image_source(image: ImageRef) -> Union[str, BinaryIO]:
+    """
+    Get something PIL and reportlab's ImageReader can open
+
+    Args:
+        image: Image path or spooled image
+
+    Returns:
+        Union[str, BinaryIO]: The path itself, or a readable stream
+    """
+    if isinstance(image, SpooledImage):
+        return image.open()
+    return image
+
+
+def copy_image(image: ImageRef, dest_path: str):
+    """Copy an image to a file"""
+    if isinstance(image, SpooledImage):
+        image.save(dest_path)
+    else:
+        shutil.copy2(image, dest_path)
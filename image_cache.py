@@ -0,0 +1,209 @@
+"""
+Persistent cache of resampled images for Heritage Report Generator
+
+Derivatives are stored as ready-to-embed JPEG/PNG files so an image that
+has been rendered for a given slot before never needs decoding again.
+"""
+
+import os
+import time
+import hashlib
+import logging
+from typing import Optional, Dict, Tuple
+
+from constants import DERIVATIVE_CACHE_MAX_MB
+from image_buffers import ImageRef, image_file_path
+from utils import atomic_write, TEMP_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# Partial files older than this were left by a process that stopped while writing
+STALE_TEMP_SECONDS = 60 * 60
+
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Calculate the SHA-256 content hash of a file
+
+    Args:
+        file_path: Path to file
+        chunk_size: Read size in bytes
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_image(image: ImageRef) -> str:
+    """
+    Calculate the SHA-256 content hash of an image file or spooled image
+
+    Args:
+        image: Image path or spooled image
+
+    Returns:
+        str: Hex digest of the image bytes
+    """
+    file_path = image_file_path(image)
+    if file_path:
+        return hash_file(file_path)
+    return hashlib.sha256(image.getvalue()).hexdigest()
+
+
+class DerivativeCache:
+    """Size-bounded on-disk cache of encoded image derivatives"""
+
+    def __init__(self, cache_dir: str, max_size_mb: float = DERIVATIVE_CACHE_MAX_MB):
+        """
+        Initialize derivative cache
+
+        Args:
+            cache_dir: Directory holding cached derivatives
+            max_size_mb: Maximum total size before least recently used entries are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.entries = {}
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def make_key(self, content_hash: str, box_px: Tuple[int, int], fill: bool,
+                 dpi: int, quality: int, image_format: str) -> str:
+        """
+        Build the cache key for a derivative
+
+        Args:
+            content_hash: Hash of the source image contents
+            box_px: Target box in pixels
+            fill: Whether the image covers the box rather than fitting in it
+            dpi: Target resolution
+            quality: Encoding quality
+            image_format: Output format extension ('jpg' or 'png')
+
+        Returns:
+            str: File name of the derivative inside the cache
+        """
+        raw = f"{content_hash}|{box_px[0]}x{box_px[1]}|{int(fill)}|{dpi}|{quality}|{image_format}"
+        return f"{hashlib.sha256(raw.encode('utf-8')).hexdigest()}.{image_format}"
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a derivative
+
+        Args:
+            key: Cache key from make_key
+
+        Returns:
+            Optional[str]: Path to the cached file or None
+        """
+        path = os.path.join(self.cache_dir, key)
+        if key not in self.entries or not os.path.exists(path):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        size, _ = self.entries[key]
+        self.entries[key] = (size, os.path.getmtime(path))
+        self.pinned.add(key)
+        self.hits += 1
+        return path
+
+    def put(self, key: str, data: bytes) -> str:
+        """
+        Store a derivative
+
+        Args:
+            key: Cache key from make_key
+            data: Encoded image bytes
+
+        Returns:
+            str: Path to the cached file
+        """
+        path = os.path.join(self.cache_dir, key)
+
+        with atomic_write(path) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+
+        self.entries[key] = (len(data), os.path.getmtime(path))
+        self.pinned.add(key)
+        self._evict()
+        return path
+
+    def release(self, path: ImageRef):
+        """
+        Allow a derivative to be evicted again once the report no longer needs it
+
+        Args:
+            path: Path returned by get or put; other images are ignored
+        """
+        if isinstance(path, str) and os.path.dirname(path) == self.cache_dir:
+            self.pinned.discard(os.path.basename(path))
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Get cache statistics
+
+        Returns:
+            Dict[str, float]: Cache statistics
+        """
+        return {
+            'entries': len(self.entries),
+            'size_mb': round(sum(size for size, _ in self.entries.values()) / (1024 * 1024), 2),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _load_index(self):
+        """Build the in-memory index from the cache directory, removing stale partial files"""
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(TEMP_SUFFIX):
+                # Recent ones may still be written by another report running at the same time
+                if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                    try:
+                        os.remove(entry.path)
+                        logger.debug(f"Removed partial cache file: {entry.name}")
+                    except OSError as e:
+                        logger.debug(f"Could not remove partial cache file {entry.name}: {e}")
+                continue
+            self.entries[entry.name] = (stat.st_size, stat.st_mtime)
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits its size limit"""
+        total = sum(size for size, _ in self.entries.values())
+        if total <= self.max_size:
+            return
+
+        # Entries used by the report being built must stay on disk until it is written
+        candidates = sorted(
+            (mtime, key) for key, (_, mtime) in self.entries.items() if key not in self.pinned
+        )
+
+        for _, key in candidates:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except OSError as e:
+                logger.debug(f"Could not evict cache entry {key}: {e}")
+                continue
+            total -= self.entries.pop(key)[0]
+            logger.debug(f"Evicted cached derivative: {key}")
@@ -0,0 +1,159 @@
+"""
+Image export for Heritage Report Generator
+
+Places downloaded images in an output folder without copying their data
+where the file system allows it: a reflink (copy-on-write clone) first, then
+a hard link, and only then a real copy using copy_file_range. Exported files
+are named after their content hash, so exporting the same images again
+finds them already in place and does nothing.
+"""
+
+import os
+import sys
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from constants import EXPORT_LINK_MODE, EXPORT_WORKERS
+from image_buffers import ImageRef, image_size, image_name, image_file_path
+from image_cache import hash_image
+
+logger = logging.getLogger(__name__)
+
+# Linux ioctl that clones a file's extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Length of the content hash used in exported file names
+NAME_HASH_LENGTH = 16
+
+
+def export_name(image: ImageRef, prefix: str) -> str:
+    """
+    Get the content-addressed file name an image is exported under
+
+    Args:
+        image: Image path or spooled image
+        prefix: Name prefix (e.g. the monument name)
+
+    Returns:
+        str: File name, identical for identical image contents
+    """
+    ext = os.path.splitext(image_name(image))[1].lower() or '.jpg'
+    return f"{prefix}_{hash_image(image)[:NAME_HASH_LENGTH]}{ext}"
+
+
+def _reflink(src: str, dest: str) -> bool:
+    """Clone a file on copy-on-write file systems; False if not supported"""
+    if not sys.platform.startswith('linux'):
+        return False
+
+    import fcntl
+    try:
+        with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+
+
+def _copy(src: str, dest: str):
+    """Copy a file in the kernel where possible"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+                remaining = os.fstat(src_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+        except OSError:
+            pass
+
+    # Uses sendfile / CopyFile2 where available
+    shutil.copyfile(src, dest)
+
+
+def place_file(image: ImageRef, dest_path: str, link_mode: str = EXPORT_LINK_MODE) -> str:
+    """
+    Put an image at a path, sharing its data with the source where possible
+
+    The file appears under its final name only once complete, so an
+    interrupted export never leaves a partial file that looks exported.
+
+    Args:
+        image: Image path or spooled image
+        dest_path: Destination path
+        link_mode: 'auto' to try reflinks and hard links first, 'copy' to always copy
+
+    Returns:
+        str: How the file was placed: 'existing', 'reflink', 'hardlink', 'copy' or 'write'
+    """
+    if os.path.exists(dest_path) and os.path.getsize(dest_path) == image_size(image):
+        return 'existing'
+
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    src_path = image_file_path(image)
+
+    try:
+        if src_path is None:
+            # Only in memory: one write, nothing to link to
+            image.save(tmp_path)
+            method = 'write'
+        elif link_mode == 'auto' and _reflink(src_path, tmp_path):
+            method = 'reflink'
+        else:
+            method = 'copy'
+            if link_mode == 'auto':
+                try:
+                    os.link(src_path, tmp_path)
+                    method = 'hardlink'
+                except OSError:
+                    pass
+            if method == 'copy':
+                _copy(src_path, tmp_path)
+
+        os.replace(tmp_path, dest_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return method
+
+
+def export_images(images: List[ImageRef], output_dir: str, prefix: str,
+                  link_mode: str = EXPORT_LINK_MODE, workers: int = EXPORT_WORKERS) -> Tuple[Dict, Dict[str, int]]:
+    """
+    Export images to a folder under content-addressed names, in parallel
+
+    Args:
+        images: Images to export
+        output_dir: Output folder
+        prefix: File name prefix
+        link_mode: 'auto' to try reflinks and hard links first, 'copy' to always copy
+        workers: Parallel exports
+
+    Returns:
+        Tuple[Dict, Dict[str, int]]: Mapping of image to exported path, and how many files were
+        placed by each method
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    def export_one(image):
+        dest_path = os.path.join(output_dir, export_name(image, prefix))
+        return image, dest_path, place_file(image, dest_path, link_mode)
+
+    exported = {}
+    methods = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for image, dest_path, method in executor.map(export_one, images):
+            exported[image] = dest_path
+            methods[method] = methods.get(method, 0) + 1
+
+    return exported, methods
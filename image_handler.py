@@ -4,28 +4,121 @@ Image handling module for Heritage Report Generator
 
 import os
 import re
+import math
 import requests
 import tempfile
 import shutil
+import time
 import logging
-from typing import Optional, List, Dict, Tuple
-from PIL import Image as PILImage
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from typing import Optional, List, Dict, Tuple, Any, Iterable
 
-from exceptions import ImageDownloadError
-from constants import DOWNLOAD_TIMEOUT, CHUNK_SIZE, MAX_RETRIES
+from exceptions import ImageDownloadError, DownloadThrottledError, DownloadCancelledError
+from constants import (DOWNLOAD_TIMEOUT, CHUNK_SIZE, MAX_RETRIES, DRIVE_DOWNLOAD_URL, DOWNLOAD_MAX_CONCURRENCY,
+                       SPOOL_IMAGES, PLAN_DOWNLOADS, PLAN_MIN_LINKS, DOWNLOAD_BANDWIDTH_KBPS, USE_DRIVE_THUMBNAILS,
+                       DRIVE_THUMBNAIL_URL, THUMBNAIL_FILL_MARGIN, IMAGE_TARGET_DPI, HEDGE_DOWNLOADS,
+                       STALL_MIN_KBPS, STALL_WINDOW)
+from image_sources import ImageSource
+from download_control import DownloadController, HostController, parse_retry_after
+from download_planner import DownloadPlanner
+from link_cache import FailedLinkCache
+from shared_cache import SharedImageCache
 from utils import extract_drive_file_id, parse_image_links, create_temp_filename
+from image_metadata import probe_image, display_size
+from image_buffers import SpooledImage, ImageRef, image_exists, image_size, image_name
+from image_export import export_images
 
 logger = logging.getLogger(__name__)
 
+# Phrases Google uses in 403 responses that mean "slow down" rather than "no access"
+RATE_LIMIT_MARKERS = ('ratelimitexceeded', 'userratelimitexceeded', 'too many users', 'quota exceeded')
+
+# Responses that will not change by retrying: no access, not found, deleted
+PERMANENT_FAILURE_STATUSES = (401, 403, 404, 410)
+
+
+def thumbnail_size_for_slot(box_width: float, box_height: float, fill: bool = False,
+                            dpi: int = IMAGE_TARGET_DPI) -> int:
+    """
+    Get the longest side a server-rendered thumbnail needs for an image slot
+    
+    The thumbnail service fits images inside a square, so for slots the image
+    must cover (fill) the size is raised by THUMBNAIL_FILL_MARGIN to leave room
+    for photos whose shape differs from the slot's.
+    
+    Args:
+        box_width: Slot width in points
+        box_height: Slot height in points
+        fill: Whether the image covers the whole slot
+        dpi: Target resolution
+        
+    Returns:
+        int: Longest side of the thumbnail in pixels
+    """
+    longest = max(box_width, box_height) / 72.0 * dpi
+    if fill:
+        longest *= THUMBNAIL_FILL_MARGIN
+    return int(math.ceil(longest))
+
+
+def _close_response(future):
+    """Close the response of a hedged request that lost the race"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
 
 class ImageHandler:
     """Handles image downloading and processing"""
     
-    def __init__(self):
-        """Initialize image handler"""
+    def __init__(self, download_url: str = DRIVE_DOWNLOAD_URL, sources: Optional[List[ImageSource]] = None,
+                 spool: bool = SPOOL_IMAGES, plan_downloads: bool = PLAN_DOWNLOADS,
+                 bandwidth_kbps: float = DOWNLOAD_BANDWIDTH_KBPS,
+                 failed_links: Optional[FailedLinkCache] = None,
+                 thumbnail_url: Optional[str] = DRIVE_THUMBNAIL_URL if USE_DRIVE_THUMBNAILS else None,
+                 shared_cache: Optional[SharedImageCache] = None, hedge_downloads: bool = HEDGE_DOWNLOADS):
+        """
+        Initialize image handler
+        
+        Args:
+            download_url: Direct download URL template with a {file_id} placeholder
+            sources: Local folders or archives to look in before downloading
+            spool: Keep downloaded images in memory, using the temp directory only for large files
+            plan_downloads: Look up file sizes first, skip non-images and download the largest first
+            bandwidth_kbps: Total download rate in KB per second (0 for no limit)
+            failed_links: Cache of links that failed permanently on earlier runs
+            thumbnail_url: Thumbnail URL template with {file_id} and {size} placeholders, or None to
+                always download originals
+            shared_cache: Image cache shared with other generator processes
+            hedge_downloads: Send a second request when the server is unusually slow to answer
+        """
+        self.download_url = download_url
+        self.sources = sources or []
+        self.spool = spool
+        self.failed_links = failed_links
+        self.shared_cache = shared_cache
+        self.failure_reasons = {}
+        self.unavailable_images = []
+        self.offline_hits = 0
         self.temp_dir = tempfile.mkdtemp()
+        self.thumbnail_url = thumbnail_url
         self.downloaded_images = {}
+        self.thumbnails = {}
+        self.thumbnail_fallbacks = 0
         self.session = requests.Session()
+        self.download_controller = DownloadController(bandwidth_kbps)
+        self.planner = DownloadPlanner(self.session, self.download_controller) if plan_downloads else None
+        self.hedge_downloads = hedge_downloads
+        self.hedge_executor = None
+        self.stall_min_kbps = STALL_MIN_KBPS
+        self.stall_window = STALL_WINDOW
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.prefetch_executor = None
+        # (file ID, future, event set to stop the download) for each prefetch
+        self.prefetch_futures = []
+        self.local = threading.local()
         logger.info(f"Created temporary directory: {self.temp_dir}")
         
     def __del__(self):
@@ -35,111 +128,701 @@ class ImageHandler:
     def cleanup(self):
         """Clean up temporary files and directory"""
         try:
+            if getattr(self, 'prefetch_executor', None) is not None:
+                self.cancel_prefetch()
+                self.prefetch_executor.shutdown(wait=True, cancel_futures=True)
+                self.prefetch_executor = None
+            
+            if getattr(self, 'hedge_executor', None) is not None:
+                # Requests that lost a race close their response when they finish
+                self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+                self.hedge_executor = None
+            
             if hasattr(self, 'session'):
                 self.session.close()
             
+            for source in getattr(self, 'sources', []):
+                source.close()
+            
+            for image in list(getattr(self, 'downloaded_images', {}).values()) + \
+                    list(getattr(self, 'thumbnails', {}).values()):
+                if isinstance(image, SpooledImage):
+                    image.close()
+            
             if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
                 shutil.rmtree(self.temp_dir)
                 logger.info(f"Cleaned up temporary directory: {self.temp_dir}")
         except Exception as e:
             logger.error(f"Error during cleanup: {e}")
     
-    def download_drive_image(self, url: str, filename_prefix: str = "image") -> Optional[str]:
+    def download_drive_image(self, url: str, filename_prefix: str = "image",
+                             thumbnail_size: Optional[int] = None) -> Optional[ImageRef]:
         """
         Download image from Google Drive
         
         Args:
             url: Google Drive URL
             filename_prefix: Prefix for saved file
+            thumbnail_size: Longest side in pixels the image is needed at; a server-rendered
+                thumbnail of that size is fetched instead of the original when available
             
         Returns:
-            Optional[str]: Path to downloaded image or None
+            Optional[ImageRef]: Path to downloaded image, spooled image, or None
         """
         file_id = extract_drive_file_id(url)
         if not file_id:
             logger.warning(f"Could not extract file ID from URL: {url}")
             return None
         
-        # Check if already downloaded
-        if file_id in self.downloaded_images:
-            logger.debug(f"Image already downloaded: {file_id}")
-            return self.downloaded_images[file_id]
+        # Only one thread downloads a given file, the others wait for its result
+        with self._file_lock(file_id):
+            # Check if already downloaded
+            if file_id in self.downloaded_images:
+                logger.debug(f"Image already downloaded: {file_id}")
+                return self.downloaded_images[file_id]
+            
+            local_path = self._fetch_from_sources(file_id, filename_prefix)
+            if local_path:
+                return local_path
+            
+            failure = self.failed_links.get(file_id) if self.failed_links else None
+            if failure:
+                logger.info(f"Skipping {filename_prefix}, link failed on an earlier run: {failure['reason']}")
+                self.failure_reasons[file_id] = failure['reason']
+                return None
+            
+            # Other processes sharing the cache wait here while this one downloads the file
+            with self._shared_lock(file_id):
+                cached = self._fetch_from_shared_cache(file_id, thumbnail_size, filename_prefix)
+                if cached:
+                    return cached
+                
+                if thumbnail_size and self.thumbnail_url:
+                    thumbnail = self._download_thumbnail(file_id, thumbnail_size, filename_prefix)
+                    if thumbnail:
+                        self._store_in_shared_cache(f"{file_id}_s{thumbnail_size}", thumbnail, file_id)
+                        return thumbnail
+                    if self._prefetch_cancelled():
+                        return None
+                
+                image = self._download_file(file_id, url, filename_prefix)
+                if image:
+                    self._store_in_shared_cache(file_id, image)
+                return image
+    
+    def _shared_lock(self, file_id: str):
+        """Get the cross-process lock for a file ID, or a no-op without a shared cache"""
+        if self.shared_cache is None:
+            return contextlib.nullcontext()
+        return self.shared_cache.lock(file_id)
+    
+    def _fetch_from_shared_cache(self, file_id: str, thumbnail_size: Optional[int],
+                                 filename_prefix: str) -> Optional[str]:
+        """Get a file, or a thumbnail of the requested size, another process already downloaded"""
+        if self.shared_cache is None:
+            return None
+        
+        keys = [file_id] + ([f"{file_id}_s{thumbnail_size}"] if thumbnail_size else [])
+        for key in keys:
+            path = self.shared_cache.get(key)
+            if not path:
+                continue
+            if not self._validate_image(path):
+                logger.warning(f"Removing unreadable image from shared cache: {path}")
+                self.shared_cache.remove(key)
+                continue
+            
+            if key == file_id:
+                self.downloaded_images[file_id] = path
+            else:
+                self.thumbnails[(file_id, thumbnail_size)] = path
+            logger.info(f"Using {filename_prefix} from shared cache")
+            return path
+        
+        return None
+    
+    def _store_in_shared_cache(self, key: str, image: ImageRef, lock_key: Optional[str] = None):
+        """Copy a downloaded image into the shared cache for other processes, holding the lock of lock_key or key"""
+        if self.shared_cache is None:
+            return
+        try:
+            self.shared_cache.put(key, image, lock_key)
+        except OSError as e:
+            logger.warning(f"Could not add {image_name(image)} to shared cache: {e}")
+    
+    def _download_thumbnail(self, file_id: str, size: int, filename_prefix: str) -> Optional[ImageRef]:
+        """
+        Fetch a server-rendered thumbnail, in a single attempt
+        
+        Any problem (no thumbnail for the file, an error page, a thumbnail smaller
+        than requested) returns None so the caller downloads the original.
+        
+        Args:
+            file_id: Google Drive file ID
+            size: Longest side in pixels
+            filename_prefix: Prefix for saved file
+            
+        Returns:
+            Optional[ImageRef]: Thumbnail image or None
+        """
+        if (file_id, size) in self.thumbnails:
+            return self.thumbnails[(file_id, size)]
+        
+        thumbnail_url = self.thumbnail_url.format(file_id=file_id, size=size)
+        name = f"{file_id}_s{size}.part"
+        part = SpooledImage(name, self.temp_dir) if self.spool else os.path.join(self.temp_dir, name)
+        controller = self.download_controller.for_url(thumbnail_url)
+        image = None
+        
+        try:
+            controller.acquire()
+        except ImageDownloadError:
+            return None
+        
+        try:
+            status, content_type = self._fetch_to_part(thumbnail_url, part, '', controller)
+            if status == 'complete' and content_type.startswith('image/'):
+                ext = self._get_file_extension(content_type)
+                temp_path = create_temp_filename(f"{filename_prefix}_thumb", ext.lstrip('.'), self.temp_dir)
+                if isinstance(part, SpooledImage):
+                    part.finish()
+                    part.name = os.path.basename(temp_path)
+                    image = part
+                else:
+                    os.replace(part, temp_path)
+                    image = temp_path
+        except DownloadCancelledError:
+            # Not a missing thumbnail, so the original must not be downloaded instead
+            self._discard_part(part)
+            return None
+        except DownloadThrottledError as e:
+            controller.record_throttle(e.retry_after)
+        except Exception as e:
+            logger.debug(f"Thumbnail not available for {filename_prefix}: {e}")
+        finally:
+            controller.release()
+        
+        metadata = probe_image(image) if image else None
+        if metadata is None or max(metadata['width'], metadata['height']) < size:
+            # Missing, unreadable, or capped below the size needed: use the original
+            self._discard_part(image or part)
+            self.thumbnail_fallbacks += 1
+            logger.debug(f"Downloading original for {filename_prefix}, no {size}px thumbnail")
+            return None
+        
+        self.thumbnails[(file_id, size)] = image
+        logger.info(f"Downloaded {size}px thumbnail: {filename_prefix}")
+        return image
+    
+    def forget_image(self, file_id: str):
+        """
+        Drop a downloaded image from this handler, freeing its memory
+        
+        Args:
+            file_id: Google Drive file ID
+        """
+        with self._file_lock(file_id):
+            images = [self.downloaded_images.pop(file_id, None)]
+            images += [self.thumbnails.pop(key) for key in list(self.thumbnails) if key[0] == file_id]
+            for image in images:
+                if isinstance(image, SpooledImage):
+                    image.close()
+    
+    def _fetch_from_sources(self, file_id: str, filename_prefix: str) -> Optional[ImageRef]:
+        """Look for a file in the offline sources before going to the network"""
+        for source in self.sources:
+            try:
+                path = source.fetch(file_id, self.temp_dir)
+            except Exception as e:
+                logger.warning(f"Could not read {file_id} from {source.path}: {e}")
+                continue
+            
+            if path and self._validate_image(path):
+                self.downloaded_images[file_id] = path
+                self.offline_hits += 1
+                logger.info(f"Found {filename_prefix} in {source.path}")
+                return path
+            
+            if isinstance(path, SpooledImage):
+                path.close()
+        
+        return None
+    
+    def _download_file(self, file_id: str, url: str, filename_prefix: str) -> Optional[ImageRef]:
+        """Download a file with retries, backoff and resumption of partial transfers"""
+        download_url = self.download_url.format(file_id=file_id)
+        if self.spool:
+            part = SpooledImage(f"{file_id}.part", self.temp_dir)
+        else:
+            part = os.path.join(self.temp_dir, f"{file_id}.part")
+        content_type = ''
+        controller = self.download_controller.for_url(download_url)
+        start_time = time.monotonic()
         
-        # Try downloading with retries
         for attempt in range(MAX_RETRIES):
+            if attempt:
+                time.sleep(controller.backoff_delay(attempt))
+            if self._prefetch_cancelled():
+                self._discard_part(part)
+                return None
+            
+            try:
+                controller.acquire()
+            except ImageDownloadError as e:
+                logger.warning(f"Skipping {filename_prefix}: {e}")
+                self._record_failure(file_id, "downloads paused after repeated failures")
+                return None
+            
             try:
+                # Cancelled while waiting for a slot
+                if self._prefetch_cancelled():
+                    raise DownloadCancelledError("Prefetch cancelled")
                 logger.info(f"Downloading image: {filename_prefix} (attempt {attempt + 1}/{MAX_RETRIES})")
                 
-                # Google Drive direct download URL
-                download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
+                status, content_type = self._fetch_to_part(download_url, part, content_type, controller)
                 
-                response = self.session.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+                if status == 'html':
+                    self._discard_part(part)
+                    logger.warning(f"Downloaded file is not a valid image: {filename_prefix}")
+                    self._record_failure(file_id, "link opens a web page, not an image", permanent=True)
+                    return None
                 
-                # Check for virus scan warning
-                if b'confirm=' in response.content[:1000]:
-                    confirm_token = self._extract_confirm_token(response.text)
-                    if confirm_token:
-                        download_url = f"https://drive.google.com/uc?export=download&id={file_id}&confirm={confirm_token}"
-                        response = self.session.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+                if status in PERMANENT_FAILURE_STATUSES:
+                    self._discard_part(part)
+                    logger.warning(f"Failed to download (status {status}), not retrying: {url}")
+                    self._record_failure(file_id, f"HTTP {status}", permanent=True)
+                    return None
                 
-                if response.status_code == 200:
-                    # Determine file extension
-                    ext = self._get_file_extension(response.headers.get('content-type', ''))
-                    
-                    # Save to temp directory
-                    temp_path = create_temp_filename(filename_prefix, ext.lstrip('.'), self.temp_dir)
-                    
-                    with open(temp_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                            if chunk:
-                                f.write(chunk)
-                    
-                    # Validate image
-                    if self._validate_image(temp_path):
-                        self.downloaded_images[file_id] = temp_path
-                        logger.info(f"Successfully downloaded: {filename_prefix}")
-                        return temp_path
-                    else:
-                        os.remove(temp_path)
-                        logger.warning(f"Downloaded file is not a valid image: {filename_prefix}")
-                        return None
+                if status != 'complete':
+                    if status >= 500:
+                        controller.record_failure()
+                    logger.warning(f"Failed to download (status {status}): {url}")
+                    continue
+                
+                # Determine file extension and move into place
+                ext = self._get_file_extension(content_type)
+                temp_path = create_temp_filename(filename_prefix, ext.lstrip('.'), self.temp_dir)
+                if isinstance(part, SpooledImage):
+                    part.finish()
+                    part.name = os.path.basename(temp_path)
+                    image = part
                 else:
-                    logger.warning(f"Failed to download (status {response.status_code}): {url}")
+                    os.replace(part, temp_path)
+                    image = temp_path
+                
+                # Validate image
+                if self._validate_image(image):
+                    self.downloaded_images[file_id] = image
+                    self.download_controller.download_times.record(time.monotonic() - start_time)
+                    if self.failed_links:
+                        self.failed_links.forget(file_id)
+                    logger.info(f"Successfully downloaded: {filename_prefix}")
+                    return image
+                else:
+                    self._discard_part(image)
+                    logger.warning(f"Downloaded file is not a valid image: {filename_prefix}")
+                    self._record_failure(file_id, "file is not a readable image", permanent=True)
+                    return None
                     
+            except DownloadCancelledError:
+                self._discard_part(part)
+                logger.info(f"Stopped prefetching {filename_prefix}, its entry is no longer the newest")
+                return None
+            except DownloadThrottledError as e:
+                controller.record_throttle(e.retry_after)
+                logger.warning(f"Download throttled for {filename_prefix} (attempt {attempt + 1})")
             except requests.exceptions.Timeout:
+                controller.record_failure()
                 logger.warning(f"Download timeout for {filename_prefix} (attempt {attempt + 1})")
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    ImageDownloadError) as e:
+                controller.record_failure()
+                logger.warning(f"Download interrupted for {filename_prefix} (attempt {attempt + 1}): {e}")
             except Exception as e:
                 logger.error(f"Error downloading {filename_prefix}: {e}")
+            finally:
+                controller.release()
         
+        self._discard_part(part)
+        self._record_failure(file_id, f"failed after {MAX_RETRIES} attempts")
         return None
     
-    def process_image_links(self, links_str: str, prefix: str = "image") -> List[str]:
+    def _record_failure(self, file_id: str, reason: str, permanent: bool = False):
+        """
+        Remember why a file could not be fetched
+        
+        Args:
+            file_id: Google Drive file ID
+            reason: Reason shown in the report
+            permanent: Whether retrying cannot help, so later runs skip the link
+        """
+        self.failure_reasons[file_id] = reason
+        if permanent and self.failed_links:
+            self.failed_links.record(file_id, reason)
+    
+    def _discard_part(self, part: ImageRef):
+        """Throw away a partial or invalid download"""
+        if isinstance(part, SpooledImage):
+            part.close()
+        elif os.path.exists(part):
+            os.remove(part)
+    
+    def _file_lock(self, file_id: str) -> threading.Lock:
+        """Get the lock serialising downloads of one file ID"""
+        with self.lock:
+            if file_id not in self.file_locks:
+                self.file_locks[file_id] = threading.Lock()
+            return self.file_locks[file_id]
+    
+    def _fetch_to_part(self, download_url: str, part: ImageRef, content_type: str = '',
+                       controller: Optional[HostController] = None) -> Tuple[Any, str]:
+        """
+        Download a file into a .part file or spooled buffer, resuming from its current size
+        
+        Args:
+            download_url: Direct download URL
+            part: Path of the partial file, or the spooled buffer
+            content_type: Content type seen by an earlier attempt
+            controller: Host controller to report response latency to
+            
+        Returns:
+            Tuple[Any, str]: ('complete' | 'html' | HTTP status code, content type)
+            
+        Raises:
+            DownloadThrottledError: If the server is rate limiting us
+            DownloadCancelledError: If this is a prefetch that was cancelled
+            ImageDownloadError: If the connection ended before the file was complete
+        """
+        spooled = isinstance(part, SpooledImage)
+        offset = image_size(part) if image_exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        
+        start_time = time.monotonic()
+        response = self._get(download_url, headers, controller)
+        
+        try:
+            if self._is_throttled(response):
+                raise DownloadThrottledError(
+                    f"Rate limited (status {response.status_code})",
+                    retry_after=parse_retry_after(response.headers.get('retry-after'))
+                )
+            
+            if controller and response.status_code in (200, 206):
+                controller.record_success(time.monotonic() - start_time)
+            
+            # Large files get a virus scan warning page instead of the file
+            if response.status_code == 200 and 'text/html' in response.headers.get('content-type', ''):
+                confirm_token = self._extract_confirm_token(response.text)
+                if not confirm_token:
+                    return 'html', content_type
+                response.close()
+                download_url = f"{download_url}&confirm={confirm_token}"
+                response = self._get(download_url, headers, controller)
+            
+            if response.status_code == 416 and offset:
+                # Range starts at or past the end: either already complete or a stale part file
+                total = self._parse_content_range(response.headers.get('content-range', ''))[2]
+                if total == offset:
+                    return 'complete', content_type
+                self._reset_part(part)
+                raise ImageDownloadError("Partial file does not match the remote file")
+            
+            if response.status_code == 206 and offset:
+                start, _, total = self._parse_content_range(response.headers.get('content-range', ''))
+                if start != offset:
+                    self._reset_part(part)
+                    raise ImageDownloadError(f"Server resumed at byte {start} instead of {offset}")
+                mode = 'ab'
+                logger.info(f"Resuming download at {offset / (1024 * 1024):.1f} MB")
+            elif response.status_code == 200:
+                # Server ignored the Range header, start from the beginning
+                offset, total, mode = 0, None, 'wb'
+                content_length = response.headers.get('content-length')
+                if content_length and content_length.isdigit():
+                    total = int(content_length)
+            else:
+                return response.status_code, content_type
+            
+            content_type = response.headers.get('content-type', content_type)
+            received = offset
+            
+            if spooled and mode == 'wb':
+                part.truncate()
+            sink = part if spooled else open(part, mode)
+            bandwidth = self.download_controller.bandwidth
+            window_start, window_bytes, window_wait = time.monotonic(), 0, 0.0
+            
+            try:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if self._prefetch_cancelled():
+                        raise DownloadCancelledError("Prefetch cancelled")
+                    if chunk:
+                        sink.write(chunk)
+                        received += len(chunk)
+                        window_bytes += len(chunk)
+                        window_wait += bandwidth.consume(len(chunk))
+                    
+                    # Time spent under the bandwidth cap does not count against the transfer
+                    elapsed = time.monotonic() - window_start - window_wait
+                    if self.stall_min_kbps and elapsed >= self.stall_window:
+                        speed = window_bytes / 1024 / elapsed
+                        if speed < self.stall_min_kbps:
+                            if controller:
+                                controller.record_stall()
+                            raise ImageDownloadError(f"Transfer stalled at {speed:.1f} KB/s")
+                        window_start, window_bytes, window_wait = time.monotonic(), 0, 0.0
+            finally:
+                if not spooled:
+                    sink.close()
+            
+            if total is not None and received < total:
+                raise ImageDownloadError(f"Connection closed at {received} of {total} bytes")
+            
+            return 'complete', content_type
+            
+        finally:
+            response.close()
+    
+    def _get(self, url: str, headers: Dict[str, str],
+             controller: Optional[HostController] = None) -> requests.Response:
+        """
+        Send a streaming GET, hedged with a second request if the answer is slow
+        
+        If no response has arrived after the host's usual answer time (see
+        HostController.hedge_delay) and the host has a free transfer slot, the
+        request is sent again and whichever response arrives first is used;
+        the other is closed when it arrives, and the extra slot freed then.
+        
+        Args:
+            url: Request URL
+            headers: Request headers
+            controller: Host controller providing the hedge delay and transfer slots
+            
+        Returns:
+            requests.Response: First response to arrive
+        """
+        delay = controller.hedge_delay() if controller and self.hedge_downloads else None
+        if delay is None:
+            return self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+        
+        with self.lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_CONCURRENCY * 2,
+                                                         thread_name_prefix='hedge')
+        
+        def send():
+            return self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers)
+        
+        first = self.hedge_executor.submit(send)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        
+        # The second request needs a slot of its own, so it never exceeds the host's limit
+        if not controller.try_acquire():
+            logger.debug(f"No answer after {delay:.1f}s but no free slot for a second request to {url}")
+            return first.result()
+        
+        logger.info(f"No answer after {delay:.1f}s, sending a second request for {url}")
+        second = self.hedge_executor.submit(send)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                controller.record_hedge(won=future is second)
+                loser = first if future is second else second
+                loser.add_done_callback(_close_response)
+                loser.add_done_callback(lambda _: controller.release())
+                return future.result()
+        controller.release()
+        raise error
+    
+    def _reset_part(self, part: ImageRef):
+        """Empty a partial download so the next attempt starts over"""
+        if isinstance(part, SpooledImage):
+            part.truncate()
+        elif os.path.exists(part):
+            os.remove(part)
+    
+    def _is_throttled(self, response: requests.Response) -> bool:
+        """Check whether a response is a rate-limit rejection"""
+        if response.status_code == 429:
+            return True
+        if response.status_code != 403:
+            return False
+        
+        # Drive uses 403 both for missing permissions and for rate limiting
+        body = response.text[:4096].lower()
+        return any(marker in body for marker in RATE_LIMIT_MARKERS)
+    
+    def _parse_content_range(self, content_range: str) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+        """Parse a Content-Range header into (start, end, total)"""
+        match = re.match(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)', content_range.strip())
+        if not match:
+            return None, None, None
+        start, end, total = match.groups()
+        return (
+            int(start) if start else None,
+            int(end) if end else None,
+            int(total) if total and total != '*' else None
+        )
+    
+    def process_image_links(self, links_str: str, prefix: str = "image",
+                            thumbnail_size: Optional[int] = None) -> List[ImageRef]:
         """
         Process multiple image links
         
         Args:
             links_str: String containing image links
             prefix: Prefix for downloaded files
+            thumbnail_size: Longest side in pixels the images are drawn at, or None for originals
             
         Returns:
-            List[str]: Paths to downloaded images
+            List[ImageRef]: Downloaded images (paths or spooled images)
         """
         if not links_str:
             return []
         
-        links = parse_image_links(links_str)
-        images = []
+        links = [link for link in parse_image_links(links_str) if link]
+        order = self._plan_downloads(links)
         
-        for i, link in enumerate(links):
-            if link:
-                img_path = self.download_drive_image(link, f"{prefix}_{i+1}")
-                if img_path:
-                    images.append(img_path)
+        # Download in parallel; the host controller decides how many run at once
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_MAX_CONCURRENCY, len(links)))) as executor:
+            futures = {i: executor.submit(self.download_drive_image, links[i], f"{prefix}_{i+1}", thumbnail_size)
+                       for i in order}
+            results = [futures[i].result() if i in futures else None for i in range(len(links))]
+            images = [img_path for img_path in results if img_path]
+        
+        for link, result in zip(links, results):
+            if result is None:
+                file_id = extract_drive_file_id(link)
+                self.unavailable_images.append({
+                    'link': link,
+                    'reason': self.failure_reasons.get(file_id, "could not be read from the link")
+                })
         
         logger.info(f"Processed {len(images)}/{len(links)} images for {prefix}")
         return images
     
-    def resize_image(self, image_path: str, max_width: int, max_height: int) -> Tuple[int, int]:
+    def prefetch_image_links(self, links_str: str, prefix: str = "image", thumbnail_size: Optional[int] = None):
+        """
+        Start downloading image links in the background
+        
+        A later process_image_links call with the same links, prefix and thumbnail
+        size picks up the finished downloads, or waits for the ones still in progress.
+        
+        Args:
+            links_str: String containing image links
+            prefix: Prefix for downloaded files
+            thumbnail_size: Longest side in pixels the images are drawn at, or None for originals
+        """
+        links = [link for link in parse_image_links(links_str) if link]
+        if not links:
+            return
+        
+        order = self._plan_downloads(links)
+        
+        with self.lock:
+            if self.prefetch_executor is None:
+                self.prefetch_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_CONCURRENCY,
+                                                            thread_name_prefix='prefetch')
+            pending = {file_id for file_id, _, _ in self.prefetch_futures}
+            for i in order:
+                file_id = extract_drive_file_id(links[i])
+                if file_id in pending:
+                    continue
+                cancelled = threading.Event()
+                future = self.prefetch_executor.submit(self._prefetch_download, links[i], f"{prefix}_{i+1}",
+                                                       thumbnail_size, cancelled)
+                self.prefetch_futures.append((file_id, future, cancelled))
+        
+        logger.debug(f"Prefetching {len(links)} images for {prefix}")
+    
+    def _prefetch_download(self, url: str, filename_prefix: str, thumbnail_size: Optional[int],
+                           cancelled: threading.Event) -> Optional[ImageRef]:
+        """Download an image on a prefetch thread, giving up once the event is set"""
+        self.local.cancelled = cancelled
+        try:
+            return self.download_drive_image(url, filename_prefix, thumbnail_size)
+        finally:
+            self.local.cancelled = None
+    
+    def _prefetch_cancelled(self) -> bool:
+        """Check whether the prefetch running on this thread was cancelled"""
+        cancelled = getattr(self.local, 'cancelled', None)
+        return cancelled is not None and cancelled.is_set()
+    
+    def _plan_downloads(self, links: List[str]) -> List[int]:
+        """
+        Get the order to fetch links in
+        
+        Links already downloaded or available offline come first; the rest are
+        ordered by the planner, which also leaves out links that are not images.
+        Fewer than PLAN_MIN_LINKS remote links keep their order without lookups,
+        which would only delay the first download.
+        
+        Args:
+            links: Image links
+            
+        Returns:
+            List[int]: Indices of the links to fetch, in order
+        """
+        if self.planner is None:
+            return list(range(len(links)))
+        
+        local, remote = [], []
+        for i, link in enumerate(links):
+            file_id = extract_drive_file_id(link)
+            if file_id and file_id not in self.downloaded_images and \
+                    not any(source.contains(file_id) for source in self.sources) and \
+                    not (self.failed_links and self.failed_links.peek(file_id)) and \
+                    not (self.shared_cache and self.shared_cache.contains(file_id)):
+                remote.append((i, file_id, self.download_url.format(file_id=file_id)))
+            else:
+                local.append(i)
+        
+        if len(remote) < PLAN_MIN_LINKS:
+            return list(range(len(links)))
+        
+        order, skipped = self.planner.plan([url for _, _, url in remote])
+        for j in skipped:
+            remote_file = self.planner.probe(remote[j][2])
+            self._record_failure(remote[j][1], f"not an image ({remote_file['content_type']})", permanent=True)
+        return local + [remote[j][0] for j in order]
+    
+    def cancel_prefetch(self, keep: Iterable[str] = ()):
+        """
+        Drop prefetches that are no longer needed
+        
+        Queued prefetches are never started; running ones stop at their next
+        chunk and leave nothing behind, so the file can be fetched again later.
+        
+        Args:
+            keep: File IDs whose prefetches carry on
+        """
+        keep = set(keep)
+        with self.lock:
+            queued = running = 0
+            kept = []
+            for file_id, future, cancelled in self.prefetch_futures:
+                if file_id in keep:
+                    kept.append((file_id, future, cancelled))
+                elif future.cancel():
+                    queued += 1
+                elif not future.done():
+                    cancelled.set()
+                    running += 1
+            self.prefetch_futures = kept
+        
+        if queued or running:
+            logger.debug(f"Cancelled {queued} queued and {running} running prefetches")
+    
+    def resize_image(self, image_path: ImageRef, max_width: int, max_height: int) -> Tuple[int, int]:
         """
         Calculate resized dimensions maintaining aspect ratio
         
@@ -152,20 +835,23 @@ class ImageHandler:
             Tuple[int, int]: New width and height
         """
         try:
-            with PILImage.open(image_path) as img:
-                width, height = img.size
-                aspect_ratio = height / width
-                
-                # Calculate new dimensions
-                if width > max_width:
-                    width = max_width
-                    height = int(width * aspect_ratio)
-                
-                if height > max_height:
-                    height = max_height
-                    width = int(height / aspect_ratio)
-                
-                return width, height
+            metadata = probe_image(image_path)
+            if metadata is None:
+                raise ValueError(f"Not a readable image: {image_path}")
+            
+            width, height = display_size(metadata)
+            aspect_ratio = height / width
+            
+            # Calculate new dimensions
+            if width > max_width:
+                width = max_width
+                height = int(width * aspect_ratio)
+            
+            if height > max_height:
+                height = max_height
+                width = int(height / aspect_ratio)
+            
+            return width, height
                 
         except Exception as e:
             logger.error(f"Error calculating image dimensions: {e}")
@@ -178,14 +864,35 @@ class ImageHandler:
         Returns:
             Dict[str, int]: Download statistics
         """
+        controller_stats = self.download_controller.get_stats()
+        bandwidth_stats = self.download_controller.bandwidth.get_stats()
         stats = {
-            'total_downloaded': len(self.downloaded_images),
-            'total_size_mb': 0
+            'total_downloaded': len(self.downloaded_images) + len(self.thumbnails),
+            'thumbnails': len(self.thumbnails),
+            'thumbnail_fallbacks': self.thumbnail_fallbacks,
+            'shared_cache_hits': self.shared_cache.get_stats()['hits'] if self.shared_cache else 0,
+            'total_size_mb': 0,
+            'offline_hits': self.offline_hits,
+            'throttle_events': controller_stats['throttled'],
+            'circuit_trips': controller_stats['circuit_trips'],
+            'skipped_non_images': self.planner.stats['skipped'] if self.planner else 0,
+            'skipped_failed_links': self.failed_links.get_stats()['hits'] if self.failed_links else 0,
+            'bytes_received': bandwidth_stats['bytes'],
+            'throughput_kbps': bandwidth_stats['throughput_kbps'],
+            'bandwidth_limit_kbps': bandwidth_stats['limit_kbps'],
+            'bandwidth_wait_s': bandwidth_stats['wait_time'],
+            'hedged_requests': controller_stats['hedged'],
+            'hedge_wins': controller_stats['hedge_wins'],
+            'stalled_transfers': controller_stats['stalls']
         }
         
-        for path in self.downloaded_images.values():
-            if os.path.exists(path):
-                stats['total_size_mb'] += os.path.getsize(path) / (1024 * 1024)
+        latency = self.download_controller.download_times.get_stats()
+        for pct in (50, 90, 99):
+            stats[f'download_time_p{pct}_s'] = latency[f'p{pct}']
+        
+        for image in list(self.downloaded_images.values()) + list(self.thumbnails.values()):
+            if image_exists(image):
+                stats['total_size_mb'] += image_size(image) / (1024 * 1024)
         
         stats['total_size_mb'] = round(stats['total_size_mb'], 2)
         return stats
@@ -211,41 +918,32 @@ class ImageHandler:
         
         return '.jpg'  # default
     
-    def _validate_image(self, image_path: str) -> bool:
-        """Validate if file is a valid image"""
-        try:
-            with PILImage.open(image_path) as img:
-                img.verify()
-            return True
-        except Exception:
-            return False
+    def _validate_image(self, image_path: ImageRef) -> bool:
+        """Validate if file is a valid image (header probe, cached for later stages)"""
+        return probe_image(image_path) is not None
     
     def copy_to_output_dir(self, output_dir: str, prefix: str = "report_images") -> Dict[str, str]:
         """
-        Copy downloaded images to output directory
+        Export downloaded images to output directory
+        
+        Files are named after their contents, so exporting again skips images
+        already there, and are linked instead of copied where possible.
         
         Args:
             output_dir: Output directory path
-            prefix: Prefix for copied files
+            prefix: Prefix for exported files
             
         Returns:
-            Dict[str, str]: Mapping of original to copied paths
+            Dict[str, str]: Mapping of original to exported paths
         """
         copied_files = {}
         
         try:
-            os.makedirs(output_dir, exist_ok=True)
+            images = [image for image in self.downloaded_images.values() if image_exists(image)]
+            copied_files, methods = export_images(images, output_dir, prefix)
             
-            for i, (file_id, temp_path) in enumerate(self.downloaded_images.items()):
-                if os.path.exists(temp_path):
-                    ext = os.path.splitext(temp_path)[1]
-                    new_filename = f"{prefix}_{i+1}_{file_id[:8]}{ext}"
-                    new_path = os.path.join(output_dir, new_filename)
-                    
-                    shutil.copy2(temp_path, new_path)
-                    copied_files[temp_path] = new_path
-                    
-            logger.info(f"Copied {len(copied_files)} images to {output_dir}")
+            summary = ', '.join(f"{count} {method}" for method, count in sorted(methods.items()))
+            logger.info(f"Exported {len(copied_files)} images to {output_dir} ({summary or 'none'})")
             
         except Exception as e:
             logger.error(f"Error copying images: {e}")
@@ -0,0 +1,162 @@
+"""
+Image metadata probing for Heritage Report Generator
+
+Reads only the image header (dimensions, format, mode, EXIF orientation)
+and keeps the result in a process-wide cache, so the image handler, the
+image processor and the PDF builder never open the same file twice.
+"""
+
+import os
+import logging
+import threading
+from typing import Optional, Dict, Any, Tuple
+
+from PIL import Image as PILImage
+
+from image_buffers import SpooledImage, ImageRef, image_size, open_image_source
+
+logger = logging.getLogger(__name__)
+
+# EXIF tag holding the camera orientation
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def read_image_header(image_path: ImageRef) -> Dict[str, Any]:
+    """
+    Read image metadata from the file header without decoding pixel data
+
+    Args:
+        image_path: Path to image or spooled image
+
+    Returns:
+        Dict[str, Any]: Image metadata
+
+    Raises:
+        Exception: If the file is not a readable image
+    """
+    source = open_image_source(image_path)
+
+    try:
+        with PILImage.open(source) as img:
+            width, height = img.size
+            orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+            transparency = img.mode in ('RGBA', 'LA', 'PA') or (
+                img.mode == 'P' and 'transparency' in img.info
+            )
+
+            return {
+                'width': width,
+                'height': height,
+                'format': img.format,
+                'mode': img.mode,
+                'orientation': orientation,
+                'transparency': transparency,
+                'file_size': image_size(image_path)
+            }
+    finally:
+        if source is not image_path:
+            source.close()
+
+
+def display_size(metadata: Dict[str, Any]) -> Tuple[int, int]:
+    """
+    Get the size of an image after its EXIF orientation is applied
+
+    Args:
+        metadata: Metadata from probe_image
+
+    Returns:
+        Tuple[int, int]: Displayed width and height in pixels
+    """
+    if metadata['orientation'] in (5, 6, 7, 8):
+        return metadata['height'], metadata['width']
+    return metadata['width'], metadata['height']
+
+
+class ImageMetadataCache:
+    """Thread-safe cache of image header metadata, keyed by path"""
+
+    def __init__(self):
+        """Initialize metadata cache"""
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.probes = 0
+
+    def probe(self, image_path: ImageRef) -> Optional[Dict[str, Any]]:
+        """
+        Get metadata for an image, reading its header on first use
+
+        Args:
+            image_path: Path to image or spooled image
+
+        Returns:
+            Optional[Dict[str, Any]]: Image metadata or None if the file is not a valid image
+        """
+        signature = self._signature(image_path)
+        if signature is None:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(image_path)
+            if entry and entry[0] == signature:
+                return entry[1]
+
+        try:
+            metadata = read_image_header(image_path)
+        except Exception as e:
+            logger.debug(f"Could not read image header {image_path}: {e}")
+            metadata = None
+
+        with self.lock:
+            self.entries[image_path] = (signature, metadata)
+            self.probes += 1
+        return metadata
+
+    def put(self, image_path: ImageRef, metadata: Dict[str, Any]):
+        """
+        Record metadata for an image written by this process
+
+        Args:
+            image_path: Path to image
+            metadata: Image metadata
+        """
+        signature = self._signature(image_path)
+        if signature is None:
+            return
+
+        metadata = dict(metadata, file_size=signature[0])
+        with self.lock:
+            self.entries[image_path] = (signature, metadata)
+
+    def forget(self, image_path: ImageRef):
+        """Remove an image from the cache"""
+        with self.lock:
+            self.entries.pop(image_path, None)
+
+    def _signature(self, image_path: ImageRef) -> Optional[Tuple[int, int]]:
+        """Size and modification time used to detect changed files"""
+        if isinstance(image_path, SpooledImage):
+            # Spooled images are read-only once complete
+            return image_path.size, 0
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+
+# Shared by every handler, processor and builder in the process
+metadata_cache = ImageMetadataCache()
+
+
+def probe_image(image_path: ImageRef) -> Optional[Dict[str, Any]]:
+    """
+    Get cached header metadata for an image
+
+    Args:
+        image_path: Path to image or spooled image
+
+    Returns:
+        Optional[Dict[str, Any]]: Image metadata or None if the file is not a valid image
+    """
+    return metadata_cache.probe(image_path)
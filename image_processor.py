@@ -0,0 +1,664 @@
+"""
+Image preprocessing module for Heritage Report Generator
+
+Resamples images to the resolution they are actually drawn at in the PDF,
+so full-size phone photos are not embedded into 6x4 inch slots.
+"""
+
+import io
+import os
+import math
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Tuple, Optional, Union
+
+from PIL import Image as PILImage, ImageOps
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; isolated decodes then run without a hard cap
+    resource = None
+
+from constants import (IMAGE_TARGET_DPI, IMAGE_QUALITY, IMAGE_WORKERS, DECODE_MAX_MEMORY_MB,
+                       DECODE_ISOLATED_MAX_MEMORY_MB)
+from exceptions import ImageTooLargeError
+from image_cache import DerivativeCache, hash_image
+from image_metadata import probe_image, display_size, metadata_cache, EXIF_ORIENTATION_TAG
+from image_buffers import ImageRef, image_size, image_name, image_file_path, open_image_source
+
+logger = logging.getLogger(__name__)
+
+
+def select_output_format(metadata: Dict) -> str:
+    """
+    Choose the output format for an image from its header metadata
+
+    Args:
+        metadata: Metadata from probe_image
+
+    Returns:
+        str: 'png' for images with transparency, otherwise 'jpg'
+    """
+    return 'png' if metadata['transparency'] else 'jpg'
+
+
+# Modes that can be decoded a strip or tile at a time and reduced
+TILED_DECODE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+# Bits per pixel of uncompressed pixel layouts, for splitting them into strips
+RAW_MODE_BITS = {'L': 8, 'LA': 16, 'RGB': 24, 'BGR': 24, 'RGBA': 32, 'RGBX': 32, 'BGRA': 32, 'BGRX': 32,
+                 'CMYK': 32}
+
+
+def pixel_bytes(size: Tuple[int, int], mode: str) -> int:
+    """Get the memory Pillow uses for the pixels of an image"""
+    return size[0] * size[1] * (1 if mode in ('1', 'L', 'P') else 4)
+
+
+def decode_bounded(source: Union[str, io.IOBase], target_size: Tuple[int, int],
+                   max_memory_mb: float = DECODE_MAX_MEMORY_MB) -> PILImage.Image:
+    """
+    Decode an image at no less than a given size without exceeding a memory limit
+
+    JPEGs are decoded at a reduced scale (draft mode). Other images are decoded
+    in full when they fit under the limit; otherwise those stored in strips or
+    tiles are decoded one band at a time, each band reduced before the next
+    is read.
+
+    Args:
+        source: Path to image or an open stream
+        target_size: Smallest (width, height) needed, after orientation
+        max_memory_mb: Largest amount of decoded pixels held at once
+
+    Returns:
+        PILImage.Image: Loaded image, at least target_size where the original is (caller closes it)
+
+    Raises:
+        ImageTooLargeError: If the image cannot be decoded within the limit
+    """
+    max_bytes = int(max_memory_mb * 1024 * 1024)
+    img = PILImage.open(source)
+    try:
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        if orientation in (5, 6, 7, 8):
+            target_size = target_size[1], target_size[0]
+
+        img.draft(img.mode, target_size)
+        if pixel_bytes(img.size, img.mode) <= max_bytes:
+            img.load()
+            return img
+
+        width, height = img.size
+        factor = max(1, min(width // max(1, target_size[0]), height // max(1, target_size[1])))
+        tiles = img.tile
+        if len(tiles) == 1:
+            # Uncompressed images (BMP, PPM, plain TIFF) can be read in strips of any height
+            rows = max(factor, max_bytes // 4 // pixel_bytes((width, 1), img.mode) // factor * factor)
+            tiles = _split_raw_tile(tiles[0], rows) or tiles
+
+        if len(tiles) < 2 or orientation != 1 or img.mode not in TILED_DECODE_MODES:
+            raise ImageTooLargeError(f"{width}x{height} image needs more than {max_memory_mb:g} MB to decode")
+
+        reduced = _decode_bands(source, img.size, img.mode, tiles, factor, max_bytes)
+        img.close()
+        return reduced
+    except Exception:
+        img.close()
+        raise
+
+
+def _split_raw_tile(tile: Tuple, rows: int) -> Optional[List[Tuple]]:
+    """Split an uncompressed whole-image tile into strips of a number of rows, or None if not possible"""
+    codec, (x0, y0, x1, y1), offset, args = tile
+    if codec != 'raw' or (x0, y0) != (0, 0):
+        return None
+
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+    bits = RAW_MODE_BITS.get(rawmode)
+    if bits is None or ystep not in (1, -1):
+        return None
+
+    stride = stride or (x1 * bits + 7) // 8
+    strips = []
+    for top in range(0, y1, rows):
+        bottom = min(y1, top + rows)
+        # Bottom-up images store the last row first
+        first_row = top if ystep == 1 else y1 - bottom
+        strips.append(('raw', (0, top, x1, bottom), offset + first_row * stride, (rawmode, stride, ystep)))
+    return strips
+
+
+def _decode_bands(source: Union[str, io.IOBase], size: Tuple[int, int], mode: str, tiles: List[Tuple],
+                  factor: int, max_bytes: int) -> PILImage.Image:
+    """Decode an image band by band, reducing each band by an integer factor"""
+    width, height = size
+    if pixel_bytes((math.ceil(width / factor), math.ceil(height / factor)), mode) > max_bytes:
+        raise ImageTooLargeError(f"{width}x{height} image is too large even at 1/{factor} size")
+    output = PILImage.new(mode, (math.ceil(width / factor), math.ceil(height / factor)))
+
+    # Group rows of tiles into bands whose height is a multiple of the factor, so reduced bands line up
+    tile_rows = {}
+    for tile in tiles:
+        tile_rows.setdefault(tile[1][1], []).append(tile)
+
+    bands = []
+    band = []
+    for top in sorted(tile_rows):
+        band.extend(tile_rows[top])
+        bottom = max(tile[1][3] for tile in band)
+        if bottom % factor == 0 or bottom >= height:
+            bands.append(band)
+            band = []
+    if band:
+        bands.append(band)
+
+    for band in bands:
+        top = min(tile[1][1] for tile in band)
+        bottom = max(tile[1][3] for tile in band)
+        if pixel_bytes((width, bottom - top), mode) > max_bytes:
+            raise ImageTooLargeError(f"{width}x{height} image has tiles too large to decode")
+
+        canvas = PILImage.new(mode, (width, bottom - top))
+        for codec, (x0, y0, x1, y1), offset, args in band:
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            with PILImage.open(source) as part:
+                # Decode only this tile, as if it were the whole image
+                part._size = (x1 - x0, y1 - y0)
+                if hasattr(part, '_tile_size'):
+                    # TIFF allocates its pixel memory from this size
+                    part._tile_size = part._size
+                part.tile = [(codec, (0, 0, x1 - x0, y1 - y0), offset, args)]
+                part.load()
+                canvas.paste(part, (x0, y0 - top))
+
+        output.paste(canvas.reduce(factor) if factor > 1 else canvas, (0, top // factor))
+        canvas.close()
+
+    return output
+
+
+def decode_isolated(image: ImageRef, target_size: Tuple[int, int],
+                    max_memory_mb: float = DECODE_ISOLATED_MAX_MEMORY_MB) -> PILImage.Image:
+    """
+    Decode an image that decode_bounded cannot, in a separate process with a hard memory cap
+
+    The process decodes the image in full and reduces it by a whole factor, so
+    only about target_size pixels come back. Running out of memory ends that
+    process, not the report.
+
+    Args:
+        image: Image path or spooled image
+        target_size: Smallest (width, height) needed, after orientation
+        max_memory_mb: Memory the process may use in total
+
+    Returns:
+        PILImage.Image: Loaded image, at least target_size where the original is (caller closes it)
+
+    Raises:
+        ImageTooLargeError: If the image cannot be decoded under the cap either
+    """
+    source = image_file_path(image) or image.getvalue()
+    # A fresh interpreter, so the cap is not taken up by a copy of this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_limit_memory,
+                             initargs=(max_memory_mb,)) as pool:
+        try:
+            return pool.submit(_decode_reduced, source, target_size, max_memory_mb).result()
+        except MemoryError as e:
+            raise ImageTooLargeError(f"image needs more than {max_memory_mb:g} MB to decode") from e
+
+
+def _limit_memory(max_memory_mb: float):
+    """Cap the memory of the current process (runs in the isolated decoding process)"""
+    if resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        limit = int(max_memory_mb * 1024 * 1024)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+
+
+def _decode_reduced(source: Union[str, bytes], target_size: Tuple[int, int],
+                    max_memory_mb: float) -> PILImage.Image:
+    """Decode an image in full and reduce it by a whole factor to no less than target_size"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+
+    img = decode_bounded(source, target_size, max_memory_mb)
+    if img.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+        target_size = target_size[1], target_size[0]
+    factor = max(1, min(img.width // max(1, target_size[0]), img.height // max(1, target_size[1])))
+    if factor == 1:
+        return img
+
+    # reduce keeps the image's info, so its orientation is still applied by the caller
+    reduced = img.reduce(factor)
+    img.close()
+    return reduced
+
+
+def render_derivative(image_path: Union[str, bytes, io.IOBase, PILImage.Image], target_size: Tuple[int, int],
+                      image_format: str, quality: int, max_memory_mb: float = DECODE_MAX_MEMORY_MB) -> bytes:
+    """
+    Orient, resample and encode an image
+
+    Args:
+        image_path: Path to source image, its bytes, an open stream or an image decode_isolated returned
+        target_size: Output (width, height) in pixels after orientation
+        image_format: 'jpg' or 'png'
+        quality: JPEG quality (1-100)
+        max_memory_mb: Memory limit for decoding the source
+
+    Returns:
+        bytes: Encoded image without the source metadata
+
+    Raises:
+        ImageTooLargeError: If the source cannot be decoded within the limit
+    """
+    if isinstance(image_path, bytes):
+        image_path = io.BytesIO(image_path)
+
+    decoded = image_path if isinstance(image_path, PILImage.Image) else decode_bounded(image_path, target_size,
+                                                                                        max_memory_mb)
+    with decoded as img:
+        img = ImageOps.exif_transpose(img)
+        if img.size != target_size:
+            # Shrink by whole factors first, so the filter works on a much smaller image
+            img = img.resize(target_size, PILImage.Resampling.LANCZOS, reducing_gap=3.0)
+
+        buffer = io.BytesIO()
+        if image_format == 'png':
+            img.convert('RGBA').save(buffer, format='PNG', optimize=True)
+        else:
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(buffer, format='JPEG', quality=quality, optimize=True)
+
+    return buffer.getvalue()
+
+
+def calculate_target_size(image_size: Tuple[int, int], box_px: Tuple[int, int],
+                          fill: bool = False) -> Tuple[int, int]:
+    """
+    Calculate the pixel size an image should be resampled to
+
+    Args:
+        image_size: Current (width, height) in pixels
+        box_px: Target box (width, height) in pixels
+        fill: Cover the whole box instead of fitting inside it
+
+    Returns:
+        Tuple[int, int]: New width and height (never larger than the original)
+    """
+    width, height = image_size
+    box_width, box_height = box_px
+
+    scale_x = box_width / float(width)
+    scale_y = box_height / float(height)
+    scale = max(scale_x, scale_y) if fill else min(scale_x, scale_y)
+
+    if scale >= 1:
+        return width, height
+
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class ImageProcessor:
+    """Downsamples and re-encodes images for their slot in the PDF"""
+
+    def __init__(self, output_dir: str, dpi: int = IMAGE_TARGET_DPI, quality: int = IMAGE_QUALITY,
+                 cache: Optional[DerivativeCache] = None, workers: int = IMAGE_WORKERS,
+                 max_memory_mb: float = DECODE_MAX_MEMORY_MB):
+        """
+        Initialize image processor
+
+        Args:
+            output_dir: Directory for resampled images
+            dpi: Target resolution for embedded images
+            quality: JPEG quality used when re-encoding (1-100)
+            cache: Optional persistent cache of previously rendered derivatives
+            workers: Number of worker processes for rendering (0 uses all CPU cores)
+            max_memory_mb: Memory one image may use while it is decoded
+        """
+        self.output_dir = output_dir
+        self.dpi = dpi
+        self.quality = quality
+        self.cache = cache
+        self.workers = workers or os.cpu_count() or 1
+        self.max_memory_mb = max_memory_mb
+        self._pool = None
+        self.prepared_images = {}
+        self.content_hashes = {}
+        self.image_levels = {}
+        self.stats = {
+            'images_processed': 0,
+            'images_resampled': 0,
+            'original_bytes': 0,
+            'output_bytes': 0,
+            'images_decoded_separately': 0
+        }
+
+    def box_to_pixels(self, box_width: float, box_height: float, dpi: Optional[int] = None) -> Tuple[int, int]:
+        """Convert a box size in points to pixels at the target DPI"""
+        dpi = dpi or self.dpi
+        return (
+            int(math.ceil(box_width / 72.0 * dpi)),
+            int(math.ceil(box_height / 72.0 * dpi))
+        )
+
+    def set_image_level(self, image_path: ImageRef, dpi: int, quality: int):
+        """
+        Use a lower resolution or JPEG quality for one image (e.g. to meet a size budget)
+
+        Args:
+            image_path: Source image
+            dpi: Target resolution for this image
+            quality: JPEG quality for this image
+        """
+        self.image_levels[image_path] = (dpi, quality)
+
+    def get_image_level(self, image_path: ImageRef) -> Tuple[int, int]:
+        """Get the (dpi, quality) an image is prepared at"""
+        return self.image_levels.get(image_path, (self.dpi, self.quality))
+
+    def prepare_image(self, image_path: ImageRef, box_width: float, box_height: float,
+                      fill: bool = False) -> ImageRef:
+        """
+        Prepare an image for embedding in a box of the given size
+
+        Args:
+            image_path: Path to source image or spooled image
+            box_width: Width of the slot in points
+            box_height: Height of the slot in points
+            fill: Image is stretched over the whole box rather than fitted in it
+
+        Returns:
+            ImageRef: Image to embed (the original if no processing was needed or possible)
+        """
+        key = self._key(image_path, box_width, box_height, fill)
+
+        if key not in self.prepared_images:
+            self.prepare_batch([(image_path, box_width, box_height, fill)])
+
+        return self.prepared_images[key]
+
+    def prepare_batch(self, images: List[Tuple[str, float, float, bool]]):
+        """
+        Prepare several images at once, rendering them in parallel worker processes
+
+        Args:
+            images: List of (image_path, box_width, box_height, fill) tuples
+        """
+        pending = []
+        duplicates = []
+        rendering = {}
+        seen = set()
+
+        for image_path, box_width, box_height, fill in images:
+            key = self._key(image_path, box_width, box_height, fill)
+            if key in self.prepared_images or key in seen:
+                continue
+            seen.add(key)
+            _, box_px, _, quality = key
+
+            try:
+                output_path, job = self._plan(image_path, box_px, fill, quality)
+            except Exception as e:
+                logger.warning(f"Could not preprocess image {image_path}, embedding original: {e}")
+                output_path, job = image_path, None
+
+            if job is None:
+                self._store(key, image_path, output_path)
+                continue
+
+            # The same photo under another name or Drive ID is rendered only once
+            render_key = (self._content_hash(image_path), box_px, fill, quality)
+            if render_key in rendering:
+                duplicates.append((key, image_path, rendering[render_key]))
+            else:
+                rendering[render_key] = key
+                pending.append((key, job))
+
+        if not pending:
+            return
+
+        results = self._render_jobs([job for _, job in pending])
+
+        for (key, job), result in zip(pending, results):
+            image_path = job['image_path']
+            try:
+                if isinstance(result, ImageTooLargeError):
+                    logger.info(f"Decoding {image_name(image_path)} in a separate process: {result}")
+                    self.stats['images_decoded_separately'] += 1
+                    result = self._render_isolated(job)
+                if isinstance(result, Exception):
+                    raise result
+                output_path = self._finish(job, result)
+            except Exception as e:
+                logger.warning(f"Could not preprocess image {image_path}, embedding original: {e}")
+                output_path = image_path
+            self._store(key, image_path, output_path)
+
+        for key, image_path, rendered_key in duplicates:
+            output_path = self.prepared_images[rendered_key]
+            if output_path == rendered_key[0]:
+                # Rendering failed and the original is embedded, so embed this copy's original too
+                output_path = image_path
+            self._store(key, image_path, output_path)
+
+    def forget_images(self, images: List[ImageRef]):
+        """
+        Drop what is remembered about source images that will not be drawn again, and let
+        the cache evict their derivatives
+
+        Args:
+            images: Source images
+        """
+        images = set(images)
+        released = [self.prepared_images.pop(key) for key in list(self.prepared_images) if key[0] in images]
+        # A derivative shared with a duplicate that is still drawn stays pinned
+        in_use = set(self.prepared_images.values())
+        for output_path in released:
+            metadata_cache.forget(output_path)
+            if self.cache and output_path not in in_use:
+                self.cache.release(output_path)
+        for image_path in images:
+            self.content_hashes.pop(image_path, None)
+            self.image_levels.pop(image_path, None)
+            metadata_cache.forget(image_path)
+
+    def close(self):
+        """Shut down the worker pool"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get preprocessing statistics
+
+        Returns:
+            Dict[str, int]: Preprocessing statistics
+        """
+        stats = dict(self.stats)
+        stats['bytes_saved'] = stats['original_bytes'] - stats['output_bytes']
+        if self.cache:
+            stats['cache_hits'] = self.cache.hits
+            stats['cache_misses'] = self.cache.misses
+        return stats
+
+    def _key(self, image_path: ImageRef, box_width: float, box_height: float, fill: bool) -> Tuple:
+        """Key of a prepared image: source, box in pixels at the image's DPI, fill and quality"""
+        dpi, quality = self.get_image_level(image_path)
+        return image_path, self.box_to_pixels(box_width, box_height, dpi), fill, quality
+
+    def _plan(self, image_path: ImageRef, box_px: Tuple[int, int], fill: bool,
+              quality: int) -> Tuple[Optional[ImageRef], Optional[Dict]]:
+        """
+        Decide how an image must be prepared without decoding it
+
+        Returns:
+            Tuple: (output_path, None) if the image is ready, otherwise (None, render job)
+        """
+        metadata = probe_image(image_path)
+        if metadata is None:
+            raise ValueError("not a readable image")
+
+        orientation = metadata['orientation']
+        size = display_size(metadata)
+
+        target_size = calculate_target_size(size, box_px, fill)
+        image_format = select_output_format(metadata)
+
+        # Re-encoding at the same size only helps when a lower JPEG quality was requested
+        recompress = quality < self.quality and image_format == 'jpg'
+        if target_size == size and orientation == 1 and not recompress:
+            return image_path, None
+
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(
+                self._content_hash(image_path), box_px, fill, self.get_image_level(image_path)[0],
+                quality, image_format
+            )
+            cached_path = self.cache.get(cache_key)
+            if cached_path:
+                logger.debug(f"Using cached derivative for {image_name(image_path)}")
+                return cached_path, None
+
+        job = {
+            'image_path': image_path,
+            'size': size,
+            'target_size': target_size,
+            'image_format': image_format,
+            'orientation': orientation,
+            'mode': metadata['mode'],
+            'quality': quality,
+            'cache_key': cache_key
+        }
+        return None, job
+
+    def _render_jobs(self, jobs: List[Dict]) -> List:
+        """Render jobs in the worker pool, or inline when parallelism would not help"""
+        if len(jobs) < 2 or self.workers < 2:
+            return [self._render_inline(job) for job in jobs]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        try:
+            futures = [
+                self._pool.submit(
+                    render_derivative, self._worker_source(job['image_path']), job['target_size'],
+                    job['image_format'], job['quality'], self.max_memory_mb
+                )
+                for job in jobs
+            ]
+        except Exception as e:
+            logger.warning(f"Image worker pool unavailable, rendering on main thread: {e}")
+            self.close()
+            self.workers = 1
+            return [self._render_inline(job) for job in jobs]
+
+        results = []
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except BrokenProcessPool:
+                logger.warning("Image worker pool stopped, rendering on main thread")
+                self._pool = None
+                results.append(self._render_inline(job))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _render_inline(self, job: Dict):
+        """Render a job on the calling thread, returning the exception on failure"""
+        try:
+            source = open_image_source(job['image_path'])
+            try:
+                return render_derivative(source, job['target_size'], job['image_format'], job['quality'],
+                                         self.max_memory_mb)
+            finally:
+                if source is not job['image_path']:
+                    source.close()
+        except Exception as e:
+            return e
+
+    def _render_isolated(self, job: Dict):
+        """Render a job whose source is too large for the decoding limit, returning the exception on failure"""
+        try:
+            img = decode_isolated(job['image_path'], job['target_size'], DECODE_ISOLATED_MAX_MEMORY_MB)
+            return render_derivative(img, job['target_size'], job['image_format'], job['quality'])
+        except Exception as e:
+            return e
+
+    def _worker_source(self, image_path: ImageRef) -> Union[str, bytes]:
+        """Get something that can be sent to a worker process: a file path, or the bytes of an in-memory image"""
+        return image_file_path(image_path) or image_path.getvalue()
+
+    def _finish(self, job: Dict, data: bytes) -> ImageRef:
+        """Store rendered bytes and return the path to embed"""
+        image_path = job['image_path']
+
+        # A recompressed copy that is no smaller is not worth it, but a downsized one is always used
+        if job['image_format'] == 'jpg' and job['orientation'] == 1 and job['target_size'] == job['size'] \
+                and len(data) >= image_size(image_path):
+            return image_path
+
+        logger.debug(f"Resampled {image_name(image_path)} from {job['size']} to {job['target_size']}")
+
+        if self.cache:
+            output_path = self.cache.put(job['cache_key'], data)
+        else:
+            output_path = self._output_path(image_path, job['target_size'], job['quality'], job['image_format'])
+            with open(output_path, 'wb') as f:
+                f.write(data)
+
+        # The derivative's header is known, so the builder does not need to read it
+        if job['image_format'] == 'png':
+            image_format, mode = 'PNG', 'RGBA'
+        else:
+            image_format, mode = 'JPEG', 'L' if job['mode'] == 'L' else 'RGB'
+        metadata_cache.put(output_path, {
+            'width': job['target_size'][0],
+            'height': job['target_size'][1],
+            'format': image_format,
+            'mode': mode,
+            'orientation': 1,
+            'transparency': job['image_format'] == 'png'
+        })
+        return output_path
+
+    def _content_hash(self, image_path: ImageRef) -> str:
+        """Get the content hash of a source image, hashing each file only once"""
+        if image_path not in self.content_hashes:
+            self.content_hashes[image_path] = hash_image(image_path)
+        return self.content_hashes[image_path]
+
+    def _output_path(self, image_path: ImageRef, target_size: Tuple[int, int], quality: int, ext: str) -> str:
+        """Build the file name for a resampled image"""
+        source_name = image_file_path(image_path) or image_name(image_path)
+        digest = hashlib.md5(source_name.encode('utf-8')).hexdigest()[:12]
+        filename = f"resampled_{digest}_{target_size[0]}x{target_size[1]}_q{quality}.{ext}"
+        return os.path.join(self.output_dir, filename)
+
+    def _store(self, key: Tuple, image_path: ImageRef, output_path: ImageRef):
+        """Remember a prepared image and update statistics"""
+        self.prepared_images[key] = output_path
+        try:
+            original_size = image_size(image_path)
+            output_size = image_size(output_path)
+        except OSError:
+            return
+
+        self.stats['images_processed'] += 1
+        self.stats['original_bytes'] += original_size
+        self.stats['output_bytes'] += output_size
+        if output_path != image_path:
+            self.stats['images_resampled'] += 1
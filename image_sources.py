@@ -0,0 +1,240 @@
+"""
+Offline image sources for Heritage Report Generator
+
+Resolves Google Drive file IDs to files that are already on disk, such as
+a Google Takeout folder or a "download all files" ZIP, so the network is
+only used for images that are not available locally.
+
+A file is matched to a Drive file ID when:
+- its name (or name without extension) is the file ID, or contains it, e.g.
+  "IMG_2041_1BxiMVs0XRA5nFMdKvBdBZjgmUUqptlbs.jpg", or
+- a manifest.csv in the folder/archive maps it to an ID, using the
+  columns "id" and "name" (path relative to the manifest)
+"""
+
+import os
+import re
+import abc
+import csv
+import io
+import shutil
+import zipfile
+import logging
+import threading
+from typing import Optional, Dict, List
+
+from exceptions import ConfigurationError
+from constants import CHUNK_SIZE, SPOOL_IMAGES
+from image_buffers import SpooledImage, ImageRef
+
+logger = logging.getLogger(__name__)
+
+# Name of the optional ID-to-file manifest
+MANIFEST_FILENAME = 'manifest.csv'
+
+# Drive file IDs are long runs of URL-safe characters
+DRIVE_ID_TOKEN = re.compile(r'[A-Za-z0-9_-]{25,}')
+
+# Only files with these extensions are indexed
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff', '.heic')
+
+
+def file_id_candidates(name: str) -> List[str]:
+    """
+    Get the Drive file IDs a file name could stand for
+
+    Args:
+        name: File name without directories
+
+    Returns:
+        List[str]: Candidate file IDs
+    """
+    stem = os.path.splitext(name)[0]
+    candidates = [stem]
+
+    for token in DRIVE_ID_TOKEN.findall(stem):
+        candidates.append(token)
+        # IDs may contain '_' and '-', so also try the parts around those separators
+        for i, char in enumerate(token):
+            if char in '_-':
+                candidates.extend(part for part in (token[:i], token[i+1:]) if len(part) >= 25)
+
+    return list(dict.fromkeys(candidates))
+
+
+class ImageSource(abc.ABC):
+    """Base class for local image sources"""
+
+    def __init__(self, path: str):
+        """
+        Initialize image source
+
+        Args:
+            path: Location of the source
+        """
+        self.path = path
+        self.index = None
+        self.index_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def build_index(self) -> Dict[str, str]:
+        """Build the file ID to entry index"""
+
+    def contains(self, file_id: str) -> bool:
+        """Check whether the source has a file for a Drive file ID"""
+        with self.index_lock:
+            if self.index is None:
+                self.index = self.build_index()
+                logger.info(f"Indexed {len(self.index)} images in {self.path}")
+        return file_id in self.index
+
+    @abc.abstractmethod
+    def fetch(self, file_id: str, dest_dir: str) -> Optional[ImageRef]:
+        """
+        Get a local image for a Drive file ID
+
+        Args:
+            file_id: Google Drive file ID
+            dest_dir: Directory to place extracted files in
+
+        Returns:
+            Optional[ImageRef]: Path to the image, a spooled image, or None if the source does not have it
+        """
+
+    def close(self):
+        """Release resources held by the source"""
+        pass
+
+    def _add_entry(self, index: Dict[str, str], name: str, entry: str):
+        """Add every ID a file name could stand for, keeping the first match"""
+        for candidate in file_id_candidates(name):
+            index.setdefault(candidate, entry)
+
+
+class LocalMirrorSource(ImageSource):
+    """Images in a local directory tree (e.g. an extracted Google Takeout)"""
+
+    def build_index(self) -> Dict[str, str]:
+        index = {}
+        manifest_path = None
+
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if name == MANIFEST_FILENAME and manifest_path is None:
+                    manifest_path = os.path.join(root, name)
+                elif name.lower().endswith(IMAGE_EXTENSIONS):
+                    self._add_entry(index, name, os.path.join(root, name))
+
+        if manifest_path:
+            base = os.path.dirname(manifest_path)
+            with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+                for row in csv.DictReader(f):
+                    file_id, name = row.get('id', '').strip(), row.get('name', '').strip()
+                    if file_id and name:
+                        index[file_id] = os.path.join(base, name)
+
+        return index
+
+    def fetch(self, file_id: str, dest_dir: str) -> Optional[str]:
+        if not self.contains(file_id):
+            return None
+
+        path = self.index[file_id]
+        return path if os.path.isfile(path) else None
+
+
+class ZipArchiveSource(ImageSource):
+    """Images inside a ZIP archive, read member by member without extracting the archive"""
+
+    def __init__(self, path: str, spool: bool = SPOOL_IMAGES):
+        super().__init__(path)
+        self.spool = spool
+        self.archive = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def build_index(self) -> Dict[str, str]:
+        index = {}
+        manifest_member = None
+
+        # Only the central directory is read here; member data is read on demand
+        with self.lock:
+            if self.archive is None:
+                self.archive = zipfile.ZipFile(self.path)
+            members = self.archive.infolist()
+
+        for info in members:
+            if info.is_dir():
+                continue
+            name = info.filename.rsplit('/', 1)[-1]
+            if name == MANIFEST_FILENAME and manifest_member is None:
+                manifest_member = info.filename
+            elif name.lower().endswith(IMAGE_EXTENSIONS):
+                self._add_entry(index, name, info.filename)
+
+        if manifest_member:
+            base = manifest_member.rsplit('/', 1)[0] + '/' if '/' in manifest_member else ''
+            with self.lock:
+                data = self.archive.read(manifest_member)
+            for row in csv.DictReader(io.StringIO(data.decode('utf-8-sig'))):
+                file_id, name = row.get('id', '').strip(), row.get('name', '').strip()
+                if file_id and name:
+                    index[file_id] = base + name
+
+        return index
+
+    def fetch(self, file_id: str, dest_dir: str) -> Optional[ImageRef]:
+        # Indexing would open the archive again and nothing would close it
+        if self.closed or not self.contains(file_id):
+            return None
+
+        member = self.index[file_id]
+        ext = os.path.splitext(member)[1].lower() or '.jpg'
+        dest_path = os.path.join(dest_dir, f"offline_{file_id}{ext}")
+
+        try:
+            with self.lock:
+                if self.archive is None:
+                    logger.debug(f"Not reading {file_id}, {self.path} is closed")
+                    return None
+                with self.archive.open(member) as src:
+                    if not self.spool:
+                        with open(dest_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        return dest_path
+
+                    image = SpooledImage(os.path.basename(dest_path), dest_dir)
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        image.write(chunk)
+                    image.finish()
+                    return image
+        except KeyError:
+            logger.warning(f"Member listed in manifest not found in {self.path}: {member}")
+            return None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+
+def create_image_source(path: str) -> ImageSource:
+    """
+    Create an image source for a directory or ZIP archive
+
+    Args:
+        path: Directory or .zip file
+
+    Returns:
+        ImageSource: Source for the path
+
+    Raises:
+        ConfigurationError: If the path is neither a directory nor a ZIP archive
+    """
+    if os.path.isdir(path):
+        return LocalMirrorSource(path)
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        return ZipArchiveSource(path)
+    raise ConfigurationError(f"Image source must be a folder or ZIP archive: {path}")
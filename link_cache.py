@@ -0,0 +1,151 @@
+"""
+Failed link cache for Heritage Report Generator
+
+Remembers Google Drive file IDs that could not be downloaded for a reason
+that will not go away by retrying (deleted file, revoked sharing, a link to
+something that is not an image), so later runs skip them instead of waiting
+on retries and timeouts. Entries expire after a TTL and can be ignored for
+one run to check every link again. Runs sharing the file merge their changes
+into it under a file lock, so none of them loses the others' failures.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from typing import Optional, Dict, Any
+
+from constants import FAILED_LINK_TTL_HOURS
+from shared_cache import FileLock
+from utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class FailedLinkCache:
+    """Persistent record of file IDs that failed permanently, with the reason"""
+
+    def __init__(self, cache_path: str, ttl_hours: float = FAILED_LINK_TTL_HOURS, refresh: bool = False):
+        """
+        Initialize failed link cache
+
+        Args:
+            cache_path: JSON file holding the entries
+            ttl_hours: Hours after which a failed link is tried again
+            refresh: Ignore existing entries for this run and try every link again
+        """
+        self.cache_path = cache_path
+        self.ttl = ttl_hours * 3600
+        self.refresh = refresh
+        self.entries = {}
+        # Changes not written yet: an entry, or None for a forgotten link
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+
+        self._load()
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a failed link
+
+        Args:
+            file_id: Google Drive file ID
+
+        Returns:
+            Optional[Dict[str, Any]]: Entry with 'reason' and 'failed_at', or None if the link should be tried
+        """
+        entry = self.peek(file_id)
+        if entry is not None:
+            with self.lock:
+                self.hits += 1
+        return entry
+
+    def peek(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """Look up a failed link without counting it as skipped"""
+        if self.refresh:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(file_id)
+            if entry is None or time.time() - entry['failed_at'] > self.ttl:
+                return None
+            return entry
+
+    def record(self, file_id: str, reason: str):
+        """
+        Record a permanent failure
+
+        Args:
+            file_id: Google Drive file ID
+            reason: Why the link failed, shown in the report and logs
+        """
+        with self.lock:
+            self.entries[file_id] = {'reason': reason, 'failed_at': time.time()}
+            self.changes[file_id] = self.entries[file_id]
+            self._save()
+
+    def forget(self, file_id: str):
+        """Remove a link that has been downloaded successfully"""
+        with self.lock:
+            if self.entries.pop(file_id, None) is not None:
+                self.changes[file_id] = None
+                self._save()
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get cache statistics
+
+        Returns:
+            Dict[str, int]: Number of entries and links skipped this run
+        """
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits}
+
+    def _load(self):
+        """Read entries from disk"""
+        self.entries = self._read()
+        logger.debug(f"Loaded {len(self.entries)} failed links from {self.cache_path}")
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        """Read the entries on disk, dropping expired ones"""
+        if not os.path.exists(self.cache_path):
+            return {}
+
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read failed link cache {self.cache_path}: {e}")
+            return {}
+
+        now = time.time()
+        return {
+            file_id: entry for file_id, entry in entries.items()
+            if isinstance(entry, dict) and now - entry.get('failed_at', 0) <= self.ttl
+        }
+
+    def _save(self):
+        """Merge this run's changes into the entries on disk; the caller holds the lock"""
+        cache_dir = os.path.dirname(self.cache_path) or '.'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+
+            # Other runs may have written since this one loaded, so apply the changes to what is there now
+            with FileLock(self.cache_path + '.lock'):
+                entries = self._read()
+                for file_id, entry in self.changes.items():
+                    if entry is None:
+                        entries.pop(file_id, None)
+                    else:
+                        entries[file_id] = entry
+
+                with atomic_write(self.cache_path) as tmp_path:
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        json.dump(entries, f, indent=1)
+
+            self.entries = entries
+            self.changes = {}
+        except OSError as e:
+            logger.warning(f"Could not save failed link cache {self.cache_path}: {e}")
@@ -0,0 +1,125 @@
+"""
+Image link index for Heritage Report Generator
+
+Reads the image columns of every row once and records each Google Drive
+file ID with the rows and slots that reference it. Batch work (cache
+warming, prefetching, deduplication) plans its downloads from this table
+instead of parsing the same cells again for each row.
+"""
+
+import logging
+from typing import Dict, List, Tuple, Iterable, Optional
+
+from constants import PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD
+from utils import match_drive_file_id
+
+logger = logging.getLogger(__name__)
+
+# (row index, field name, position of the link within the field)
+LinkSlot = Tuple[int, str, int]
+
+
+class LinkIndex:
+    """File IDs referenced by a dataset's image columns, with where each one is used"""
+
+    def __init__(self, rows: Iterable[Dict[str, str]],
+                 fields: Tuple[str, ...] = (PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD)):
+        """
+        Build the index in one pass over the rows
+
+        Args:
+            rows: CSV rows
+            fields: Columns holding comma-separated image links
+        """
+        self.fields = fields
+        self.links = {}
+        self.slots = {}
+        self.unparsed = []
+        self.row_count = 0
+
+        for row_index, row in enumerate(rows):
+            self.row_count += 1
+            for field in fields:
+                value = row.get(field)
+                if not value:
+                    continue
+                position = 0
+                for link in str(value).split(','):
+                    link = link.strip()
+                    if not link:
+                        continue
+                    file_id = match_drive_file_id(link)
+                    if file_id is None:
+                        self.unparsed.append((row_index, field, link))
+                    else:
+                        self.links.setdefault(file_id, link)
+                        self.slots.setdefault(file_id, []).append((row_index, field, position))
+                    position += 1
+
+        if self.unparsed:
+            logger.warning(f"Could not extract a file ID from {len(self.unparsed)} links, "
+                           f"e.g. {self.unparsed[0][2]}")
+        logger.debug(f"Indexed {len(self.links)} files referenced {self.reference_count()} times "
+                     f"in {self.row_count} rows")
+
+    def __len__(self) -> int:
+        return len(self.links)
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self.links
+
+    def file_ids(self) -> List[str]:
+        """Get all file IDs, in order of first appearance"""
+        return list(self.links)
+
+    def slots_for(self, file_id: str) -> List[LinkSlot]:
+        """
+        Get the places a file is referenced from
+
+        Args:
+            file_id: Google Drive file ID
+
+        Returns:
+            List[LinkSlot]: (row index, field, position) for each reference
+        """
+        return list(self.slots.get(file_id, []))
+
+    def rows_for(self, file_id: str) -> List[int]:
+        """Get the indices of the rows referencing a file, without duplicates"""
+        return sorted({row_index for row_index, _, _ in self.slots.get(file_id, [])})
+
+    def links_for_row(self, row_index: int, field: Optional[str] = None) -> Dict[str, str]:
+        """
+        Get the files referenced by one row
+
+        Args:
+            row_index: Row index
+            field: Only this column, or all image columns if None
+
+        Returns:
+            Dict[str, str]: Link for each file ID, in the row's order
+        """
+        found = []
+        for file_id, slots in self.slots.items():
+            for slot_row, slot_field, position in slots:
+                if slot_row == row_index and (field is None or slot_field == field):
+                    found.append((self.fields.index(slot_field), position, file_id))
+        return {file_id: self.links[file_id] for _, _, file_id in sorted(found)}
+
+    def reference_count(self) -> int:
+        """Get the number of links, counting repeated references to a file"""
+        return sum(len(slots) for slots in self.slots.values())
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get index statistics
+
+        Returns:
+            Dict[str, int]: Rows, distinct files, references and links without a file ID
+        """
+        return {
+            'rows': self.row_count,
+            'files': len(self.links),
+            'references': self.reference_count(),
+            'unparsed': len(self.unparsed)
+        }
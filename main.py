@@ -8,9 +8,12 @@ import sys
 import os
 import argparse
 import logging
+import multiprocessing
 from datetime import datetime
 
 from report_generator import ReportGenerator
+from cache_warmer import CacheWarmer
+from constants import SHARED_IMAGE_CACHE_DIR, IMAGE_CACHE_DIR
 from utils import validate_csv_path, generate_output_filename, setup_logging
 from exceptions import ReportGeneratorError
 
@@ -28,12 +31,94 @@ def print_banner():
     print()
 
 
+def warm_cache(argv):
+    """Download every image referenced by a CSV into the shared cache, without building a report"""
+    parser = argparse.ArgumentParser(
+        prog='main.exe warm-cache',
+        description='Download all images linked from a CSV into the image cache, so reports can '
+                    'later be built quickly or offline. Run it again to resume after an interruption.'
+    )
+    parser.add_argument('csv_file', help='Path to CSV file containing assessment data')
+    parser.add_argument(
+        '--cache-dir',
+        default=SHARED_IMAGE_CACHE_DIR or os.path.join(IMAGE_CACHE_DIR, 'images'),
+        help='Cache folder to fill (default: SHARED_IMAGE_CACHE_DIR, or "images" in the cache folder)'
+    )
+    parser.add_argument('--image-source', action='append', default=[], metavar='PATH',
+                        help='Folder or ZIP archive with already downloaded images')
+    parser.add_argument('--max-bandwidth', type=float, metavar='KBPS',
+                        help='Limit the total download speed to this many KB per second')
+    parser.add_argument('--refresh-links', action='store_true',
+                        help='Try links that failed on earlier runs again instead of skipping them')
+    parser.add_argument('-l', '--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='WARNING',
+                        help='Set logging level (default: WARNING)')
+    parser.add_argument('--log-file', help='Save logs to file')
+    args = parser.parse_args(argv)
+    
+    setup_logging(args.log_file, args.log_level)
+    logger = logging.getLogger(__name__)
+    print_banner()
+    
+    if not validate_csv_path(args.csv_file):
+        print(f"Error: Invalid CSV file: {args.csv_file}")
+        sys.exit(1)
+    
+    def show_progress(done, total, file_id, ok):
+        status = '' if ok else f" (failed: {file_id})"
+        print(f"\r  {done}/{total} images cached{status:<50}", end='', flush=True)
+    
+    warmer = None
+    try:
+        print(f"Caching images from: {os.path.basename(args.csv_file)}")
+        print(f"Cache folder: {args.cache_dir}\n")
+        
+        warmer = CacheWarmer(args.csv_file, args.cache_dir, image_sources=args.image_source,
+                             bandwidth_kbps=args.max_bandwidth, refresh_links=args.refresh_links)
+        stats = warmer.warm(on_progress=show_progress)
+        
+        print("\n\n" + "=" * 60)
+        print(f"  - Images Referenced: {stats['total']}")
+        print(f"  - Already Cached: {stats['already_cached']}")
+        print(f"  - Downloaded: {stats['downloaded']}")
+        if stats['copied']:
+            print(f"  - Copied From Image Sources: {stats['copied']}")
+        print(f"  - Failed: {stats['failed']}")
+        print("=" * 60)
+        if args.cache_dir != SHARED_IMAGE_CACHE_DIR:
+            print(f'\nUse --shared-cache "{args.cache_dir}" when generating reports to use these images.')
+        
+    except KeyboardInterrupt:
+        print("\n\nInterrupted; run the same command again to continue")
+        
+    except ReportGeneratorError as e:
+        logger.error(f"Cache warming error: {e}")
+        print(f"\n❌ Error: {e}")
+        sys.exit(1)
+        
+    except Exception as e:
+        logger.exception("Unexpected error occurred")
+        print(f"\n❌ Unexpected error: {e}")
+        print("\nPlease report this error with the log file if available")
+        sys.exit(1)
+        
+    finally:
+        if warmer:
+            warmer.cleanup()
+
+
 def main():
     """Main program entry point"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm-cache':
+        warm_cache(sys.argv[2:])
+        return
+    
     # Parse command line arguments
     parser = argparse.ArgumentParser(
         description=PROGRAM_NAME,
-        formatter_class=argparse.RawDescriptionHelpFormatter
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='Commands:\n'
+               '  warm-cache CSV   Download all images of a CSV into the cache without building a report\n'
+               '                   (see: main.exe warm-cache --help)'
     )
     
     parser.add_argument(
@@ -64,6 +149,47 @@ def main():
         help='Export downloaded images to specified directory'
     )
     
+    parser.add_argument(
+        '--image-source',
+        action='append',
+        default=[],
+        metavar='PATH',
+        help='Folder or ZIP archive with already downloaded images '
+             '(e.g. Google Takeout); can be given more than once'
+    )
+    
+    parser.add_argument(
+        '--max-size',
+        type=float,
+        metavar='MB',
+        help='Reduce image resolution and quality so the PDF stays under this size'
+    )
+    
+    parser.add_argument(
+        '--max-bandwidth',
+        type=float,
+        metavar='KBPS',
+        help='Limit the total download speed to this many KB per second'
+    )
+    
+    parser.add_argument(
+        '--refresh-links',
+        action='store_true',
+        help='Try links that failed on earlier runs again instead of skipping them'
+    )
+    
+    parser.add_argument(
+        '--shared-cache',
+        metavar='DIR',
+        help='Folder shared with other running copies so each image is downloaded only once'
+    )
+    
+    parser.add_argument(
+        '--all-entries',
+        action='store_true',
+        help='Put every assessment in the CSV into one PDF instead of only the latest'
+    )
+    
     parser.add_argument(
         '-v', '--version',
         action='version',
@@ -71,6 +197,9 @@ def main():
     )
     
     args = parser.parse_args()
+    if args.all_entries and args.export_images:
+        # Each entry's images are released once its pages are written
+        parser.error('--export-images cannot be combined with --all-entries')
     
     # If no CSV file provided, show usage
     if not args.csv_file:
@@ -107,13 +236,21 @@ def main():
         print("\nPhase 1: Loading data...")
         
         # Create report generator
-        generator = ReportGenerator(csv_path)
+        generator = ReportGenerator(csv_path, image_sources=args.image_source, size_budget_mb=args.max_size,
+                                    bandwidth_kbps=args.max_bandwidth, refresh_links=args.refresh_links,
+                                    thumbnails=False if args.export_images else None,
+                                    shared_cache_dir=args.shared_cache)
         
+        if args.image_source:
+            print(f"Using offline image sources: {', '.join(args.image_source)}")
         print("Phase 2: Downloading images from Google Drive...")
         print("(This may take a while depending on internet speed)\n")
         
         # Generate report
-        stats = generator.generate_report(output_path)
+        if args.all_entries:
+            stats = generator.generate_compendium(output_path)
+        else:
+            stats = generator.generate_report(output_path)
         
         # Export images if requested
         if args.export_images:
@@ -128,10 +265,49 @@ def main():
         print(f"File size: {os.path.getsize(output_path) / (1024*1024):.2f} MB")
         print()
         print("Report Details:")
-        print(f"  - Monument: {stats['monument_name']}")
-        print(f"  - Assessment Date: {stats['assessment_date']}")
+        if 'entries' in stats:
+            print(f"  - Assessments: {stats['entries']}")
+        else:
+            print(f"  - Monument: {stats['monument_name']}")
+            print(f"  - Assessment Date: {stats['assessment_date']}")
         print(f"  - Images Downloaded: {stats['total_images']}")
         print(f"  - Image Data Size: {stats['total_image_size_mb']} MB")
+        if stats['bandwidth_limit_kbps']:
+            print(f"  - Download Speed: {stats['download_throughput_kbps']:.0f} KB/s "
+                  f"(limit {stats['bandwidth_limit_kbps']:.0f} KB/s, {stats['bandwidth_wait_s']:.1f}s waited)")
+        elif stats['download_throughput_kbps']:
+            print(f"  - Download Speed: {stats['download_throughput_kbps']:.0f} KB/s")
+        if stats['download_time_p50_s'] is not None:
+            print(f"  - Download Time per Image: {stats['download_time_p50_s']}s median, "
+                  f"{stats['download_time_p90_s']}s p90, {stats['download_time_p99_s']}s p99")
+        if stats['hedged_requests']:
+            print(f"  - Slow Requests Sent Twice: {stats['hedged_requests']} "
+                  f"({stats['hedge_wins']} answered faster the second time)")
+        if stats['stalled_transfers']:
+            print(f"  - Stalled Transfers Restarted: {stats['stalled_transfers']}")
+        if stats['unavailable_images']:
+            print(f"  - Images Unavailable: {stats['unavailable_images']} "
+                  f"({stats['skipped_failed_links']} skipped after failing on an earlier run)")
+        if stats['shared_cache_hits']:
+            print(f"  - Images From Shared Cache: {stats['shared_cache_hits']}")
+        if stats['thumbnails']:
+            print(f"  - Downloaded as Thumbnails: {stats['thumbnails']}")
+        if stats['skipped_non_images']:
+            print(f"  - Links Skipped (not images): {stats['skipped_non_images']}")
+        print(f"  - Images Resampled: {stats['images_resampled']} "
+              f"({stats['image_bytes_saved'] / (1024*1024):.2f} MB saved)")
+        if stats['images_decoded_separately']:
+            print(f"  - Large Images Decoded Separately: {stats['images_decoded_separately']}")
+        if stats['duplicate_images']:
+            print(f"  - Duplicate Images Embedded Once: {stats['duplicate_images']}")
+        if stats['contact_sheets']:
+            print(f"  - Contact Sheets: {stats['contact_sheets']}")
+        if stats['size_budget']:
+            budget = stats['size_budget']
+            reduced = sum(1 for image in budget['images'] if image['reduced'])
+            print(f"  - Size Budget: {budget['achieved_mb']} of {budget['budget_mb']} MB"
+                  f"{'' if budget['within_budget'] else ' (could not fit)'}, "
+                  f"{reduced} image(s) reduced")
         print("=" * 60)
         
     except ReportGeneratorError as e:
@@ -163,4 +339,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Required for image worker processes in the frozen executable
+    multiprocessing.freeze_support()
     main()
@@ -3,97 +3,143 @@ PDF building module for Heritage Report Generator
 Enhanced with two-column layout for better space utilization
 """
 
+import io
 import os
+import copy
+import math
 import logging
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import (SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image, KeepTogether,
+                                PageBreak, Flowable)
 from reportlab.lib.units import inch
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 
 from constants import *
 from utils import safe_str, format_date
 from exceptions import PDFGenerationError
+from image_processor import ImageProcessor
+from image_metadata import probe_image
+from image_buffers import ImageRef, image_exists, image_name, image_file_path, open_image_source
+from image_cache import hash_image
+from contact_sheet import render_contact_sheet, LABEL_HEIGHT
+from report_styles import get_styles
 
 logger = logging.getLogger(__name__)
 
+# Distinct images remembered for reuse, across all entries of a streamed build
+EMBEDDED_IMAGE_MEMO = 512
+
+
+def use_contact_sheets(additional_images: List[ImageRef]) -> bool:
+    """Check whether additional images are shown on contact sheets instead of a grid"""
+    return bool(CONTACT_SHEET_THRESHOLD) and len(additional_images) > CONTACT_SHEET_THRESHOLD
+
+
+def contact_sheet_cell() -> Tuple[float, float]:
+    """Get the (width, height) in points of one contact sheet cell, including its number"""
+    cell_width = (PAGE_SIZE[0] - LEFT_MARGIN - RIGHT_MARGIN) / CONTACT_SHEET_COLUMNS
+    # 4:3 thumbnails with a number strip below each
+    return cell_width, cell_width * 0.75 / (1 - LABEL_HEIGHT)
+
+
+def additional_image_box(additional_images: List) -> Tuple[float, float, bool]:
+    """
+    Get the box each additional image is drawn in
+
+    Args:
+        additional_images: Additional images or their links
+
+    Returns:
+        Tuple[float, float, bool]: Width and height in points, and whether the image fills the box
+    """
+    if use_contact_sheets(additional_images):
+        return contact_sheet_cell() + (False,)
+    return ADDITIONAL_IMAGE_WIDTH*inch, ADDITIONAL_IMAGE_HEIGHT*inch, True
+
+
+def image_slots(primary_images: List[ImageRef], additional_images: List[ImageRef]) -> List[Tuple]:
+    """
+    Get the boxes the images section draws images into
+
+    Args:
+        primary_images: Primary images (only the first is shown)
+        additional_images: Additional images
+
+    Returns:
+        List[Tuple]: (image, box_width, box_height, fill) for each drawn image
+    """
+    slots = [(path, PRIMARY_IMAGE_MAX_WIDTH*inch, PRIMARY_IMAGE_MAX_HEIGHT*inch, False)
+             for path in primary_images[:1] if image_exists(path)]
+    if not use_contact_sheets(additional_images):
+        slots += [(path, ADDITIONAL_IMAGE_WIDTH*inch, ADDITIONAL_IMAGE_HEIGHT*inch, True)
+                  for path in additional_images if image_exists(path)]
+    return slots
+
+
+class FlowableStream(list):
+    """
+    Flowable list for doc.build() that is filled one entry at a time
+
+    reportlab lays out flowables from the front of the list it is given and
+    removes each one once it is drawn. This list asks for the next entry only
+    when it runs empty, so only the entry being laid out is held in memory.
+    """
+
+    def __init__(self, entries: Iterator[List[Flowable]]):
+        """
+        Initialize flowable stream
+
+        Args:
+            entries: Iterator giving the flowables of one entry at a time
+        """
+        super().__init__()
+        self.entries = entries
+        self.exhausted = False
+
+    def __len__(self) -> int:
+        # reportlab checks the length before taking the next flowable
+        while not super().__len__() and not self.exhausted:
+            try:
+                self.extend(next(self.entries))
+            except StopIteration:
+                self.exhausted = True
+        return super().__len__()
+
 
 class PDFBuilder:
     """Handles PDF generation with two-column layout"""
 
-    def __init__(self, output_path: str):
+    def __init__(self, output_path: str, image_processor: Optional[ImageProcessor] = None):
         """
         Initialize PDF builder
 
         Args:
             output_path: Path for output PDF
+            image_processor: Optional processor that resamples images to their drawn size
         """
         self.output_path = output_path
-        self.styles = getSampleStyleSheet()
-        self.setup_custom_styles()
+        self.image_processor = image_processor
+        self.styles = get_styles()
         self.story = []
 
-    def setup_custom_styles(self):
-        """Setup custom paragraph styles for the report"""
-        # Try to register font with better Unicode support
-        arabic_font = DEFAULT_FONT
-        try:
-            if os.path.exists(ARABIC_FONT_PATH):
-                pdfmetrics.registerFont(TTFont(ARABIC_FONT_NAME, ARABIC_FONT_PATH))
-                arabic_font = ARABIC_FONT_NAME
-                logger.info(f"Registered font: {ARABIC_FONT_NAME}")
-        except Exception as e:
-            logger.warning(f"Could not register Arabic font: {e}")
-
-        # Section title style
-        self.styles.add(ParagraphStyle(
-            name='SectionTitle',
-            parent=self.styles['Heading1'],
-            fontSize=SECTION_TITLE_SIZE,
-            textColor=colors.HexColor(SECTION_TITLE_COLOR),
-            spaceAfter=12,
-            spaceBefore=12,
-            alignment=TA_LEFT
-        ))
-
-        # Field label style (for two-column layout)
-        self.styles.add(ParagraphStyle(
-            name='FieldLabel',
-            parent=self.styles['Normal'],
-            fontSize=FIELD_LABEL_SIZE,
-            textColor=colors.HexColor(FIELD_LABEL_COLOR),
-            fontName=BOLD_FONT,
-            spaceAfter=2,
-            alignment=TA_LEFT
-        ))
-
-        # Field value style (for two-column layout)
-        self.styles.add(ParagraphStyle(
-            name='FieldValue',
-            parent=self.styles['Normal'],
-            fontSize=FIELD_VALUE_SIZE,
-            textColor=colors.HexColor(FIELD_VALUE_COLOR),
-            spaceAfter=6,
-            fontName=arabic_font,
-            alignment=TA_LEFT
-        ))
-
-        # Compact field style for two-column layout
-        self.styles.add(ParagraphStyle(
-            name='CompactField',
-            parent=self.styles['Normal'],
-            fontSize=FIELD_VALUE_SIZE - 1,
-            textColor=colors.HexColor(FIELD_VALUE_COLOR),
-            spaceAfter=4,
-            fontName=arabic_font,
-            leftIndent=0,
-            alignment=TA_LEFT
-        ))
+        # Content hash -> (first image flowable, its source), shared by every copy of that image;
+        # least recently used first
+        self.embedded_images = OrderedDict()
+        self.image_hashes = OrderedDict()
+
+        # Streams opened for in-memory images, closed once the PDF is written
+        self.open_sources = []
+        self.stats = {
+            'images_embedded': 0,
+            'duplicate_images': 0,
+            'contact_sheets': 0,
+            'entries': 0
+        }
 
     def add_header_with_logos(self, csv_dir: str):
         """Add header with logos to the report"""
@@ -150,6 +196,10 @@ class PDFBuilder:
         self.story.append(title)
         self.story.append(Spacer(1, 0.2*inch))
 
+    def add_page_break(self):
+        """Start a new page"""
+        self.story.append(PageBreak())
+
     def add_section(self, title: str, fields_dict: Dict[str, str]):
         """
         Add a section with title and field-value pairs in two-column layout
@@ -239,13 +289,15 @@ class PDFBuilder:
 
         return Paragraph(cell_content, self.styles['CompactField'])
 
-    def add_images_section(self, primary_images: List[str], additional_images: List[str]):
+    def add_images_section(self, primary_images: List[ImageRef], additional_images: List[ImageRef],
+                           unavailable_images: Optional[List[Dict[str, str]]] = None):
         """
         Add images section to the report
 
         Args:
             primary_images: List of primary image paths
             additional_images: List of additional image paths
+            unavailable_images: Links that could not be fetched, each with 'link' and 'reason'
         """
         # Add section title
         self.story.append(Paragraph("7. Documentation and Evidence", self.styles['SectionTitle']))
@@ -253,6 +305,10 @@ class PDFBuilder:
 
         # Add any text documentation first (if this section has text fields)
 
+        # Render all images up front so they can be resampled in parallel
+        if self.image_processor:
+            self.image_processor.prepare_batch(image_slots(primary_images, additional_images))
+
         # Add primary images
         if primary_images:
             self.story.append(Paragraph("<b>Primary Display Photo:</b>", self.styles['FieldLabel']))
@@ -266,13 +322,24 @@ class PDFBuilder:
         # Add additional images
         if additional_images:
             self.story.append(Paragraph("<b>Additional Images:</b>", self.styles['FieldLabel']))
-            self._add_image_grid(
-                additional_images,
-                ADDITIONAL_IMAGE_WIDTH*inch,
-                ADDITIONAL_IMAGE_HEIGHT*inch
-            )
+            if use_contact_sheets(additional_images):
+                self._add_contact_sheets([path for path in additional_images if image_exists(path)])
+            else:
+                self._add_image_grid(
+                    additional_images,
+                    ADDITIONAL_IMAGE_WIDTH*inch,
+                    ADDITIONAL_IMAGE_HEIGHT*inch
+                )
+
+        if unavailable_images:
+            self.story.append(Paragraph("<b>Unavailable Images:</b>", self.styles['FieldLabel']))
+            for item in unavailable_images:
+                self.story.append(Paragraph(
+                    f"(Image not available: {escape(item['link'])} - {escape(item['reason'])})",
+                    self.styles['FieldValue']
+                ))
 
-        if not primary_images and not additional_images:
+        if not primary_images and not additional_images and not unavailable_images:
             self.story.append(Paragraph("(No images available)", self.styles['FieldValue']))
 
         self.story.append(Spacer(1, 0.2*inch))
@@ -290,17 +357,22 @@ class PDFBuilder:
             self._create_two_column_layout(populated_fields)
             self.story.append(Spacer(1, 0.1*inch))
 
-    def _add_image(self, img_path: str, max_width: float, max_height: float):
+    def _add_image(self, img_path: ImageRef, max_width: float, max_height: float):
         """Add single image to the story"""
         try:
-            if not os.path.exists(img_path):
+            if not image_exists(img_path):
                 logger.warning(f"Image file not found: {img_path}")
                 return
 
-            img = Image(img_path)
+            if self.image_processor:
+                img_path = self.image_processor.prepare_image(img_path, max_width, max_height)
+
+            metadata = probe_image(img_path)
+            if metadata is None:
+                raise ValueError("not a readable image")
 
             # Calculate aspect ratio and resize
-            img_width, img_height = img.drawWidth, img.drawHeight
+            img_width, img_height = metadata['width'], metadata['height']
             aspect = img_height / float(img_width)
 
             # Fit within max dimensions
@@ -312,8 +384,7 @@ class PDFBuilder:
                 img_height = max_height
                 img_width = img_height / aspect
 
-            img.drawWidth = img_width
-            img.drawHeight = img_height
+            img = self._create_image(img_path, img_width, img_height)
 
             # Add image with spacing
             self.story.append(Spacer(1, 0.1*inch))
@@ -324,7 +395,110 @@ class PDFBuilder:
             logger.error(f"Error adding image {img_path}: {e}")
             self.story.append(Paragraph("(Error loading image)", self.styles['FieldValue']))
 
-    def _add_image_grid(self, image_paths: List[str], width: float, height: float):
+    def _create_image(self, img_path: ImageRef, width: float, height: float) -> Image:
+        """
+        Create an image flowable, embedding each distinct image only once
+
+        reportlab reuses an image XObject only for the same file name (or, for
+        streams, after decoding the pixels again), so copies of one photo under
+        different names or Drive IDs are drawn from the first copy instead.
+        The most recent EMBEDDED_IMAGE_MEMO images are remembered across the
+        entries of a streamed build.
+        """
+        if img_path not in self.image_hashes:
+            self.image_hashes[img_path] = hash_image(img_path)
+        content_hash = self.image_hashes[img_path]
+        self._touch(self.image_hashes, img_path)
+
+        template, source = self.embedded_images.get(content_hash, (None, None))
+        if template is not None and not self._is_readable(source):
+            template = None
+        if template is None:
+            source = self._image_source(img_path)
+            template = Image(source, width=width, height=height)
+            self.embedded_images[content_hash] = (template, source)
+            self.stats['images_embedded'] += 1
+        else:
+            self.stats['duplicate_images'] += 1
+            logger.debug(f"Reusing embedded image for duplicate {img_path}")
+        self._touch(self.embedded_images, content_hash)
+
+        # Only copies are drawn, so the pixels they decode are freed with the story, not kept here
+        img = copy.copy(template)
+        img._width, img._height = width, height
+        img.drawWidth, img.drawHeight = width, height
+        return img
+
+    def _image_source(self, img_path: ImageRef):
+        """Get the file path of an image for reportlab, or a stream that is closed after the build"""
+        # reportlab opens and closes files itself, so nothing keeps a spilled image's file open
+        path = image_file_path(img_path)
+        if path is not None:
+            return path
+
+        source = open_image_source(img_path)
+        self.open_sources.append(source)
+        return source
+
+    def _is_readable(self, source) -> bool:
+        """Check whether a remembered image can still be drawn from its source"""
+        return os.path.exists(source) if isinstance(source, str) else not source.closed
+
+    def _touch(self, memo: OrderedDict, key):
+        """Mark a memo entry as most recently used and drop the oldest beyond EMBEDDED_IMAGE_MEMO"""
+        memo.move_to_end(key)
+        while len(memo) > EMBEDDED_IMAGE_MEMO:
+            memo.popitem(last=False)
+
+    def _release_image_data(self):
+        """Close the streams of drawn images, keeping the file-backed ones for later entries"""
+        for content_hash, (_, source) in list(self.embedded_images.items()):
+            # Only readable from its stream, which is closed below
+            if not isinstance(source, str):
+                del self.embedded_images[content_hash]
+        self._close_sources()
+
+        # Keys that are spooled images would keep them alive
+        for image in [image for image in self.image_hashes if not isinstance(image, str)]:
+            del self.image_hashes[image]
+
+    def _close_sources(self):
+        """Close the streams opened for in-memory images"""
+        for source in self.open_sources:
+            source.close()
+        self.open_sources = []
+
+    def _add_contact_sheets(self, image_paths: List[ImageRef]):
+        """Add images as numbered thumbnails on page-wide contact sheets, each followed by its index"""
+        dpi = self.image_processor.dpi if self.image_processor else IMAGE_TARGET_DPI
+        quality = self.image_processor.quality if self.image_processor else IMAGE_QUALITY
+
+        sheet_width = PAGE_SIZE[0] - LEFT_MARGIN - RIGHT_MARGIN
+        cell_width, cell_height = contact_sheet_cell()
+        cell_px = (int(math.ceil(cell_width / 72.0 * dpi)), int(math.ceil(cell_height / 72.0 * dpi)))
+        per_sheet = CONTACT_SHEET_COLUMNS * CONTACT_SHEET_ROWS
+
+        for start in range(0, len(image_paths), per_sheet):
+            sheet_images = image_paths[start:start + per_sheet]
+            try:
+                data = render_contact_sheet(sheet_images, CONTACT_SHEET_COLUMNS, cell_px, start + 1, quality)
+            except Exception as e:
+                logger.error(f"Error creating contact sheet for images {start + 1}-{start + len(sheet_images)}: {e}")
+                self.story.append(Paragraph("(Error loading images)", self.styles['FieldValue']))
+                continue
+
+            rows = int(math.ceil(len(sheet_images) / float(CONTACT_SHEET_COLUMNS)))
+            sheet = Image(io.BytesIO(data), width=sheet_width, height=cell_height * rows)
+            index = ' &nbsp; '.join(
+                f"<b>{start + i + 1}</b> {escape(image_name(img_path))}"
+                for i, img_path in enumerate(sheet_images)
+            )
+            self.story.append(KeepTogether([sheet, Paragraph(index, self.styles['ContactSheetIndex'])]))
+            self.stats['contact_sheets'] += 1
+
+        logger.info(f"Added {len(image_paths)} images on {self.stats['contact_sheets']} contact sheets")
+
+    def _add_image_grid(self, image_paths: List[ImageRef], width: float, height: float):
         """Add images in a grid layout"""
         for i in range(0, len(image_paths), IMAGES_PER_ROW):
             row_images = image_paths[i:i+IMAGES_PER_ROW]
@@ -332,8 +506,10 @@ class PDFBuilder:
 
             for img_path in row_images:
                 try:
-                    if os.path.exists(img_path):
-                        img = Image(img_path, width=width, height=height)
+                    if image_exists(img_path):
+                        if self.image_processor:
+                            img_path = self.image_processor.prepare_image(img_path, width, height, fill=True)
+                        img = self._create_image(img_path, width, height)
                         image_row.append(img)
                 except Exception as e:
                     logger.error(f"Error adding grid image {img_path}: {e}")
@@ -363,21 +539,66 @@ class PDFBuilder:
             bool: True if successful
         """
         try:
-            # Create PDF document
-            doc = SimpleDocTemplate(
-                self.output_path,
-                pagesize=PAGE_SIZE,
-                topMargin=TOP_MARGIN,
-                bottomMargin=BOTTOM_MARGIN,
-                leftMargin=LEFT_MARGIN,
-                rightMargin=RIGHT_MARGIN
-            )
-
             # Build PDF
-            doc.build(self.story)
+            self._create_document().build(self.story)
             logger.info(f"PDF generated successfully: {self.output_path}")
             return True
 
         except Exception as e:
             logger.error(f"Error generating PDF: {e}")
-            raise PDFGenerationError(f"Failed to generate PDF: {str(e)}")
\ No newline at end of file
+            raise PDFGenerationError(f"Failed to generate PDF: {str(e)}")
+        finally:
+            self._close_sources()
+
+    def generate_streaming(self, entries: Iterable[Optional[List[Flowable]]]) -> bool:
+        """
+        Generate the PDF document from entries produced one at a time
+
+        Each entry is laid out as soon as it is produced, and its flowables and
+        embedded image sources are released before the next entry is requested,
+        so memory does not grow with the number of entries. An entry is either
+        the list of flowables given by the iterable, or, if it gives None, what
+        was added with the add_* methods since the previous entry. When entries
+        is a generator, its code after each yield runs once that entry has been
+        drawn, which is where the entry's images can be released.
+
+        Args:
+            entries: Flowables (or None) for each entry, in order
+
+        Returns:
+            bool: True if successful
+        """
+        try:
+            self._create_document().build(FlowableStream(self._stream_entries(entries)))
+            logger.info(f"PDF generated successfully: {self.output_path} ({self.stats['entries']} entries)")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error generating PDF: {e}")
+            raise PDFGenerationError(f"Failed to generate PDF: {str(e)}")
+        finally:
+            self._close_sources()
+
+    def _stream_entries(self, entries: Iterable[Optional[List[Flowable]]]) -> Iterator[List[Flowable]]:
+        """Collect each entry's flowables and forget them and its images once it is laid out"""
+        for flowables in entries:
+            if flowables:
+                self.story.extend(flowables)
+            story, self.story = self.story, []
+            self.stats['entries'] += 1
+            yield story
+
+            # Drawn by now; repeated images in later entries still reuse the first copy
+            del story, flowables
+            self._release_image_data()
+
+    def _create_document(self) -> SimpleDocTemplate:
+        """Create the document template with the configured page size and margins"""
+        return SimpleDocTemplate(
+            self.output_path,
+            pagesize=PAGE_SIZE,
+            topMargin=TOP_MARGIN,
+            bottomMargin=BOTTOM_MARGIN,
+            leftMargin=LEFT_MARGIN,
+            rightMargin=RIGHT_MARGIN
+        )
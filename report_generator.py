@@ -4,13 +4,21 @@ Main report generator class for Heritage Report Generator
 
 import os
 import logging
-from typing import Dict, Any, Optional
+import threading
+from typing import Dict, Any, Optional, List
 
 from data_loader import DataLoader
-from image_handler import ImageHandler
-from pdf_builder import PDFBuilder
+from image_handler import ImageHandler, thumbnail_size_for_slot
+from pdf_builder import PDFBuilder, image_slots, additional_image_box
+from image_processor import ImageProcessor
+from image_cache import DerivativeCache
+from image_sources import create_image_source
+from link_index import LinkIndex
+from link_cache import FailedLinkCache
+from shared_cache import SharedImageCache
+from size_budget import SizeBudgetPlanner, estimate_text_bytes
 from constants import *
-from utils import safe_str, format_date
+from utils import safe_str, format_date, parse_image_links
 from exceptions import ReportGeneratorError
 
 logger = logging.getLogger(__name__)
@@ -19,26 +27,74 @@ logger = logging.getLogger(__name__)
 class ReportGenerator:
     """Main class for generating heritage assessment reports"""
     
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, image_sources: Optional[List[str]] = None,
+                 size_budget_mb: Optional[float] = None, bandwidth_kbps: Optional[float] = None,
+                 refresh_links: bool = False, thumbnails: Optional[bool] = None,
+                 shared_cache_dir: Optional[str] = None):
         """
         Initialize report generator
         
         Args:
             csv_path: Path to CSV file
+            image_sources: Folders or ZIP archives holding already downloaded images
+            size_budget_mb: Target PDF size in MB (default: PDF_SIZE_BUDGET_MB, 0 for none)
+            bandwidth_kbps: Download speed cap in KB/s (default: DOWNLOAD_BANDWIDTH_KBPS, 0 for none)
+            refresh_links: Try links that failed on earlier runs again
+            thumbnails: Download additional images as server-rendered thumbnails (default: USE_DRIVE_THUMBNAILS)
+            shared_cache_dir: Image cache shared with other processes (default: SHARED_IMAGE_CACHE_DIR)
         """
         self.csv_path = csv_path
         self.csv_dir = os.path.dirname(csv_path)
+        self.size_budget_mb = PDF_SIZE_BUDGET_MB if size_budget_mb is None else size_budget_mb
+        thumbnails = USE_DRIVE_THUMBNAILS if thumbnails is None else thumbnails
+        shared_cache_dir = shared_cache_dir or SHARED_IMAGE_CACHE_DIR
         
         # Initialize components
         self.data_loader = DataLoader(csv_path)
-        self.image_handler = ImageHandler()
+        self.image_handler = ImageHandler(
+            sources=[create_image_source(path) for path in image_sources or []],
+            bandwidth_kbps=DOWNLOAD_BANDWIDTH_KBPS if bandwidth_kbps is None else bandwidth_kbps,
+            failed_links=self._create_failed_link_cache(refresh_links),
+            thumbnail_url=DRIVE_THUMBNAIL_URL if thumbnails else None,
+            shared_cache=SharedImageCache(shared_cache_dir) if shared_cache_dir else None
+        )
+        self.image_processor = self._create_image_processor()
         self.pdf_builder = None
+        self.size_budget = None
+        self.output_path = None
+        self.compendium_stats = None
         
         # Data storage
         self.latest_data = None
         self.primary_images = []
         self.additional_images = []
         
+        # Newest row seen while the CSV loads, prefetched by a background thread once it settles
+        self.prefetch_row = None
+        self.prefetch_stopped = False
+        self.prefetch_condition = threading.Condition()
+        self.prefetch_thread = None
+        
+    def _create_failed_link_cache(self, refresh: bool) -> Optional[FailedLinkCache]:
+        """Create the cache of links that failed on earlier runs if enabled"""
+        if not USE_FAILED_LINK_CACHE:
+            return None
+        return FailedLinkCache(os.path.join(IMAGE_CACHE_DIR, 'failed_links.json'), refresh=refresh)
+    
+    def _create_image_processor(self) -> Optional[ImageProcessor]:
+        """Create the image processor and its derivative cache if enabled"""
+        if not DOWNSAMPLE_IMAGES:
+            return None
+        
+        cache = None
+        if USE_DERIVATIVE_CACHE:
+            try:
+                cache = DerivativeCache(os.path.join(IMAGE_CACHE_DIR, 'derivatives'))
+            except OSError as e:
+                logger.warning(f"Derivative cache unavailable, images will be resampled each run: {e}")
+        
+        return ImageProcessor(self.image_handler.temp_dir, cache=cache)
+    
     def generate_report(self, output_path: str) -> Dict[str, Any]:
         """
         Generate the complete report
@@ -74,20 +130,167 @@ class ReportGenerator:
             logger.error(f"Report generation failed: {e}")
             raise ReportGeneratorError(f"Failed to generate report: {str(e)}")
     
+    def generate_compendium(self, output_path: str) -> Dict[str, Any]:
+        """
+        Generate one report with every assessment in the CSV, one after another
+        
+        Entries are downloaded, laid out and released one at a time, so memory
+        stays flat however many rows the CSV has. An image used by several
+        entries is kept until the last of them instead of being downloaded
+        again, and the size budget is not applied.
+        
+        Args:
+            output_path: Path for output PDF
+            
+        Returns:
+            Dict[str, Any]: Report generation statistics, with the number of entries
+            
+        Raises:
+            ReportGeneratorError: If report generation fails
+        """
+        try:
+            logger.info("Starting compendium generation")
+            rows = self.data_loader.load_data()
+            if self.size_budget_mb:
+                logger.warning("PDF size budget is not applied to compendiums, ignoring it")
+            
+            self.output_path = output_path
+            self.compendium_stats = {'entries': 0, 'images': 0, 'unavailable_images': 0}
+            self.pdf_builder = PDFBuilder(output_path, self.image_processor)
+            self.pdf_builder.generate_streaming(self._compendium_entries(rows, LinkIndex(rows)))
+            
+            stats = self._get_statistics()
+            stats['entries'] = self.compendium_stats['entries']
+            stats['total_images'] = self.compendium_stats['images']
+            stats['unavailable_images'] = self.compendium_stats['unavailable_images']
+            
+            logger.info("Compendium generation completed successfully")
+            return stats
+            
+        except Exception as e:
+            logger.error(f"Compendium generation failed: {e}")
+            raise ReportGeneratorError(f"Failed to generate compendium: {str(e)}")
+    
+    def _compendium_entries(self, rows: List[Dict[str, str]], link_index: LinkIndex):
+        """Add the content of each row in turn, releasing images after the last row that uses them"""
+        last_rows = {}
+        for file_id in link_index.file_ids():
+            last_rows.setdefault(link_index.rows_for(file_id)[-1], []).append(file_id)
+        
+        for index, row in enumerate(rows):
+            logger.info(f"Adding entry {index + 1}/{len(rows)}")
+            self.latest_data = row
+            self.primary_images = []
+            self.additional_images = []
+            self._download_images()
+            
+            if index:
+                self.pdf_builder.add_page_break()
+            self.pdf_builder.add_header_with_logos(self.csv_dir)
+            self._add_all_sections()
+            yield None
+            
+            images = self.primary_images + self.additional_images
+            self.compendium_stats['entries'] += 1
+            self.compendium_stats['images'] += len(images)
+            self.compendium_stats['unavailable_images'] += len(self.image_handler.unavailable_images)
+            
+            # The next entry only lists its own unavailable images
+            del self.image_handler.unavailable_images[:]
+            for file_id in last_rows.pop(index, []):
+                self.image_handler.forget_image(file_id)
+            if self.image_processor:
+                kept = set(self.image_handler.downloaded_images.values())
+                kept.update(self.image_handler.thumbnails.values())
+                self.image_processor.forget_images([image for image in images if image not in kept])
+            del images
+            self.primary_images = []
+            self.additional_images = []
+    
     def _load_data(self):
         """Load and validate CSV data"""
         logger.info("Loading CSV data")
         
-        # Load data
-        self.data_loader.load_data()
+        # Load data, downloading the images of the newest row seen so far while parsing continues
+        if PREFETCH_IMAGES:
+            self._start_prefetching()
+        try:
+            self.data_loader.load_data(on_candidate=self._note_candidate if PREFETCH_IMAGES else None)
+        finally:
+            self._stop_prefetching()
         
         # Get latest entry
         self.latest_data = self.data_loader.get_latest_entry()
+        if PREFETCH_IMAGES:
+            self.image_handler.cancel_prefetch(keep=self._row_file_ids(self.latest_data))
         
         # Log some basic info
         date_value = self.latest_data.get('Date of Assessment', 'Unknown')
         logger.info(f"Processing assessment from: {date_value}")
     
+    def _start_prefetching(self):
+        """Start the thread that prefetches the newest row found while the CSV loads"""
+        self.prefetch_row = None
+        self.prefetch_stopped = False
+        self.prefetch_thread = threading.Thread(target=self._prefetch_worker, name='prefetch-rows', daemon=True)
+        self.prefetch_thread.start()
+    
+    def _note_candidate(self, row: Dict[str, str]):
+        """Record a row that may turn out to be the latest entry (called by the CSV parser for each newer row)"""
+        with self.prefetch_condition:
+            self.prefetch_row = row
+            self.prefetch_condition.notify_all()
+    
+    def _stop_prefetching(self):
+        """Stop prefetching further rows; downloads already started carry on"""
+        with self.prefetch_condition:
+            self.prefetch_stopped = True
+            self.prefetch_condition.notify_all()
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+    
+    def _prefetch_worker(self):
+        """Prefetch the newest row once no newer one has been found for PREFETCH_SETTLE_SECONDS"""
+        started = None
+        while True:
+            with self.prefetch_condition:
+                row = self.prefetch_row
+                changed = self.prefetch_condition.wait_for(
+                    lambda: self.prefetch_stopped or self.prefetch_row is not row,
+                    timeout=PREFETCH_SETTLE_SECONDS
+                )
+                if self.prefetch_stopped:
+                    return
+            if not changed and row is not None and row is not started:
+                started = row
+                self._prefetch_images(row)
+    
+    def _row_file_ids(self, row: Dict[str, str]) -> List[str]:
+        """Get the file IDs of a row's images"""
+        return LinkIndex([row]).file_ids()
+    
+    def _prefetch_images(self, row: Dict[str, str]):
+        """Queue downloads for a row that may turn out to be the latest entry"""
+        try:
+            # Downloads for rows this one replaced are no longer needed, unless this row shares them
+            self.image_handler.cancel_prefetch(keep=self._row_file_ids(row))
+            self.image_handler.prefetch_image_links(row.get(PRIMARY_IMAGE_FIELD) or '', "primary")
+            additional_links = row.get(ADDITIONAL_IMAGES_FIELD) or ''
+            self.image_handler.prefetch_image_links(additional_links, "additional",
+                                                    self._additional_thumbnail_size(additional_links))
+        except Exception as e:
+            logger.warning(f"Could not prefetch images: {e}")
+    
+    def _additional_thumbnail_size(self, links_str: str) -> Optional[int]:
+        """Get the thumbnail size matching the slot additional images are drawn in"""
+        if not self.image_handler.thumbnail_url:
+            return None
+        
+        box_width, box_height, fill = additional_image_box(parse_image_links(links_str))
+        dpi = self.image_processor.dpi if self.image_processor else IMAGE_TARGET_DPI
+        return thumbnail_size_for_slot(box_width, box_height, fill, dpi)
+    
     def _download_images(self):
         """Download images from Google Drive links"""
         logger.info("Downloading images")
@@ -107,7 +310,8 @@ class ReportGenerator:
         if additional_links:
             self.additional_images = self.image_handler.process_image_links(
                 additional_links, 
-                "additional"
+                "additional",
+                self._additional_thumbnail_size(additional_links)
             )
         
         # Log download results
@@ -115,11 +319,44 @@ class ReportGenerator:
         logger.info(f"Downloaded {total_images} images total")
     
     def _build_pdf(self, output_path: str):
-        """Build the PDF report"""
+        """Build the PDF report, rebuilding with smaller images if it exceeds the size budget"""
         logger.info("Building PDF report")
+        self.output_path = output_path
+        
+        if self.size_budget_mb:
+            self._plan_size_budget()
+        
+        self._build_pdf_once(output_path)
+        while self.size_budget and self.size_budget.needs_rebuild(output_path):
+            self._build_pdf_once(output_path)
+        
+        size_mb = os.path.getsize(output_path) / (1024 * 1024)
+        if size_mb > MAX_PDF_SIZE_WARNING:
+            logger.warning(f"PDF is {size_mb:.1f} MB, larger than {MAX_PDF_SIZE_WARNING} MB "
+                           f"(set PDF_SIZE_BUDGET_MB to limit the size)")
+    
+    def _plan_size_budget(self):
+        """Choose image resolution and quality so the PDF fits the size budget"""
+        if not self.image_processor:
+            logger.warning("PDF size budget needs DOWNSAMPLE_IMAGES enabled, ignoring it")
+            return
         
+        texts = [self.latest_data.get(csv_field, '')
+                 for fields in SECTION_FIELDS.values() for csv_field in fields.values()]
+        texts += [label for fields in SECTION_FIELDS.values() for label in fields]
+        logos = [os.path.join(self.csv_dir, BILADI_LOGO_FILENAME), os.path.join(self.csv_dir, CER_LOGO_FILENAME)]
+        
+        self.size_budget = SizeBudgetPlanner(self.image_processor, self.size_budget_mb)
+        self.size_budget.allocate(
+            image_slots(self.primary_images, self.additional_images),
+            self.primary_images[:1],
+            estimate_text_bytes(texts, files=logos, fonts=[ARABIC_FONT_PATH])
+        )
+    
+    def _build_pdf_once(self, output_path: str):
+        """Build the PDF report"""
         # Initialize PDF builder
-        self.pdf_builder = PDFBuilder(output_path)
+        self.pdf_builder = PDFBuilder(output_path, self.image_processor)
         
         # Add header with logos
         self.pdf_builder.add_header_with_logos(self.csv_dir)
@@ -210,7 +447,8 @@ class ReportGenerator:
             self.pdf_builder.add_section("7. Documentation and Evidence", section_data)
         
         # Then add images
-        self.pdf_builder.add_images_section(self.primary_images, self.additional_images)
+        self.pdf_builder.add_images_section(self.primary_images, self.additional_images,
+                                            self.image_handler.unavailable_images)
     
     def _get_statistics(self) -> Dict[str, Any]:
         """Get report generation statistics"""
@@ -223,13 +461,47 @@ class ReportGenerator:
             'primary_images': len(self.primary_images),
             'additional_images': len(self.additional_images),
             'total_images': image_stats['total_downloaded'],
-            'total_image_size_mb': image_stats['total_size_mb']
+            'total_image_size_mb': image_stats['total_size_mb'],
+            'offline_images': image_stats['offline_hits'],
+            'throttle_events': image_stats['throttle_events'],
+            'skipped_non_images': image_stats['skipped_non_images'],
+            'thumbnails': image_stats['thumbnails'],
+            'shared_cache_hits': image_stats['shared_cache_hits'],
+            'skipped_failed_links': image_stats['skipped_failed_links'],
+            'unavailable_images': len(self.image_handler.unavailable_images),
+            'download_throughput_kbps': image_stats['throughput_kbps'],
+            'bandwidth_limit_kbps': image_stats['bandwidth_limit_kbps'],
+            'bandwidth_wait_s': image_stats['bandwidth_wait_s'],
+            'download_time_p50_s': image_stats['download_time_p50_s'],
+            'download_time_p90_s': image_stats['download_time_p90_s'],
+            'download_time_p99_s': image_stats['download_time_p99_s'],
+            'hedged_requests': image_stats['hedged_requests'],
+            'hedge_wins': image_stats['hedge_wins'],
+            'stalled_transfers': image_stats['stalled_transfers'],
+            'images_resampled': 0,
+            'image_bytes_saved': 0,
+            'images_decoded_separately': 0,
+            'duplicate_images': self.pdf_builder.stats['duplicate_images'] if self.pdf_builder else 0,
+            'contact_sheets': self.pdf_builder.stats['contact_sheets'] if self.pdf_builder else 0,
+            'pdf_size_mb': 0,
+            'size_budget': self.size_budget.get_report() if self.size_budget else None
         }
         
+        if self.output_path and os.path.exists(self.output_path):
+            stats['pdf_size_mb'] = round(os.path.getsize(self.output_path) / (1024 * 1024), 2)
+        
+        if self.image_processor:
+            processing_stats = self.image_processor.get_stats()
+            stats['images_resampled'] = processing_stats['images_resampled']
+            stats['image_bytes_saved'] = processing_stats['bytes_saved']
+            stats['images_decoded_separately'] = processing_stats['images_decoded_separately']
+        
         return stats
     
     def cleanup(self):
         """Clean up resources"""
+        if getattr(self, 'image_processor', None):
+            self.image_processor.close()
         if hasattr(self, 'image_handler'):
             self.image_handler.cleanup()
     
@@ -0,0 +1,169 @@
+"""
+Font and paragraph style registry for Heritage Report Generator
+
+Parses the report fonts and builds the paragraph styles once per process.
+The Unicode font (ARIALUNI.TTF) is about 23 MB, so parsing it again for
+every PDFBuilder would dominate the cost of each report in a batch. All
+builders, in any thread, share the same stylesheet; it must not be changed
+after it is built.
+"""
+
+import os
+import logging
+import threading
+
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle, StyleSheet1
+from reportlab.lib.enums import TA_LEFT
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+from constants import (DEFAULT_FONT, BOLD_FONT, ARABIC_FONT_PATH, ARABIC_FONT_NAME, SECTION_TITLE_SIZE,
+                       SECTION_TITLE_COLOR, FIELD_LABEL_SIZE, FIELD_LABEL_COLOR, FIELD_VALUE_SIZE,
+                       FIELD_VALUE_COLOR, USE_FONT_CACHE, IMAGE_CACHE_DIR)
+from font_cache import FontCache
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_fonts = {}
+_styles = None
+_font_cache = None
+
+
+def register_font(name: str, path: str) -> bool:
+    """
+    Register a TrueType font, parsing the file only the first time
+
+    Args:
+        name: Font name used in styles
+        path: Path to the .ttf file
+
+    Returns:
+        bool: True if the font can be used
+    """
+    with _lock:
+        if name not in _fonts:
+            _fonts[name] = _load_font(name, path)
+        return _fonts[name]
+
+
+def get_styles() -> StyleSheet1:
+    """
+    Get the report's paragraph styles, building them on first use
+
+    Returns:
+        StyleSheet1: Sample styles plus SectionTitle, FieldLabel, FieldValue,
+        CompactField and ContactSheetIndex (shared; do not modify)
+    """
+    global _styles
+
+    if _styles is None:
+        unicode_font = ARABIC_FONT_NAME if register_font(ARABIC_FONT_NAME, ARABIC_FONT_PATH) else DEFAULT_FONT
+        with _lock:
+            if _styles is None:
+                _styles = _build_styles(unicode_font)
+    return _styles
+
+
+def reset():
+    """Forget the built styles so the next get_styles() builds them again (fonts stay registered with reportlab)"""
+    global _styles
+
+    with _lock:
+        _styles = None
+        _fonts.clear()
+
+
+def _load_font(name: str, path: str) -> bool:
+    """Parse and register a font file"""
+    if name in pdfmetrics.getRegisteredFontNames():
+        return True
+    if not os.path.exists(path):
+        return False
+
+    try:
+        if USE_FONT_CACHE:
+            font = _get_font_cache().load_font(name, path)
+        else:
+            font = TTFont(name, path)
+        pdfmetrics.registerFont(font)
+        logger.info(f"Registered font: {name}")
+        return True
+    except Exception as e:
+        logger.warning(f"Could not register font {name}: {e}")
+        return False
+
+
+def _get_font_cache() -> FontCache:
+    """Get the process-wide font cache (called with _lock held)"""
+    global _font_cache
+
+    if _font_cache is None:
+        _font_cache = FontCache(os.path.join(IMAGE_CACHE_DIR, 'fonts'))
+    return _font_cache
+
+
+def _build_styles(unicode_font: str) -> StyleSheet1:
+    """Build the sample stylesheet with the report's custom styles"""
+    styles = getSampleStyleSheet()
+
+    # Section title style
+    styles.add(ParagraphStyle(
+        name='SectionTitle',
+        parent=styles['Heading1'],
+        fontSize=SECTION_TITLE_SIZE,
+        textColor=colors.HexColor(SECTION_TITLE_COLOR),
+        spaceAfter=12,
+        spaceBefore=12,
+        alignment=TA_LEFT
+    ))
+
+    # Field label style (for two-column layout)
+    styles.add(ParagraphStyle(
+        name='FieldLabel',
+        parent=styles['Normal'],
+        fontSize=FIELD_LABEL_SIZE,
+        textColor=colors.HexColor(FIELD_LABEL_COLOR),
+        fontName=BOLD_FONT,
+        spaceAfter=2,
+        alignment=TA_LEFT
+    ))
+
+    # Field value style (for two-column layout)
+    styles.add(ParagraphStyle(
+        name='FieldValue',
+        parent=styles['Normal'],
+        fontSize=FIELD_VALUE_SIZE,
+        textColor=colors.HexColor(FIELD_VALUE_COLOR),
+        spaceAfter=6,
+        fontName=unicode_font,
+        alignment=TA_LEFT
+    ))
+
+    # Compact field style for two-column layout
+    styles.add(ParagraphStyle(
+        name='CompactField',
+        parent=styles['Normal'],
+        fontSize=FIELD_VALUE_SIZE - 1,
+        textColor=colors.HexColor(FIELD_VALUE_COLOR),
+        spaceAfter=4,
+        fontName=unicode_font,
+        leftIndent=0,
+        alignment=TA_LEFT
+    ))
+
+    # Index printed below each contact sheet
+    styles.add(ParagraphStyle(
+        name='ContactSheetIndex',
+        parent=styles['Normal'],
+        fontSize=FIELD_VALUE_SIZE - 3,
+        leading=FIELD_VALUE_SIZE - 1,
+        textColor=colors.HexColor(FIELD_VALUE_COLOR),
+        spaceBefore=2,
+        spaceAfter=10,
+        fontName=unicode_font,
+        alignment=TA_LEFT
+    ))
+
+    return styles
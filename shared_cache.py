@@ -0,0 +1,234 @@
+"""
+Shared image cache for Heritage Report Generator
+
+Lets several generator processes on one host (or on a shared volume) reuse
+each other's downloads. Each file ID has a lock file: the first process to
+take it downloads the image, the others wait and then read the cached copy.
+Files are written under a temporary name and renamed into place, so readers
+never see partial images; temporary files left behind by a crashed process
+are removed by the next process that finds them unlocked.
+"""
+
+import os
+import time
+import logging
+from typing import Optional, Dict
+
+from image_buffers import ImageRef, image_name, copy_image
+from image_sources import IMAGE_EXTENSIONS
+from utils import atomic_write, TEMP_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# Interval between attempts to take a lock held by another process (seconds)
+LOCK_POLL_INTERVAL = 0.05
+
+
+class FileLock:
+    """Exclusive lock on a file, held across processes (flock on Unix, msvcrt on Windows)"""
+
+    def __init__(self, path: str):
+        """
+        Initialize file lock
+
+        Args:
+            path: Lock file path, created if missing
+        """
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take the lock
+
+        Args:
+            blocking: Wait until the lock is free instead of giving up
+
+        Returns:
+            bool: True if the lock was taken
+        """
+        self.file = open(self.path, 'a+b')
+        while True:
+            if self._try_lock():
+                return True
+            if not blocking:
+                self.file.close()
+                self.file = None
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        """Release the lock"""
+        if self.file is None:
+            return
+        try:
+            self._unlock()
+        finally:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    if os.name == 'nt':
+        def _try_lock(self) -> bool:
+            import msvcrt
+            try:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                return False
+
+        def _unlock(self):
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        def _try_lock(self) -> bool:
+            import fcntl
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError:
+                return False
+
+        def _unlock(self):
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+
+class SharedImageCache:
+    """Image cache directory shared safely by several processes"""
+
+    def __init__(self, cache_dir: str):
+        """
+        Initialize shared image cache
+
+        Args:
+            cache_dir: Directory shared by all processes
+        """
+        self.cache_dir = cache_dir
+        self.lock_dir = os.path.join(cache_dir, 'locks')
+        self.hits = 0
+        self.stores = 0
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.remove_orphans()
+
+    def lock(self, key: str) -> FileLock:
+        """
+        Get the lock for one cache entry
+
+        Hold it while checking for and fetching the entry, so concurrent
+        fetches of one file ID turn into a single download.
+
+        Args:
+            key: Cache key, usually the Drive file ID
+
+        Returns:
+            FileLock: Lock to use as a context manager
+        """
+        return FileLock(os.path.join(self.lock_dir, f"{key}.lock"))
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached image
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Optional[str]: Path to the cached file or None
+        """
+        path = self._find(key)
+        if path:
+            self.hits += 1
+        return path
+
+    def contains(self, key: str) -> bool:
+        """Check whether an image is cached, without counting it as a hit"""
+        return self._find(key) is not None
+
+    def put(self, key: str, image: ImageRef, lock_key: Optional[str] = None) -> str:
+        """
+        Store an image; the caller holds the entry's lock
+
+        Args:
+            key: Cache key
+            image: Downloaded image
+            lock_key: Key of the lock the caller holds, if not key (e.g. a thumbnail
+                stored under its file ID's lock)
+
+        Returns:
+            str: Path to the cached file
+        """
+        ext = os.path.splitext(image_name(image))[1].lower()
+        if ext not in IMAGE_EXTENSIONS:
+            ext = '.jpg'
+        path = os.path.join(self.cache_dir, key + ext)
+
+        # The temporary name starts with the held lock's key so remove_orphans checks that lock
+        with atomic_write(path, prefix=f"{lock_key or key}.") as tmp_path:
+            copy_image(image, tmp_path)
+
+        self.stores += 1
+        return path
+
+    def remove(self, key: str):
+        """Delete a cached image that turned out to be unusable; the caller holds the entry's lock"""
+        path = self._find(key)
+        if path:
+            os.remove(path)
+
+    def remove_orphans(self) -> int:
+        """
+        Delete temporary files left by processes that crashed while writing
+
+        A temporary file is only orphaned if nobody holds the lock its name
+        starts with (the lock its writer held, see put).
+
+        Returns:
+            int: Number of files removed
+        """
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(TEMP_SUFFIX):
+                continue
+
+            key = name.split('.', 1)[0]
+            entry_lock = self.lock(key)
+            if not entry_lock.acquire(blocking=False):
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+            except OSError as e:
+                logger.debug(f"Could not remove orphaned file {name}: {e}")
+            finally:
+                entry_lock.release()
+
+        if removed:
+            logger.info(f"Removed {removed} partial files left in {self.cache_dir}")
+        return removed
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get cache statistics
+
+        Returns:
+            Dict[str, int]: Images read from and written to the cache by this process
+        """
+        return {'hits': self.hits, 'stores': self.stores}
+
+    def _find(self, key: str) -> Optional[str]:
+        """Get the path of a cached image, whatever its extension"""
+        for ext in IMAGE_EXTENSIONS:
+            path = os.path.join(self.cache_dir, key + ext)
+            if os.path.exists(path):
+                return path
+        return None
@@ -0,0 +1,299 @@
+"""
+PDF size budget for Heritage Report Generator
+
+Estimates the size of the finished report from its text and image payloads
+and gives each image a resolution and JPEG quality so the PDF fits a target
+size (e.g. an email attachment limit). Additional images are reduced before
+the primary photo.
+"""
+
+import os
+import logging
+from typing import Dict, List, Tuple, Any, Iterable
+
+from reportlab import rl_config
+
+from constants import SIZE_BUDGET_LEVELS, PRIMARY_IMAGE_WEIGHT
+from image_processor import ImageProcessor, calculate_target_size, select_output_format
+from image_metadata import probe_image, display_size
+from image_buffers import ImageRef, image_size, image_name
+
+logger = logging.getLogger(__name__)
+
+# Size of a JPEG at a given quality relative to quality 85, for typical photos
+JPEG_QUALITY_SIZE = [(30, 0.33), (40, 0.38), (50, 0.45), (60, 0.52), (70, 0.62),
+                     (75, 0.70), (80, 0.82), (85, 1.0), (90, 1.4), (95, 1.9), (100, 3.2)]
+
+# PDF structure and page resources
+PDF_BASE_BYTES = 8 * 1024
+
+# Compressed content stream bytes per byte of text, including layout operators
+TEXT_BYTES_PER_CHAR = 1.2
+
+# Share of a TrueType font that ends up in the PDF after subsetting
+FONT_SUBSET_FRACTION = 0.3
+
+# Builds repeated after the first one when the PDF still exceeds the budget
+MAX_CORRECTION_ROUNDS = 2
+
+MB = 1024 * 1024
+
+
+def jpeg_size_factor(quality: int) -> float:
+    """
+    Get the relative size of a JPEG encoded at a quality
+
+    Args:
+        quality: JPEG quality (1-100)
+
+    Returns:
+        float: Size relative to quality 85
+    """
+    if quality <= JPEG_QUALITY_SIZE[0][0]:
+        return JPEG_QUALITY_SIZE[0][1]
+
+    for (q0, f0), (q1, f1) in zip(JPEG_QUALITY_SIZE, JPEG_QUALITY_SIZE[1:]):
+        if quality <= q1:
+            return f0 + (f1 - f0) * (quality - q0) / float(q1 - q0)
+
+    return JPEG_QUALITY_SIZE[-1][1]
+
+
+def stream_overhead() -> float:
+    """Expansion of image data written to the PDF (reportlab ASCII85-encodes streams by default)"""
+    return 1.25 if rl_config.useA85 else 1.0
+
+
+def estimate_text_bytes(texts: Iterable[str], files: Iterable[str] = (), fonts: Iterable[str] = ()) -> int:
+    """
+    Estimate the PDF bytes taken by everything except the report images
+
+    Args:
+        texts: Text shown in the report
+        files: Other embedded images, such as logos
+        fonts: TrueType fonts embedded in the report
+
+    Returns:
+        int: Estimated size in bytes
+    """
+    total = PDF_BASE_BYTES
+    total += sum(len(str(text).encode('utf-8')) for text in texts) * TEXT_BYTES_PER_CHAR
+
+    for path in files:
+        if os.path.exists(path):
+            total += os.path.getsize(path) * stream_overhead()
+
+    for path in fonts:
+        if os.path.exists(path):
+            total += os.path.getsize(path) * FONT_SUBSET_FRACTION
+
+    return int(total)
+
+
+class SizeBudgetPlanner:
+    """Assigns a resolution and JPEG quality per image so the PDF fits a size budget"""
+
+    def __init__(self, processor: ImageProcessor, budget_mb: float,
+                 levels: List[Tuple[int, int]] = SIZE_BUDGET_LEVELS,
+                 primary_weight: float = PRIMARY_IMAGE_WEIGHT):
+        """
+        Initialize size budget planner
+
+        Args:
+            processor: Image processor that renders the chosen levels
+            budget_mb: Target PDF size in MB
+            levels: (dpi, JPEG quality) steps from best to smallest
+            primary_weight: How much longer the primary photo keeps its quality
+        """
+        self.processor = processor
+        self.budget = int(budget_mb * MB)
+        self.primary_weight = max(1.0, primary_weight)
+
+        # The processor's own settings are always the first level; steps above them are ignored
+        top = (processor.dpi, processor.quality)
+        self.levels = [top]
+        for dpi, quality in levels:
+            if dpi <= top[0] and quality <= top[1] and (dpi, quality) not in self.levels:
+                self.levels.append((dpi, quality))
+
+        self.slots = []
+        self.images = {}
+        self.fixed_bytes = 0
+        self.estimated = 0
+        self.achieved = None
+        self.rebuilds = 0
+
+    def allocate(self, slots: List[Tuple[ImageRef, float, float, bool]],
+                 primary_images: List[ImageRef], fixed_bytes: int) -> int:
+        """
+        Choose a level for every image
+
+        Args:
+            slots: (image, box_width, box_height, fill) for every image drawn in the PDF
+            primary_images: Images that get quality priority
+            fixed_bytes: Estimated size of everything except the images
+
+        Returns:
+            int: Estimated PDF size in bytes
+        """
+        self.slots = list(slots)
+        self.fixed_bytes = fixed_bytes
+
+        for image, box_width, box_height, _ in self.slots:
+            primary = image in primary_images
+            entry = self.images.setdefault(image, {
+                'level': 0,
+                'weight': self.primary_weight if primary else 1.0,
+                'role': 'primary' if primary else 'additional',
+                'area': 0.0,
+                'measured': []
+            })
+            entry['area'] += box_width * box_height
+
+        self._measure()
+        self._reduce()
+        return self.estimated
+
+    def needs_rebuild(self, pdf_path: str) -> bool:
+        """
+        Check a built PDF against the budget and lower levels further if it is too large
+
+        Args:
+            pdf_path: Path of the PDF just built
+
+        Returns:
+            bool: True if the PDF should be built again with the new levels
+        """
+        self.achieved = os.path.getsize(pdf_path)
+        if self.achieved <= self.budget or self.rebuilds >= MAX_CORRECTION_ROUNDS:
+            return False
+
+        # Measure what the images really took and attribute the rest to text and structure
+        self._measure()
+        embedded = self._embedded_image_bytes()
+        self.fixed_bytes = max(0, self.achieved - embedded)
+
+        levels_before = {image: entry['level'] for image, entry in self.images.items()}
+        self._reduce()
+        if all(entry['level'] == levels_before[image] for image, entry in self.images.items()):
+            return False
+
+        self.rebuilds += 1
+        logger.info(f"PDF is {self.achieved / MB:.2f} MB, over the {self.budget / MB:.2f} MB budget; "
+                    f"rebuilding with smaller images")
+        return True
+
+    def get_report(self) -> Dict[str, Any]:
+        """
+        Get the budget outcome and the level chosen for each image
+
+        Returns:
+            Dict[str, Any]: Budget, estimated and achieved size, and per-image decisions
+        """
+        achieved = self.achieved if self.achieved is not None else self.estimated
+        return {
+            'budget_mb': round(self.budget / MB, 2),
+            'estimated_mb': round(self.estimated / MB, 2),
+            'achieved_mb': round(achieved / MB, 2),
+            'within_budget': achieved <= self.budget,
+            'rebuilds': self.rebuilds,
+            'images': [
+                {
+                    'image': image_name(image),
+                    'role': entry['role'],
+                    'dpi': self.levels[entry['level']][0],
+                    'quality': self.levels[entry['level']][1],
+                    'reduced': entry['level'] > 0
+                }
+                for image, entry in self.images.items()
+            ]
+        }
+
+    def _measure(self):
+        """Prepare every slot at its current level and record the resulting size"""
+        self.processor.prepare_batch(self.slots)
+
+        for entry in self.images.values():
+            entry['measured'] = []
+
+        for image, box_width, box_height, fill in self.slots:
+            entry = self.images[image]
+            output = self.processor.prepare_image(image, box_width, box_height, fill)
+            metadata = probe_image(output)
+            if metadata is None:
+                continue
+            entry['measured'].append({
+                'box': (box_width, box_height, fill),
+                'output': output,
+                'level': entry['level'],
+                'bytes': image_size(output),
+                'pixels': metadata['width'] * metadata['height']
+            })
+
+    def _estimate(self, image: ImageRef, level: int) -> float:
+        """Estimate the bytes an image adds to the PDF at a level"""
+        metadata = probe_image(image)
+        if metadata is None:
+            return 0.0
+
+        dpi, quality = self.levels[level]
+        size = display_size(metadata)
+        is_jpeg = select_output_format(metadata) == 'jpg'
+        total = 0.0
+
+        for measured in self.images[image]['measured']:
+            box_width, box_height, fill = measured['box']
+            target = calculate_target_size(size, self.processor.box_to_pixels(box_width, box_height, dpi), fill)
+            factor = target[0] * target[1] / float(max(1, measured['pixels']))
+            if is_jpeg:
+                factor *= jpeg_size_factor(quality) / jpeg_size_factor(self.levels[measured['level']][1])
+            total += measured['bytes'] * min(1.0, factor)
+
+        return total * stream_overhead()
+
+    def _embedded_image_bytes(self) -> int:
+        """Bytes of the prepared images as written to the PDF, counting shared outputs once"""
+        outputs = {}
+        for entry in self.images.values():
+            for measured in entry['measured']:
+                outputs[measured['output']] = measured['bytes']
+        return int(sum(outputs.values()) * stream_overhead())
+
+    def _reduce(self):
+        """
+        Lower image levels one step at a time until the estimate fits
+
+        Each step goes to the image using the most bytes per square inch of page,
+        divided by its weight, so the primary photo is only reduced once the other
+        images have become several times smaller per area.
+        """
+        image_budget = self.budget - self.fixed_bytes
+        current = {image: self._estimate(image, entry['level']) for image, entry in self.images.items()}
+        total = sum(current.values())
+        lowest = len(self.levels) - 1
+
+        while total > image_budget:
+            candidates = [image for image, entry in self.images.items() if entry['level'] < lowest]
+            if not candidates:
+                break
+
+            image = max(candidates, key=lambda img: current[img] / max(1.0, self.images[img]['area'])
+                        / self.images[img]['weight'])
+            self.images[image]['level'] += 1
+            estimate = self._estimate(image, self.images[image]['level'])
+            total += estimate - current[image]
+            current[image] = estimate
+
+        self.estimated = int(self.fixed_bytes + total)
+
+        for image, entry in self.images.items():
+            dpi, quality = self.levels[entry['level']]
+            self.processor.set_image_level(image, dpi, quality)
+            if entry['level']:
+                logger.debug(f"Size budget: {image_name(image)} at {dpi} dpi, quality {quality}")
+
+        if self.estimated > self.budget:
+            logger.warning(f"PDF cannot be brought under {self.budget / MB:.2f} MB even at the lowest "
+                           f"image quality (estimated {self.estimated / MB:.2f} MB)")
+        else:
+            logger.info(f"Estimated PDF size {self.estimated / MB:.2f} MB for a {self.budget / MB:.2f} MB budget")
@@ -5,6 +5,181 @@ Use this to test individual modules
 
 import sys
 import os
+import re
+import time
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalTestServer:
+    """
+    Local stand-in for the Google Drive download endpoint
+    
+    Serves files from a dict at /files/<file_id>. Supports Range requests
+    unless disabled, answers HEAD requests with the size and type, and can
+    drop the connection part-way through a body, wait before answering, or
+    send a body very slowly. Error responses queued in errors, each a
+    (status, headers) pair, answer the next file requests before the files
+    are served. Image files are also served as thumbnails at
+    /thumbnails/<file_id>?sz=s<size>, like Drive's endpoint.
+    """
+    
+    def __init__(self, files, support_ranges=True, disconnects=0, disconnect_after=0, thumbnails=True,
+                 slow_starts=0, slow_start_delay=0, trickles=0, errors=None):
+        self.files = files
+        self.errors = list(errors or [])
+        self.slow_starts = slow_starts
+        self.slow_start_delay = slow_start_delay
+        self.trickles = trickles
+        self.support_ranges = support_ranges
+        self.thumbnails = thumbnails
+        self.thumbnail_requests = []
+        self.disconnects = disconnects
+        self.disconnect_after = disconnect_after
+        self.requests = []
+        self.head_requests = []
+        
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            
+            def do_GET(self):
+                server.handle(self)
+            
+            def do_HEAD(self):
+                server.handle_head(self)
+        
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/files/{{file_id}}"
+        self.thumbnail_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/thumbnails/{{file_id}}?sz=s{{size}}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    
+    def handle_head(self, request):
+        file_id = request.path.rsplit('/', 1)[-1]
+        self.head_requests.append(file_id)
+        
+        if file_id not in self.files:
+            request.send_response(404)
+            request.end_headers()
+            return
+        
+        data, content_type = self.files[file_id]
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+    
+    def handle_thumbnail(self, request):
+        import io
+        from PIL import Image
+        
+        match = re.match(r'/thumbnails/([^?]+)\?sz=s(\d+)', request.path)
+        file_id, size = match.group(1), int(match.group(2))
+        self.thumbnail_requests.append((file_id, size))
+        
+        if not self.thumbnails or file_id not in self.files or not self.files[file_id][1].startswith('image/'):
+            request.send_response(404)
+            request.end_headers()
+            return
+        
+        with Image.open(io.BytesIO(self.files[file_id][0])) as img:
+            img.thumbnail((size, size))
+            buffer = io.BytesIO()
+            img.convert('RGB').save(buffer, 'JPEG', quality=85)
+        
+        body = buffer.getvalue()
+        request.send_response(200)
+        request.send_header('Content-Type', 'image/jpeg')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+    
+    def handle(self, request):
+        if request.path.startswith('/thumbnails/'):
+            self.handle_thumbnail(request)
+            return
+        
+        file_id = request.path.rsplit('/', 1)[-1]
+        range_header = request.headers.get('Range', '')
+        self.requests.append((file_id, range_header))
+        
+        if file_id not in self.files:
+            request.send_response(404)
+            request.end_headers()
+            return
+        
+        if self.errors:
+            status, headers = self.errors.pop(0)
+            request.send_response(status)
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+        
+        if self.slow_starts > 0:
+            self.slow_starts -= 1
+            time.sleep(self.slow_start_delay)
+        
+        data, content_type = self.files[file_id]
+        start = 0
+        match = re.match(r'bytes=(\d+)-', range_header)
+        
+        if match and self.support_ranges:
+            start = int(match.group(1))
+            request.send_response(206)
+            request.send_header('Content-Range', f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            request.send_response(200)
+        
+        body = data[start:]
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        
+        if self.disconnects > 0:
+            # Send part of the body and drop the connection
+            self.disconnects -= 1
+            request.wfile.write(body[:self.disconnect_after])
+            request.wfile.flush()
+            request.close_connection = True
+            return
+        
+        try:
+            if self.trickles > 0:
+                # About 10 KB/s until the client gives up
+                self.trickles -= 1
+                for i in range(0, len(body), 1000):
+                    request.wfile.write(body[i:i + 1000])
+                    request.wfile.flush()
+                    time.sleep(0.1)
+                return
+            
+            request.wfile.write(body)
+        except ConnectionError:
+            # The client closed the connection (a hedged request that lost, or a stalled transfer)
+            request.close_connection = True
+
+
+def create_test_jpeg(size=(1200, 900)):
+    """Create JPEG bytes for download tests"""
+    import io
+    from PIL import Image
+    
+    buffer = io.BytesIO()
+    Image.effect_noise(size, 40).convert('RGB').save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
 
 
 def test_data_loader():
@@ -82,6 +257,1765 @@ def test_image_handler():
         traceback.print_exc()
 
 
+def test_resumable_download():
+    """Test resumable downloads against a local server with dropped connections"""
+    print("\n" + "="*60)
+    print("Testing Resumable Downloads")
+    print("="*60)
+    
+    try:
+        from image_handler import ImageHandler
+        from image_buffers import SpooledImage
+        
+        data = create_test_jpeg()
+        file_id = "resumable_test_file_0123456789abcdef"
+        
+        # Range-capable server that drops the first two transfers
+        with LocalTestServer({file_id: (data, 'image/jpeg')}, disconnects=2,
+                             disconnect_after=len(data) // 3) as server:
+            handler = ImageHandler(download_url=server.url, spool=False)
+            path = handler.download_drive_image(file_id, "resume")
+            
+            assert path, "download failed"
+            with open(path, 'rb') as f:
+                assert f.read() == data, "downloaded bytes differ"
+            assert server.requests[0][1] == '', "first request should not use Range"
+            resumed_at = int(server.requests[1][1][len('bytes='):-1])
+            assert 0 < resumed_at <= len(data) // 3, "second request did not resume"
+            assert not os.path.exists(os.path.join(handler.temp_dir, f"{file_id}.part"))
+            handler.cleanup()
+        print("✓ Resumed after dropped connections")
+        
+        # Server without Range support: every retry starts again from byte 0
+        with LocalTestServer({file_id: (data, 'image/jpeg')}, support_ranges=False, disconnects=1,
+                             disconnect_after=len(data) // 2) as server:
+            handler = ImageHandler(download_url=server.url, spool=False)
+            path = handler.download_drive_image(file_id, "fallback")
+            
+            assert path, "download failed"
+            with open(path, 'rb') as f:
+                assert f.read() == data, "downloaded bytes differ"
+            handler.cleanup()
+        print("✓ Fell back to a full download without Range support")
+        
+        # Spooled download: resumes into the in-memory buffer, nothing written to the temp folder
+        with LocalTestServer({file_id: (data, 'image/jpeg')}, disconnects=1,
+                             disconnect_after=len(data) // 3) as server:
+            handler = ImageHandler(download_url=server.url, spool=True)
+            image = handler.download_drive_image(file_id, "spooled")
+            
+            assert isinstance(image, SpooledImage) and image.path is None, "image was not kept in memory"
+            assert image.getvalue() == data, "spooled bytes differ"
+            assert not os.listdir(handler.temp_dir), "spooled download wrote to the temp folder"
+            handler.cleanup()
+        print("✓ Spooled download kept in memory")
+        
+        # Images over the memory limit move to the temp folder
+        spill_dir = tempfile.mkdtemp()
+        image = SpooledImage("large.jpg", spill_dir, max_memory_mb=len(data) / 2 / (1024 * 1024))
+        image.write(data[:len(data) // 4])
+        image.write(data[len(data) // 4:])
+        image.finish()
+        assert image.path and os.path.exists(image.path), "large image was not spilled to disk"
+        with image.open() as f:
+            assert f.read() == data, "spilled bytes differ"
+        
+        # The PDF builder leaves no stream open that would keep the spilled file from being deleted
+        from pdf_builder import PDFBuilder
+        in_memory = SpooledImage("small.jpg", spill_dir)
+        in_memory.write(create_test_jpeg((300, 200)))
+        in_memory.finish()
+        builder = PDFBuilder(os.path.join(spill_dir, "spooled.pdf"))
+        builder.add_images_section([image], [in_memory])
+        streams = list(builder.open_sources)
+        assert builder.generate()
+        assert len(streams) == 1 and all(stream.closed for stream in streams) and not builder.open_sources
+        assert [source for _, source in builder.embedded_images.values()][0] == image.path
+        os.remove(os.path.join(spill_dir, "spooled.pdf"))
+        in_memory.close()
+        
+        image.close()
+        assert not os.listdir(spill_dir), "spilled file was not removed"
+        os.rmdir(spill_dir)
+        print("✓ Large spooled image moved to the temp folder")
+        
+        print("\n✓ Resumable download test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Resumable download test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_prefetch_during_load():
+    """Test that images of the newest row are downloaded while the CSV loads"""
+    print("\n" + "="*60)
+    print("Testing Image Prefetch During CSV Load")
+    print("="*60)
+    
+    try:
+        import csv
+        import shutil
+        from concurrent.futures import wait
+        from unittest import mock
+        import report_generator
+        from report_generator import ReportGenerator
+        from constants import PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD, PREFETCH_SETTLE_SECONDS
+        
+        data = create_test_jpeg((400, 300))
+        files = {}
+        work_dir = tempfile.mkdtemp()
+        
+        def row_ids(name):
+            return [f"prefetch_{name}_{i}_0123456789abcdef" for i in range(3)]
+        
+        def write_csv(filename, rows):
+            csv_path = os.path.join(work_dir, filename)
+            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Date of Assessment', PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD])
+                for date, name in rows:
+                    ids = row_ids(name)
+                    files.update({file_id: (data, 'image/jpeg') for file_id in ids})
+                    writer.writerow([date, ids[0], ', '.join(ids[1:])])
+            return csv_path
+        
+        def create_generator(csv_path, server):
+            generator = ReportGenerator(csv_path)
+            generator.image_handler.download_url = server.url
+            generator.image_handler.thumbnail_url = None
+            if generator.image_processor and generator.image_processor.cache:
+                assert generator.image_processor.cache.cache_dir.startswith(work_dir)
+            return generator
+        
+        shuffled_csv = write_csv("shuffled.csv", [('2024/01/10', 'old'), ('2024/03/05', 'new'), ('2024/02/20', 'mid')])
+        sorted_csv = write_csv("sorted.csv", [(f"2024/{1 + i // 28:02d}/{1 + i % 28:02d}", f"day{i}")
+                                              for i in range(40)])
+        
+        # The failed-link and derivative caches must not touch the user's cache folder
+        with mock.patch.object(report_generator, 'IMAGE_CACHE_DIR', os.path.join(work_dir, "cache")):
+            with LocalTestServer(files) as server:
+                generator = create_generator(shuffled_csv, server)
+                generator._load_data()
+                assert generator.latest_data['Date of Assessment'] == '2024/03/05', "wrong entry selected"
+                
+                generator._download_images()
+                requested = [file_id for file_id, _ in server.requests]
+                
+                assert len(generator.primary_images) == 1 and len(generator.additional_images) == 2
+                assert all(file_id in requested for file_id in row_ids('new'))
+                assert not any('_mid_' in file_id for file_id in requested), "older row was prefetched"
+                assert len(requested) == len(set(requested)), "an image was downloaded twice"
+                generator.cleanup()
+            print("✓ Newest row's images downloaded once")
+            
+            # Every row of a date-sorted CSV is newer than the ones before it
+            with LocalTestServer(files) as server:
+                generator = create_generator(sorted_csv, server)
+                start = time.monotonic()
+                generator._load_data()
+                load_time = time.monotonic() - start
+                generator._download_images()
+                requested = [file_id for file_id, _ in server.requests]
+                
+                assert sorted(requested) == sorted(row_ids('day39')), requested
+                assert not server.head_requests, server.head_requests
+                assert load_time < PREFETCH_SETTLE_SECONDS * 5, load_time
+                generator.cleanup()
+            print(f"✓ Sorted CSV: {len(requested)} GETs and {len(server.head_requests)} HEADs "
+                  f"for the newest row only, loaded in {load_time:.2f}s")
+            
+            # A row that settles is prefetched; when a newer one replaces it, its transfers stop
+            with LocalTestServer(files, trickles=3) as server:
+                generator = create_generator(sorted_csv, server)
+                handler = generator.image_handler
+                handler.download_controller.for_url(server.url).limit = 8
+                generator._start_prefetching()
+                generator._note_candidate({PRIMARY_IMAGE_FIELD: row_ids('day0')[0],
+                                           ADDITIONAL_IMAGES_FIELD: ', '.join(row_ids('day0')[1:])})
+                deadline = time.monotonic() + 5
+                while len(server.requests) < 3 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                stale = [future for _, future, _ in handler.prefetch_futures]
+                assert len(stale) == 3 and not any(future.done() for future in stale)
+                
+                generator._note_candidate({PRIMARY_IMAGE_FIELD: row_ids('day1')[0],
+                                           ADDITIONAL_IMAGES_FIELD: ', '.join(row_ids('day1')[1:])})
+                done, _ = wait(stale, timeout=5)
+                generator._stop_prefetching()
+                
+                # Trickled in full, each transfer would take about 10 seconds
+                assert len(done) == 3 and all(future.result() is None for future in done)
+                assert not any(file_id in handler.downloaded_images or file_id in handler.failure_reasons
+                               for file_id in row_ids('day0'))
+                wait([future for _, future, _ in handler.prefetch_futures], timeout=5)
+                assert all(file_id in handler.downloaded_images for file_id in row_ids("day1"))
+                generator.cleanup()
+            print("✓ Settled row prefetched; transfers of a replaced row stopped without recording failures")
+        
+        shutil.rmtree(work_dir)
+        
+        print("\n✓ Prefetch test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Prefetch test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_download_planning():
+    """Test that sizes are looked up first, non-images skipped and the largest files started first"""
+    print("\n" + "="*60)
+    print("Testing Download Planning")
+    print("="*60)
+    
+    try:
+        from image_handler import ImageHandler
+        
+        files = {
+            "plan_small_0123456789abcdefghij": (create_test_jpeg((200, 150)), 'image/jpeg'),
+            "plan_large_0123456789abcdefghij": (create_test_jpeg((1600, 1200)), 'image/jpeg'),
+            "plan_document_0123456789abcdefg": (b'%PDF-1.4 not an image', 'application/pdf'),
+            "plan_medium_0123456789abcdefghi": (create_test_jpeg((800, 600)), 'image/jpeg'),
+        }
+        file_ids = list(files)
+        
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, plan_downloads=True)
+            urls = [server.url.format(file_id=file_id) for file_id in file_ids]
+            
+            order, skipped = handler.planner.plan(urls)
+            assert [file_ids[i] for i in order] == [file_ids[1], file_ids[3], file_ids[0]], "not largest first"
+            assert [file_ids[i] for i in skipped] == [file_ids[2]], "PDF link was not skipped"
+            print("✓ Ordered largest first, PDF link skipped")
+            
+            images = handler.process_image_links(', '.join(file_ids), "planned")
+            downloaded = [file_id for file_id, _ in server.requests]
+            
+            assert len(images) == 3, f"expected 3 images, got {len(images)}"
+            assert file_ids[2] not in downloaded, "PDF link was downloaded"
+            assert len(server.head_requests) == len(files), "sizes were looked up more than once"
+            assert [str(image).split('_')[1] for image in images] == ['1', '2', '4'], "results out of link order"
+            assert handler.get_download_stats()['skipped_non_images'] == 1
+            handler.cleanup()
+        print("✓ Images returned in link order, PDF never downloaded")
+        
+        # Two links are not worth a round trip before the first download
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, plan_downloads=True, thumbnail_url=None)
+            assert len(handler.process_image_links(', '.join([file_ids[0], file_ids[1]]), "pair")) == 2
+            assert not server.head_requests
+            
+            # Links already downloaded do not count towards the threshold
+            assert len(handler.process_image_links(', '.join(file_ids), "planned")) == 3
+            assert not server.head_requests, server.head_requests
+            handler.cleanup()
+        print("✓ Fields with fewer than 3 links to download are not looked up")
+        
+        # Without HEAD support every link is still downloaded, in link order
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, plan_downloads=True)
+            server.handle_head = lambda request: request.send_error(501)
+            urls = [server.url.format(file_id=file_id) for file_id in file_ids]
+            
+            order, skipped = handler.planner.plan(urls)
+            assert order == [0, 1, 2, 3] and not skipped
+            handler.cleanup()
+        print("✓ Kept link order when sizes are unavailable")
+        
+        print("\n✓ Download planning test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Download planning test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_bandwidth_limit():
+    """Test that parallel downloads share one bandwidth cap"""
+    print("\n" + "="*60)
+    print("Testing Download Bandwidth Limit")
+    print("="*60)
+    
+    try:
+        import time
+        from image_handler import ImageHandler
+        from download_control import BandwidthLimiter
+        
+        files = {f"bandwidth_{i}_0123456789abcdefghij": (create_test_jpeg((500, 400)), 'image/jpeg')
+                 for i in range(3)}
+        total = sum(len(data) for data, _ in files.values())
+        rate_kbps, burst_kb = 600, 16
+        
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, bandwidth_kbps=rate_kbps)
+            handler.download_controller.bandwidth = BandwidthLimiter(rate_kbps, burst_kb)
+            
+            start = time.monotonic()
+            images = handler.process_image_links(', '.join(files), "capped")
+            elapsed = time.monotonic() - start
+            stats = handler.get_download_stats()
+            handler.cleanup()
+        
+        minimum = (total - burst_kb * 1024) / (rate_kbps * 1024.0)
+        print(f"{total / 1024:.0f} KB in {elapsed:.2f}s, {stats['throughput_kbps']} KB/s "
+              f"(limit {rate_kbps} KB/s, waited {stats['bandwidth_wait_s']}s)")
+        assert len(images) == 3, "downloads failed"
+        assert stats['bytes_received'] == total
+        assert elapsed >= minimum * 0.95, f"finished in {elapsed:.2f}s, expected at least {minimum:.2f}s"
+        assert stats['throughput_kbps'] <= rate_kbps * 1.1, "throughput above the limit"
+        assert stats['bandwidth_wait_s'] > 0
+        print("✓ Combined throughput stayed at the limit")
+        
+        print("\n✓ Bandwidth limit test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Bandwidth limit test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_download_control():
+    """Test adaptive concurrency, Retry-After, jittered backoff and the circuit breaker"""
+    print("\n" + "="*60)
+    print("Testing Download Rate Control")
+    print("="*60)
+    
+    try:
+        import download_control
+        from download_control import HostController
+        from image_handler import ImageHandler
+        from exceptions import ImageDownloadError
+        
+        controller = HostController('example.com', initial_limit=2, max_limit=4)
+        for _ in range(20):
+            controller.record_success(0.1)
+        assert int(controller.limit) == 4, controller.limit
+        controller.record_throttle(retry_after=0)
+        assert int(controller.limit) == 2, controller.limit
+        print("✓ Concurrency grows by one per window of successes and halves when throttled")
+        
+        delays = [controller.backoff_delay(3) for _ in range(50)]
+        assert all(0 <= delay <= download_control.BACKOFF_BASE * 4 for delay in delays)
+        assert len(set(delays)) > 1, "backoff has no jitter"
+        
+        controller = HostController('example.com')
+        for _ in range(6):
+            controller.record_throttle(retry_after=0)
+        controller.record_success(0.1)
+        assert controller.consecutive_throttles == 0
+        backoff = download_control.BACKOFF_BASE
+        start = time.monotonic()
+        controller.record_throttle()
+        assert controller.blocked_until - start <= backoff + 0.1, "backoff kept growing after a success"
+        print("✓ Backoff is jittered and starts over after a success")
+        
+        ids = [f"control_{i}_0123456789abcdefghijklm" for i in range(4)]
+        files = {file_id: (create_test_jpeg((300, 200)), 'image/jpeg') for file_id in ids}
+        
+        with LocalTestServer(files, errors=[(429, {'Retry-After': '1'})]) as server:
+            handler = ImageHandler(download_url=server.url, plan_downloads=False, thumbnail_url=None)
+            controller = handler.download_controller.for_url(server.url)
+            start = time.monotonic()
+            assert handler.download_drive_image(ids[0], "throttled")
+            elapsed = time.monotonic() - start
+            print(f"429 with Retry-After: 1 -> downloaded after {elapsed:.2f}s")
+            assert elapsed >= 0.9, "Retry-After was not honoured"
+            assert controller.blocked_until >= start + 1.0
+            assert controller.stats['throttled'] == 1 and int(controller.limit) >= 1
+            handler.cleanup()
+        print("✓ Retry-After blocks the host before the retry")
+        
+        saved = (download_control.CIRCUIT_BREAKER_THRESHOLD, download_control.CIRCUIT_BREAKER_COOLDOWN,
+                 download_control.BACKOFF_BASE)
+        download_control.CIRCUIT_BREAKER_THRESHOLD = 3
+        download_control.CIRCUIT_BREAKER_COOLDOWN = 1
+        download_control.BACKOFF_BASE = 0.05
+        try:
+            with LocalTestServer(files, errors=[(503, {})] * 3) as server:
+                handler = ImageHandler(download_url=server.url, plan_downloads=False, thumbnail_url=None)
+                controller = handler.download_controller.for_url(server.url)
+                
+                assert handler.download_drive_image(ids[1], "failing") is None
+                assert controller.circuit_open_until > time.monotonic(), "circuit did not open"
+                assert controller.stats['circuit_trips'] == 1 and int(controller.limit) == 1
+                
+                requests_before = len(server.requests)
+                assert handler.download_drive_image(ids[2], "paused") is None
+                assert len(server.requests) == requests_before, "request sent while the circuit was open"
+                print("✓ Burst of 503s opens the circuit and pauses requests")
+                
+                time.sleep(1.1)
+                assert handler.download_drive_image(ids[3], "trial")
+                assert controller.circuit_open_until == 0 and not controller.half_open_trial
+                print("✓ Successful trial after the cooldown closes the circuit")
+                handler.cleanup()
+            
+            # A throttled trial request keeps the circuit open
+            controller = HostController('example.com')
+            controller.circuit_open_until = time.monotonic() - 0.1
+            controller.acquire()
+            assert controller.half_open_trial
+            controller.record_throttle(retry_after=0)
+            controller.release()
+            assert controller.circuit_open_until > time.monotonic()
+            try:
+                controller.acquire()
+                assert False, "request allowed after a throttled trial"
+            except ImageDownloadError:
+                pass
+            print("✓ Throttled trial request sends the circuit back to open")
+        finally:
+            (download_control.CIRCUIT_BREAKER_THRESHOLD, download_control.CIRCUIT_BREAKER_COOLDOWN,
+             download_control.BACKOFF_BASE) = saved
+        
+        print("\n✓ Download control test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Download control test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_hedged_downloads():
+    """Test that slow answers are hedged, stalled transfers restarted and latency percentiles reported"""
+    print("\n" + "="*60)
+    print("Testing Hedged Downloads and Stall Detection")
+    print("="*60)
+    
+    try:
+        from image_handler import ImageHandler
+        from image_buffers import image_size
+        from constants import HEDGE_MIN_SAMPLES
+        
+        ids = [f"hedge_{i}_0123456789abcdefghijklm" for i in range(HEDGE_MIN_SAMPLES + 3)]
+        files = {file_id: (create_test_jpeg((500, 400)), 'image/jpeg') for file_id in ids}
+        slow, crowded, stalled = ids[-3:]
+        
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, plan_downloads=False, thumbnail_url=None)
+            for file_id in ids[:HEDGE_MIN_SAMPLES]:
+                assert handler.download_drive_image(file_id, file_id)
+            
+            # The next request waits 2.5s before answering; the hedge goes out after about 1s
+            server.slow_starts, server.slow_start_delay = 1, 2.5
+            start = time.monotonic()
+            assert handler.download_drive_image(slow, "slow")
+            elapsed = time.monotonic() - start
+            stats = handler.get_download_stats()
+            print(f"Slow answer: downloaded in {elapsed:.2f}s, {stats['hedged_requests']} hedged")
+            assert elapsed < 2.5, "waited for the slow request"
+            assert stats['hedged_requests'] == 1 and stats['hedge_wins'] == 1
+            assert [file_id for file_id, _ in server.requests].count(slow) == 2
+            print("✓ Second request answered first and was used")
+            
+            # The second request held a slot of its own until the slow one answered
+            controller = handler.download_controller.for_url(server.url)
+            deadline = time.monotonic() + 5
+            while controller.active and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert controller.active == 0, controller.active
+            
+            # With every slot taken no second request is sent
+            controller.limit = 1
+            server.slow_starts, server.slow_start_delay = 1, 1.5
+            start = time.monotonic()
+            assert handler.download_drive_image(crowded, "crowded")
+            assert time.monotonic() - start >= 1.5
+            assert handler.get_download_stats()['hedged_requests'] == 1
+            assert [file_id for file_id, _ in server.requests].count(crowded) == 1
+            assert controller.active == 0
+            print("✓ Second request takes a free transfer slot, or is not sent")
+            
+            server.trickles = 1
+            handler.stall_min_kbps, handler.stall_window = 50, 0.5
+            assert handler.download_drive_image(stalled, "stalled")
+            stats = handler.get_download_stats()
+            ranges = [range_header for file_id, range_header in server.requests if file_id == stalled]
+            print(f"Stalled transfer: requests {ranges}, {stats['stalled_transfers']} stalls")
+            assert stats['stalled_transfers'] == 1
+            assert len(ranges) == 2 and ranges[0] == '' and ranges[1].startswith('bytes=')
+            assert image_size(handler.downloaded_images[stalled]) == len(files[stalled][0])
+            print("✓ Transfer below the speed floor was dropped and resumed")
+            
+            print(f"Download times: p50 {stats['download_time_p50_s']}s, p90 {stats['download_time_p90_s']}s, "
+                  f"p99 {stats['download_time_p99_s']}s")
+            assert stats['download_time_p50_s'] <= stats['download_time_p90_s'] <= stats['download_time_p99_s']
+            assert stats['download_time_p99_s'] >= 0.5
+            print("✓ Latency percentiles reported")
+            
+            handler.cleanup()
+        
+        print("\n✓ Hedged download test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Hedged download test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_image_sources():
+    """Test finding Drive files in a local folder, a ZIP archive and through a manifest"""
+    print("\n" + "="*60)
+    print("Testing Offline Image Sources")
+    print("="*60)
+    
+    try:
+        import shutil
+        import zipfile
+        from image_handler import ImageHandler
+        from image_buffers import SpooledImage
+        from image_sources import ImageSource, LocalMirrorSource, ZipArchiveSource, create_image_source
+        from exceptions import ConfigurationError
+        
+        named_id = "1BxiMVs0XRA5nFMdKvBdBZjgmUUqptlbs"
+        listed_id = "1CyjNWt1YSB6oGNeLwCeCakhnVVrqumct"
+        stem_id = "1DzkOXu2ZTC7pHOfMxDfDblioWWsrvndu"
+        files = {
+            f"takeout/IMG_2041_{named_id}.jpg": create_test_jpeg((320, 240)),
+            "takeout/photos/site plan.jpg": create_test_jpeg((330, 240)),
+            f"takeout/{stem_id}.jpg": create_test_jpeg((340, 240)),
+            "takeout/manifest.csv": f"id,name\n{listed_id},photos/site plan.jpg\n".encode('utf-8')
+        }
+        expected = {
+            named_id: files[f"takeout/IMG_2041_{named_id}.jpg"],
+            listed_id: files["takeout/photos/site plan.jpg"],
+            stem_id: files[f"takeout/{stem_id}.jpg"]
+        }
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            zip_path = os.path.join(work_dir, "takeout.zip")
+            with zipfile.ZipFile(zip_path, 'w') as archive:
+                for name, data in files.items():
+                    path = os.path.join(work_dir, name)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                    archive.writestr(name, data)
+            dest_dir = os.path.join(work_dir, "extracted")
+            os.makedirs(dest_dir)
+            
+            def read(image):
+                if isinstance(image, SpooledImage):
+                    return image.getvalue()
+                with open(image, 'rb') as f:
+                    return f.read()
+            
+            folder = create_image_source(os.path.join(work_dir, "takeout"))
+            assert isinstance(folder, LocalMirrorSource)
+            assert {file_id: read(folder.fetch(file_id, dest_dir)) for file_id in expected} == expected
+            assert folder.fetch("1MissingMissingMissingMissing0", dest_dir) is None
+            print("✓ Folder files found by ID in their name, as their name, and through the manifest")
+            
+            for spool in (False, True):
+                archive = ZipArchiveSource(zip_path, spool=spool)
+                images = {file_id: archive.fetch(file_id, dest_dir) for file_id in expected}
+                assert {file_id: read(image) for file_id, image in images.items()} == expected
+                assert all(isinstance(image, SpooledImage) == spool for image in images.values())
+                archive.close()
+                assert archive.fetch(named_id, dest_dir) is None and archive.archive is None
+            assert isinstance(create_image_source(zip_path), ZipArchiveSource)
+            print("✓ ZIP members read to files or memory; a closed archive finds nothing")
+            
+            with LocalTestServer({}) as server:
+                archive = create_image_source(zip_path)
+                handler = ImageHandler(download_url=server.url, sources=[archive], thumbnail_url=None)
+                try:
+                    assert read(handler.download_drive_image(listed_id, "offline")) == expected[listed_id]
+                    assert handler.offline_hits == 1 and not server.requests
+                finally:
+                    handler.cleanup()
+            print("✓ Handler takes a listed image from the archive without downloading it")
+            
+            try:
+                create_image_source(os.path.join(work_dir, "takeout", "manifest.csv"))
+                assert False, "a CSV file was accepted as a source"
+            except ConfigurationError:
+                pass
+            try:
+                ImageSource(work_dir)
+                assert False, "the abstract source was instantiated"
+            except TypeError:
+                pass
+            print("✓ Other files refused; sources must implement build_index and fetch")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Offline image source test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Offline image source test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_failed_link_cache():
+    """Test that dead links are remembered between runs and skipped until they expire"""
+    print("\n" + "="*60)
+    print("Testing Failed Link Cache")
+    print("="*60)
+    
+    try:
+        import shutil
+        from image_handler import ImageHandler
+        from link_cache import FailedLinkCache
+        
+        good, missing, page = ("link_good_0123456789abcdefghij", "link_missing_0123456789abcdefgh",
+                               "link_page_0123456789abcdefghij")
+        files = {
+            good: (create_test_jpeg((400, 300)), 'image/jpeg'),
+            page: (b'<html><body>Sign in to continue</body></html>', 'text/html')
+        }
+        links = ', '.join([good, missing, page])
+        work_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(work_dir, "failed_links.json")
+        
+        def run(**cache_options):
+            with LocalTestServer(files) as server:
+                handler = ImageHandler(download_url=server.url,
+                                       failed_links=FailedLinkCache(cache_path, **cache_options))
+                images = handler.process_image_links(links, "run")
+                stats = handler.get_download_stats()
+                unavailable = handler.unavailable_images
+                handler.cleanup()
+            return images, [file_id for file_id, _ in server.requests], stats, unavailable
+        
+        images, requested, _, unavailable = run()
+        assert len(images) == 1 and sorted(requested) == sorted([good, missing, page]), \
+            f"dead links were retried: {requested}"
+        assert [item['reason'] for item in unavailable] == ["HTTP 404", "link opens a web page, not an image"]
+        print("✓ 404 and HTML links failed once without retries")
+        
+        images, requested, stats, unavailable = run()
+        assert len(images) == 1 and requested == [good], f"dead links were requested again: {requested}"
+        assert stats['skipped_failed_links'] == 2 and len(unavailable) == 2
+        print("✓ Dead links skipped on the next run, still listed as unavailable")
+        
+        _, requested, _, _ = run(refresh=True)
+        assert missing in requested and page in requested, "refresh did not retry dead links"
+        _, requested, _, _ = run(ttl_hours=0)
+        assert missing in requested and page in requested, "expired entries were not retried"
+        print("✓ Dead links tried again on refresh and after the TTL")
+        
+        # Two runs sharing the file keep each other's failures
+        os.remove(cache_path)
+        first, second = FailedLinkCache(cache_path), FailedLinkCache(cache_path)
+        first.record(missing, "HTTP 404")
+        second.record(page, "link opens a web page, not an image")
+        first.record(good, "HTTP 403")
+        second.forget(missing)
+        assert sorted(FailedLinkCache(cache_path).entries) == sorted([good, page])
+        assert sorted(second.entries) == sorted([good, page]) and second.peek(good)
+        print("✓ Concurrent runs merge their failures instead of overwriting them")
+        
+        shutil.rmtree(work_dir)
+        
+        print("\n✓ Failed link cache test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Failed link cache test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_thumbnail_download():
+    """Test that grid images are fetched as thumbnails sized for their slot"""
+    print("\n" + "="*60)
+    print("Testing Thumbnail Downloads")
+    print("="*60)
+    
+    try:
+        from image_handler import ImageHandler, thumbnail_size_for_slot
+        from image_metadata import probe_image
+        from constants import ADDITIONAL_IMAGE_WIDTH, ADDITIONAL_IMAGE_HEIGHT
+        
+        original = create_test_jpeg((3000, 2000))
+        files = {
+            "thumb_photo_0123456789abcdefghij": (original, 'image/jpeg'),
+            "thumb_small_0123456789abcdefghij": (create_test_jpeg((300, 200)), 'image/jpeg'),
+        }
+        size = thumbnail_size_for_slot(ADDITIONAL_IMAGE_WIDTH * 72, ADDITIONAL_IMAGE_HEIGHT * 72, fill=True)
+        assert size == 900, f"unexpected thumbnail size {size}"
+        
+        with LocalTestServer(files) as server:
+            handler = ImageHandler(download_url=server.url, thumbnail_url=server.thumbnail_url)
+            images = handler.process_image_links(', '.join(files), "grid", thumbnail_size=size)
+            downloaded = [file_id for file_id, _ in server.requests]
+            
+            photo = probe_image(images[0])
+            assert max(photo['width'], photo['height']) == size, "thumbnail has the wrong size"
+            assert "thumb_photo_0123456789abcdefghij" not in downloaded, "original was downloaded"
+            print(f"✓ {len(original) / 1024:.0f} KB original fetched as a {size}px thumbnail")
+            
+            # The server cannot enlarge a small original, so the original is used
+            assert downloaded == ["thumb_small_0123456789abcdefghij"], "small image did not fall back"
+            assert handler.get_download_stats()['thumbnail_fallbacks'] == 1
+            print("✓ Fell back to the original when the thumbnail was too small")
+            
+            # The primary photo asks for the original
+            primary = handler.process_image_links("thumb_photo_0123456789abcdefghij", "primary")
+            assert probe_image(primary[0])['width'] == 3000, "original not used for the full-size slot"
+            handler.cleanup()
+        print("✓ Original downloaded for a slot that needs full resolution")
+        
+        with LocalTestServer(files, thumbnails=False) as server:
+            handler = ImageHandler(download_url=server.url, thumbnail_url=server.thumbnail_url)
+            images = handler.process_image_links(', '.join(files), "grid", thumbnail_size=size)
+            assert len(images) == 2 and len(server.requests) == 2, "no fallback without a thumbnail service"
+            handler.cleanup()
+        print("✓ Originals downloaded when no thumbnails are available")
+        
+        print("\n✓ Thumbnail download test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Thumbnail download test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def _shared_cache_worker(download_url, cache_dir, file_id, start, results):
+    """Download one file through the shared cache (runs in a separate process)"""
+    from image_handler import ImageHandler
+    from shared_cache import SharedImageCache
+    from image_buffers import image_size
+    
+    handler = ImageHandler(download_url=download_url, shared_cache=SharedImageCache(cache_dir))
+    start.wait()
+    image = handler.download_drive_image(file_id, "shared")
+    results.put(image_size(image) if image else 0)
+    handler.cleanup()
+
+
+def test_shared_cache():
+    """Test that processes sharing a cache download each file once"""
+    print("\n" + "="*60)
+    print("Testing Shared Image Cache")
+    print("="*60)
+    
+    try:
+        import multiprocessing
+        from shared_cache import SharedImageCache, FileLock
+        
+        data = create_test_jpeg((1200, 900))
+        file_id = "shared_photo_0123456789abcdefghij"
+        cache_dir = tempfile.mkdtemp()
+        
+        with LocalTestServer({file_id: (data, 'image/jpeg')}) as server:
+            start, results = multiprocessing.Event(), multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=_shared_cache_worker,
+                                               args=(server.url, cache_dir, file_id, start, results))
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            start.set()
+            sizes = [results.get(timeout=60) for _ in workers]
+            for worker in workers:
+                worker.join(timeout=60)
+        
+        downloads = [request for request in server.requests if request[0] == file_id]
+        assert sizes == [len(data)] * 3, f"processes got different images: {sizes}"
+        assert len(downloads) == 1, f"file downloaded {len(downloads)} times"
+        print("✓ Three processes, one download")
+        
+        # A partial file from a crashed writer is removed once nobody holds its lock
+        orphan = os.path.join(cache_dir, f"{file_id}.crashed.tmp")
+        open(orphan, 'wb').close()
+        lock = FileLock(os.path.join(cache_dir, 'locks', f"{file_id}.lock"))
+        lock.acquire()
+        SharedImageCache(cache_dir)
+        assert os.path.exists(orphan), "file being written by a live process was removed"
+        lock.release()
+        cache = SharedImageCache(cache_dir)
+        assert not os.path.exists(orphan), "orphaned partial file was kept"
+        assert cache.contains(file_id)
+        print("✓ Orphaned partial files cleaned up, files in use left alone")
+        
+        # Thumbnails are written under their file ID's lock, which must protect their partial file
+        import shared_cache
+        thumbnail_key = f"{file_id}_s320"
+        copy_image = shared_cache.copy_image
+        kept = []
+        
+        def copy_while_another_process_starts(image, dest):
+            copy_image(image, dest)
+            SharedImageCache(cache_dir)
+            kept.append(os.path.exists(dest))
+        
+        shared_cache.copy_image = copy_while_another_process_starts
+        try:
+            with cache.lock(file_id):
+                cache.put(thumbnail_key, cache.get(file_id), lock_key=file_id)
+        finally:
+            shared_cache.copy_image = copy_image
+        assert kept == [True], "thumbnail being written was removed as an orphan"
+        assert cache.contains(thumbnail_key)
+        print("✓ Thumbnail partial files protected by their file's lock")
+        
+        import shutil
+        shutil.rmtree(cache_dir)
+        
+        print("\n✓ Shared cache test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Shared cache test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_cache_warming():
+    """Test that every image of a CSV is cached once and an interrupted run resumes"""
+    print("\n" + "="*60)
+    print("Testing Cache Warming")
+    print("="*60)
+    
+    try:
+        import csv
+        import shutil
+        from unittest import mock
+        import cache_warmer
+        from cache_warmer import CacheWarmer
+        from constants import PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD
+        from exceptions import ReportGeneratorError
+        
+        ids = [f"warm_{i}_0123456789abcdefghijklm" for i in range(6)]
+        files = {file_id: (create_test_jpeg((300, 200)), 'image/jpeg') for file_id in ids}
+        dead = "warm_dead_0123456789abcdefghijk"
+        
+        work_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(work_dir, "cache")
+        csv_path = os.path.join(work_dir, "assessments.csv")
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Date of Assessment', PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD])
+            writer.writerow(['2024/01/10', ids[0], ', '.join(ids[1:4])])
+            writer.writerow(['2024/03/05', ids[4], ', '.join([ids[1], ids[5], dead])])
+        
+        def run(on_progress=None, image_sources=None):
+            warmer = CacheWarmer(csv_path, cache_dir, image_sources=image_sources)
+            warmer.image_handler.download_url = server.url
+            warmer.image_handler.failed_links = None
+            try:
+                return warmer.warm(on_progress)
+            finally:
+                warmer.cleanup()
+        
+        def interrupt(done, total, file_id, ok):
+            raise KeyboardInterrupt
+        
+        # One download at a time, so the interruption leaves work for the second run
+        concurrency = cache_warmer.DOWNLOAD_MAX_CONCURRENCY
+        cache_warmer.DOWNLOAD_MAX_CONCURRENCY = 1
+        try:
+            with LocalTestServer(files) as server:
+                try:
+                    run(interrupt)
+                    assert False, "interruption was not raised"
+                except KeyboardInterrupt:
+                    pass
+                first_run = len(server.requests)
+                
+                stats = run()
+        finally:
+            cache_warmer.DOWNLOAD_MAX_CONCURRENCY = concurrency
+            downloads = [file_id for file_id, _ in server.requests if file_id != dead]
+        
+        print(f"Interrupted after {first_run} requests, resumed with {stats}")
+        assert stats['total'] == 7 and stats['failed'] == 1
+        assert stats['downloaded'] > 0, "nothing was left for the resumed run"
+        assert stats['already_cached'] >= 1 and stats['already_cached'] + stats['downloaded'] == 6
+        assert sorted(downloads) == sorted(ids), "an image was downloaded twice or not at all"
+        assert all(os.path.exists(os.path.join(cache_dir, f"{file_id}.jpg")) for file_id in ids)
+        print("✓ All images cached once across an interrupted and a resumed run")
+        
+        # Images already downloaded by hand are copied into the cache and counted apart
+        local_id = "warm_local_0123456789abcdefghi"
+        source_dir = os.path.join(work_dir, "takeout")
+        os.makedirs(source_dir)
+        with open(os.path.join(source_dir, f"{local_id}.jpg"), 'wb') as f:
+            f.write(create_test_jpeg((300, 200)))
+        with open(csv_path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(['2024/04/01', local_id, ''])
+        
+        with LocalTestServer(files) as server:
+            stats = run(image_sources=[source_dir])
+            assert [file_id for file_id, _ in server.requests] == [dead], "an image was downloaded again"
+        assert stats['copied'] == 1 and stats['downloaded'] == 0 and stats['already_cached'] == 6, stats
+        assert os.path.exists(os.path.join(cache_dir, f"{local_id}.jpg")), "source image not copied into the cache"
+        print("✓ Images from a source folder copied into the cache")
+        
+        # Errors end the command with a message and a failing exit code
+        import main
+        with mock.patch.object(main, 'CacheWarmer', side_effect=ReportGeneratorError("cache folder is read-only")):
+            try:
+                main.warm_cache([csv_path, '--cache-dir', cache_dir])
+                assert False, "warm-cache did not exit"
+            except SystemExit as e:
+                assert e.code == 1
+        print("✓ warm-cache exits with status 1 on errors")
+        
+        shutil.rmtree(work_dir)
+        
+        print("\n✓ Cache warming test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Cache warming test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_image_export():
+    """Test that images are exported under content names, linked where possible and not exported twice"""
+    print("\n" + "="*60)
+    print("Testing Image Export")
+    print("="*60)
+    
+    try:
+        import shutil
+        from image_buffers import SpooledImage
+        from image_export import export_images, export_name
+        
+        work_dir = tempfile.mkdtemp()
+        output_dir = os.path.join(work_dir, "export")
+        
+        on_disk = os.path.join(work_dir, "photo.jpg")
+        with open(on_disk, 'wb') as f:
+            f.write(create_test_jpeg((400, 300)))
+        in_memory = SpooledImage("other.jpg", work_dir)
+        in_memory.write(create_test_jpeg((200, 100)))
+        in_memory.finish()
+        
+        exported, methods = export_images([on_disk, in_memory], output_dir, "Site")
+        print(f"First export: {methods}")
+        assert sorted(os.listdir(output_dir)) == sorted([export_name(on_disk, "Site"), export_name(in_memory, "Site")])
+        assert methods.get('write') == 1 and sum(methods.values()) == 2
+        with open(exported[on_disk], 'rb') as a, open(on_disk, 'rb') as b:
+            assert a.read() == b.read()
+        if methods.get('hardlink'):
+            assert os.path.samefile(exported[on_disk], on_disk)
+        print("✓ Exported files have content-addressed names and identical contents")
+        
+        _, methods = export_images([on_disk, in_memory], output_dir, "Site")
+        assert methods == {'existing': 2}, methods
+        print("✓ Exporting again leaves existing files alone")
+        
+        copy_dir = os.path.join(work_dir, "copies")
+        _, methods = export_images([on_disk], copy_dir, "Site", link_mode='copy')
+        assert methods == {'copy': 1}
+        assert not os.path.samefile(os.path.join(copy_dir, export_name(on_disk, "Site")), on_disk)
+        assert not any(name.endswith('.tmp') for name in os.listdir(copy_dir))
+        print("✓ Copy mode makes independent files")
+        
+        in_memory.close()
+        shutil.rmtree(work_dir)
+        
+        print("\n✓ Image export test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Image export test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_image_preprocessing():
+    """Test that images are resampled to their slot and turned upright"""
+    print("\n" + "="*60)
+    print("Testing Image Preprocessing")
+    print("="*60)
+    
+    try:
+        import shutil
+        from unittest import mock
+        from PIL import Image as PILImage
+        import image_processor
+        from image_processor import ImageProcessor, calculate_target_size
+        from image_metadata import EXIF_ORIENTATION_TAG
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            photo_path = os.path.join(work_dir, "photo.jpg")
+            with open(photo_path, 'wb') as f:
+                f.write(create_test_jpeg((2400, 1800)))
+            
+            processor = ImageProcessor(work_dir, dpi=150, workers=1)
+            box_px = processor.box_to_pixels(200, 150)
+            expected = calculate_target_size((2400, 1800), box_px)
+            output = processor.prepare_image(photo_path, 200, 150)
+            assert output != photo_path
+            with PILImage.open(output) as img:
+                assert img.size == expected and img.size[0] <= box_px[0], (img.size, box_px)
+            assert processor.get_stats()['images_resampled'] == 1
+            print(f"✓ 2400x1800 photo resampled to {expected} for a {box_px} slot at 150 DPI")
+            
+            # A downsized copy is used even when it is no smaller than the original file
+            with mock.patch.object(image_processor, 'image_size', lambda image: 0):
+                output = ImageProcessor(work_dir, dpi=150, workers=1).prepare_image(photo_path, 200, 150)
+                assert output != photo_path
+                with PILImage.open(output) as img:
+                    assert img.size == expected, img.size
+                
+                # Only a copy at the original size falls back to the original
+                processor = ImageProcessor(work_dir, workers=1)
+                processor.set_image_level(photo_path, processor.dpi, processor.quality - 20)
+                assert processor.prepare_image(photo_path, 2000, 1500) == photo_path
+            print("✓ Original kept only when a recompressed copy at the same size is no smaller")
+            
+            rotated_path = os.path.join(work_dir, "rotated.jpg")
+            exif = PILImage.Exif()
+            exif[EXIF_ORIENTATION_TAG] = 6
+            PILImage.effect_noise((300, 200), 40).convert('RGB').save(rotated_path, 'JPEG', exif=exif)
+            
+            output = ImageProcessor(work_dir, workers=1).prepare_image(rotated_path, 2000, 2000)
+            assert output != rotated_path
+            with PILImage.open(output) as img:
+                assert img.size == (200, 300), img.size
+                assert img.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1
+            print("✓ Photo with EXIF orientation 6 stored upright as 200x300")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Image preprocessing test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Image preprocessing test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_derivative_cache():
+    """Test that rendered derivatives are reused and evicted least recently used first"""
+    print("\n" + "="*60)
+    print("Testing Derivative Cache")
+    print("="*60)
+    
+    try:
+        import time
+        import shutil
+        from image_cache import DerivativeCache
+        from image_processor import ImageProcessor
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(work_dir, "cache")
+            photo_path = os.path.join(work_dir, "photo.jpg")
+            with open(photo_path, 'wb') as f:
+                f.write(create_test_jpeg((2400, 1800)))
+            
+            processor = ImageProcessor(work_dir, workers=1, cache=DerivativeCache(cache_dir))
+            first = processor.prepare_image(photo_path, 200, 150)
+            assert processor.get_stats()['cache_misses'] == 1 and processor.get_stats()['cache_hits'] == 0
+            
+            # A later run finds the derivative without rendering it again
+            processor = ImageProcessor(work_dir, workers=1, cache=DerivativeCache(cache_dir))
+            processor._render_jobs = lambda jobs: [AssertionError("rendered again")] * len(jobs)
+            assert processor.prepare_image(photo_path, 200, 150) == first
+            assert processor.get_stats()['cache_hits'] == 1
+            del processor._render_jobs
+            assert processor.prepare_image(photo_path, 100, 75) not in (first, photo_path)
+            assert processor.get_stats()['cache_misses'] == 1
+            print("✓ Derivative rendered once, found by the next run, other sizes missed")
+            
+            # Room for two 40 KB entries
+            cache_dir = os.path.join(work_dir, "lru")
+            cache = DerivativeCache(cache_dir, max_size_mb=0.08)
+            for key in ('a.jpg', 'b.jpg'):
+                cache.put(key, b'x' * 40000)
+            now = time.time()
+            os.utime(os.path.join(cache_dir, 'a.jpg'), (now - 300, now - 300))
+            os.utime(os.path.join(cache_dir, 'b.jpg'), (now - 200, now - 200))
+            
+            # A new run uses the oldest entry, which pins it for the report being built
+            cache = DerivativeCache(cache_dir, max_size_mb=0.08)
+            assert cache.get('a.jpg') and cache.get('missing.jpg') is None
+            cache.put('c.jpg', b'x' * 40000)
+            assert sorted(os.listdir(cache_dir)) == ['a.jpg', 'c.jpg'], os.listdir(cache_dir)
+            assert cache.get_stats()['entries'] == 2 and (cache.hits, cache.misses) == (1, 1)
+            
+            # Pinned entries stay even when nothing else can be evicted
+            cache.put('d.jpg', b'x' * 40000)
+            assert sorted(os.listdir(cache_dir)) == ['a.jpg', 'c.jpg', 'd.jpg'], os.listdir(cache_dir)
+            
+            # Otherwise the oldest go first
+            os.utime(os.path.join(cache_dir, 'c.jpg'), (now - 100, now - 100))
+            cache = DerivativeCache(cache_dir, max_size_mb=0.08)
+            cache.put('e.jpg', b'x' * 40000)
+            assert sorted(os.listdir(cache_dir)) == ['d.jpg', 'e.jpg'], os.listdir(cache_dir)
+            print("✓ Least recently used unpinned entries evicted, pinned ones kept over the limit")
+            
+            # Forgotten images unpin their derivatives, unless a duplicate still draws it
+            cache = DerivativeCache(os.path.join(work_dir, "release"))
+            processor = ImageProcessor(work_dir, workers=1, cache=cache)
+            copy_path = os.path.join(work_dir, "copy.jpg")
+            shutil.copy(photo_path, copy_path)
+            processor.prepare_batch([(photo_path, 200, 150, False), (copy_path, 200, 150, False)])
+            derivative = os.path.basename(processor.prepare_image(photo_path, 200, 150))
+            processor.forget_images([photo_path])
+            assert cache.pinned == {derivative}
+            processor.forget_images([copy_path])
+            assert not cache.pinned
+            print("✓ Derivatives unpinned once no image drawn needs them")
+            
+            # Partial files of a process that stopped while writing are removed, recent ones kept
+            stale = os.path.join(cache_dir, "stale.tmp")
+            recent = os.path.join(cache_dir, "recent.tmp")
+            for path in (stale, recent):
+                with open(path, 'wb') as f:
+                    f.write(b'partial')
+            os.utime(stale, (now - 7200, now - 7200))
+            cache = DerivativeCache(cache_dir, max_size_mb=0.08)
+            assert not os.path.exists(stale) and os.path.exists(recent)
+            assert sorted(cache.entries) == ['d.jpg', 'e.jpg']
+            print("✓ Stale partial files removed when the cache is opened")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Derivative cache test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Derivative cache test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_parallel_preprocessing():
+    """Test that worker processes render the same images as the main thread"""
+    print("\n" + "="*60)
+    print("Testing Parallel Preprocessing")
+    print("="*60)
+    
+    try:
+        import shutil
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+        from image_processor import ImageProcessor
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            batch = []
+            for i in range(3):
+                path = os.path.join(work_dir, f"photo_{i}.jpg")
+                with open(path, 'wb') as f:
+                    f.write(create_test_jpeg((1600 + 100 * i, 1200)))
+                batch.append((path, 200, 150, i == 2))
+            
+            def rendered(processor):
+                processor.prepare_batch(batch)
+                outputs = [processor.prepare_image(*image) for image in batch]
+                assert all(output not in (None, image[0]) for output, image in zip(outputs, batch))
+                contents = []
+                for output in outputs:
+                    with open(output, 'rb') as f:
+                        contents.append(f.read())
+                return contents
+            
+            def output_dir(name):
+                path = os.path.join(work_dir, name)
+                os.makedirs(path)
+                return path
+            
+            inline = rendered(ImageProcessor(output_dir("inline"), workers=1))
+            processor = ImageProcessor(output_dir("pool"), workers=2)
+            try:
+                assert rendered(processor) == inline
+                assert processor._pool is not None
+            finally:
+                processor.close()
+            print("✓ Worker pool output byte-identical to inline rendering")
+            
+            class BrokenPool:
+                def submit(self, *args, **kwargs):
+                    future = Future()
+                    future.set_exception(BrokenProcessPool("worker killed"))
+                    return future
+                
+                def shutdown(self, wait=True):
+                    pass
+            
+            processor = ImageProcessor(output_dir("broken"), workers=2)
+            processor._pool = BrokenPool()
+            assert rendered(processor) == inline
+            assert processor._pool is None
+            print("✓ Broken worker pool falls back to rendering on the main thread")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Parallel preprocessing test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Parallel preprocessing test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_header_probes():
+    """Test that each image header is read once from download to PDF"""
+    print("\n" + "="*60)
+    print("Testing Image Header Probes")
+    print("="*60)
+    
+    try:
+        import shutil
+        from image_handler import ImageHandler
+        from image_processor import ImageProcessor
+        from image_metadata import metadata_cache
+        from pdf_builder import PDFBuilder
+        
+        files = {f"probe_test_{i}_0123456789abcdef": (create_test_jpeg((1600, 1200 - 100 * i)), 'image/jpeg')
+                 for i in range(3)}
+        work_dir = tempfile.mkdtemp()
+        try:
+            for processor in (None, ImageProcessor(work_dir, workers=1)):
+                with LocalTestServer(files) as server:
+                    handler = ImageHandler(download_url=server.url, thumbnail_url=None)
+                    try:
+                        probes = metadata_cache.probes
+                        images = [handler.download_drive_image(file_id, "probe") for file_id in files]
+                        assert all(images), images
+                        
+                        builder = PDFBuilder(os.path.join(work_dir, "probes.pdf"), processor)
+                        builder.add_images_section(images[:1], images[1:])
+                        assert builder.generate()
+                        assert metadata_cache.probes - probes == len(files), metadata_cache.probes - probes
+                    finally:
+                        handler.cleanup()
+                mode = "resampled" if processor else "embedded as downloaded"
+                print(f"✓ {len(files)} images {mode}, each header read once")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Header probe test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Header probe test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_image_deduplication():
+    """Test that identical images are embedded in the PDF only once"""
+    print("\n" + "="*60)
+    print("Testing Image Deduplication")
+    print("="*60)
+    
+    try:
+        from pdf_builder import PDFBuilder
+        from image_buffers import SpooledImage
+        
+        data = create_test_jpeg((800, 600))
+        work_dir = tempfile.mkdtemp()
+        paths = []
+        for name in ("photo.jpg", "same_photo_other_id.jpg"):
+            paths.append(os.path.join(work_dir, name))
+            with open(paths[-1], 'wb') as f:
+                f.write(data)
+        spooled = SpooledImage("spooled_copy.jpg", work_dir)
+        spooled.write(data)
+        spooled.finish()
+        
+        output_path = os.path.join(work_dir, "dedup.pdf")
+        builder = PDFBuilder(output_path)
+        builder.add_images_section(paths[:1], [paths[1], spooled, paths[0]])
+        assert builder.generate(), "PDF generation failed"
+        
+        with open(output_path, 'rb') as f:
+            image_objects = f.read().count(b'/Subtype /Image')
+        assert image_objects == 1, f"expected 1 image object, found {image_objects}"
+        assert builder.stats['duplicate_images'] == 3
+        print("✓ Four copies of one photo embedded as a single image")
+        
+        spooled.close()
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+        
+        print("\n✓ Deduplication test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Deduplication test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_bounded_decoding():
+    """Test that oversize images are decoded reduced, in strips, or in a separate process"""
+    print("\n" + "="*60)
+    print("Testing Bounded-Memory Decoding")
+    print("="*60)
+    
+    try:
+        import io
+        import shutil
+        import functools
+        from unittest import mock
+        from PIL import Image as PILImage, ImageChops, ImageOps
+        from image_processor import ImageProcessor, decode_bounded, decode_isolated
+        from contact_sheet import load_thumbnail
+        from exceptions import ImageTooLargeError
+        
+        big = PILImage.radial_gradient('L').resize((3000, 2000)).convert('RGB')
+        
+        def encoded(image_format):
+            buffer = io.BytesIO()
+            big.save(buffer, format=image_format)
+            return io.BytesIO(buffer.getvalue())
+        
+        # 3000x2000 takes about 23 MB decoded; allow 4 MB
+        with decode_bounded(encoded('JPEG'), (300, 200), max_memory_mb=4) as img:
+            assert 300 <= img.width < 3000 and 200 <= img.height < 2000
+            print(f"✓ JPEG decoded in draft mode at {img.size}")
+        
+        for image_format in ('TIFF', 'BMP'):
+            with decode_bounded(encoded(image_format), (300, 200), max_memory_mb=4) as img:
+                difference = ImageChops.difference(img, big.reduce(10))
+                assert img.size == (300, 200)
+                assert max(high for _, high in difference.getextrema()) == 0
+        print("✓ Uncompressed TIFF and BMP decoded a strip at a time, same pixels as a full decode")
+        
+        try:
+            decode_bounded(encoded('PNG'), (300, 200), max_memory_mb=4)
+            assert False, "oversize PNG was decoded"
+        except ImageTooLargeError:
+            pass
+        print("✓ PNG that cannot be decoded within the limit is refused")
+        
+        work_dir = tempfile.mkdtemp()
+        png_path = os.path.join(work_dir, "scan.png")
+        big.save(png_path)
+        processor = ImageProcessor(work_dir, workers=1, max_memory_mb=4)
+        output = processor.prepare_image(png_path, 200, 150)
+        assert output not in (None, png_path), "oversize PNG was not resampled"
+        assert processor.get_stats()['images_decoded_separately'] == 1
+        with PILImage.open(output) as img:
+            difference = ImageChops.difference(img.convert('RGB'), big.resize(img.size))
+            assert img.width < 3000 and max(high for _, high in difference.getextrema()) < 16
+        print("✓ PNG over the processor's limit decoded in a separate process and resampled")
+        
+        # Rotated scans are reduced to at least the target size on their stored axes
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        rotated_path = os.path.join(work_dir, "rotated.png")
+        big.save(rotated_path, exif=exif)
+        with decode_isolated(rotated_path, (200, 300)) as img:
+            assert img.size == (300, 200), img.size
+            assert ImageOps.exif_transpose(img).size == (200, 300)
+        print("✓ Separate decode keeps the orientation of the original")
+        
+        # An image too large for the separate process as well is embedded as it is
+        try:
+            decode_isolated(png_path, (300, 200), max_memory_mb=20)
+            assert False, "PNG decoded over the separate process's cap"
+        except ImageTooLargeError:
+            pass
+        with mock.patch('image_processor.DECODE_ISOLATED_MAX_MEMORY_MB', 20):
+            processor = ImageProcessor(work_dir, workers=1, max_memory_mb=4)
+            assert processor.prepare_image(png_path, 200, 150) == png_path
+        print("✓ PNG over both limits still embedded, as the original")
+        
+        with mock.patch('contact_sheet.decode_bounded', functools.partial(decode_bounded, max_memory_mb=4)):
+            with load_thumbnail(png_path, (150, 100)) as img:
+                assert img.size == (150, 100)
+        print("✓ Contact sheet thumbnail of an oversize PNG")
+        
+        shutil.rmtree(work_dir)
+        
+        print("\n✓ Bounded-memory decoding test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Bounded-memory decoding test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_size_budget():
+    """Test that image quality is lowered until the PDF fits its size budget"""
+    print("\n" + "="*60)
+    print("Testing PDF Size Budget")
+    print("="*60)
+    
+    try:
+        from pdf_builder import PDFBuilder, image_slots
+        from image_processor import ImageProcessor
+        from size_budget import SizeBudgetPlanner, estimate_text_bytes
+        
+        work_dir = tempfile.mkdtemp()
+        images = []
+        for i in range(4):
+            images.append(os.path.join(work_dir, f"photo_{i+1}.jpg"))
+            with open(images[-1], 'wb') as f:
+                f.write(create_test_jpeg((1600, 1200)))
+        
+        output_path = os.path.join(work_dir, "budget.pdf")
+        processor = ImageProcessor(work_dir, workers=1)
+        
+        # Unconstrained size for reference
+        builder = PDFBuilder(output_path, processor)
+        builder.add_images_section(images[:1], images[1:])
+        builder.generate()
+        full_size = os.path.getsize(output_path)
+        
+        budget_mb = full_size * 0.5 / (1024 * 1024)
+        planner = SizeBudgetPlanner(processor, budget_mb)
+        planner.allocate(image_slots(images[:1], images[1:]), images[:1], estimate_text_bytes([]))
+        while True:
+            builder = PDFBuilder(output_path, processor)
+            builder.add_images_section(images[:1], images[1:])
+            builder.generate()
+            if not planner.needs_rebuild(output_path):
+                break
+        
+        report = planner.get_report()
+        levels = {image['image']: (image['dpi'], image['quality']) for image in report['images']}
+        print(f"Full size {full_size / 1024:.0f} KB, budget {budget_mb * 1024:.0f} KB, "
+              f"achieved {os.path.getsize(output_path) / 1024:.0f} KB")
+        assert report['within_budget'] and os.path.getsize(output_path) <= budget_mb * 1024 * 1024
+        assert all(levels["photo_1.jpg"] >= level for level in levels.values()), "primary photo was reduced first"
+        assert any(image['reduced'] for image in report['images'])
+        print("✓ PDF fits the budget, primary photo kept the best quality")
+        
+        processor.close()
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+        
+        print("\n✓ Size budget test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Size budget test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_contact_sheets():
+    """Test that many additional images are composited onto contact sheets"""
+    print("\n" + "="*60)
+    print("Testing Contact Sheets")
+    print("="*60)
+    
+    try:
+        import pdf_builder
+        from pdf_builder import PDFBuilder
+        
+        work_dir = tempfile.mkdtemp()
+        images = []
+        for i in range(30):
+            images.append(os.path.join(work_dir, f"photo_{i+1}.jpg"))
+            with open(images[-1], 'wb') as f:
+                f.write(create_test_jpeg((640 + i, 480)))
+        
+        output_path = os.path.join(work_dir, "sheets.pdf")
+        threshold = pdf_builder.CONTACT_SHEET_THRESHOLD
+        pdf_builder.CONTACT_SHEET_THRESHOLD = 24
+        try:
+            builder = PDFBuilder(output_path)
+            builder.add_images_section(images[:1], images[1:])
+            assert builder.generate(), "PDF generation failed"
+        finally:
+            pdf_builder.CONTACT_SHEET_THRESHOLD = threshold
+        
+        with open(output_path, 'rb') as f:
+            content = f.read()
+        image_objects = content.count(b'/Subtype /Image')
+        sheets = builder.stats['contact_sheets']
+        per_sheet = pdf_builder.CONTACT_SHEET_COLUMNS * pdf_builder.CONTACT_SHEET_ROWS
+        assert sheets == (29 + per_sheet - 1) // per_sheet, f"unexpected sheet count {sheets}"
+        assert image_objects == 1 + sheets, f"expected {1 + sheets} image objects, found {image_objects}"
+        print(f"✓ 29 additional images embedded as {sheets} contact sheet(s)")
+        
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+        
+        print("\n✓ Contact sheet test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Contact sheet test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_style_registry():
+    """Test that fonts are parsed and styles built once per process"""
+    print("\n" + "="*60)
+    print("Testing Font and Style Registry")
+    print("="*60)
+    
+    try:
+        import reportlab
+        import report_styles
+        from pdf_builder import PDFBuilder
+        
+        parsed = []
+        ttfont = report_styles.TTFont
+        
+        def counting_ttfont(name, path):
+            parsed.append(name)
+            return ttfont(name, path)
+        
+        vera = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+        report_styles.TTFont = counting_ttfont
+        use_font_cache = report_styles.USE_FONT_CACHE
+        report_styles.USE_FONT_CACHE = False
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(report_styles.register_font('RegistryVera', vera)))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            report_styles.TTFont = ttfont
+            report_styles.USE_FONT_CACHE = use_font_cache
+        assert results == [True] * 4 and parsed == ['RegistryVera'], parsed
+        assert not report_styles.register_font('RegistryMissing', os.path.join(tempfile.gettempdir(), 'missing.ttf'))
+        print("✓ Font parsed once for four threads")
+        
+        first = PDFBuilder(os.devnull)
+        second = PDFBuilder(os.devnull)
+        assert first.styles is second.styles
+        assert 'FieldValue' in first.styles and 'ContactSheetIndex' in first.styles
+        print("✓ Builders share one stylesheet")
+        
+        print("\n✓ Style registry test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Style registry test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_font_cache():
+    """Test loading parsed fonts from the font cache"""
+    print("\n" + "="*60)
+    print("Testing Font Cache")
+    print("="*60)
+    
+    try:
+        import io
+        import pickle
+        import shutil
+        import reportlab
+        import font_cache
+        from font_cache import FontCache
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        from reportlab.pdfgen import canvas
+        
+        cache_dir = tempfile.mkdtemp()
+        vera = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+        try:
+            cache = FontCache(cache_dir)
+            fresh = cache.load_font('CacheVeraFresh', vera)
+            assert cache.get_stats() == {'hits': 0, 'misses': 1}
+            assert len(os.listdir(cache_dir)) == 1
+            print("✓ First load parses the font and stores it")
+            
+            parsed = []
+            ttfont = font_cache.TTFont
+            
+            class CountingTTFont(ttfont):
+                def __init__(self, *args, **kwargs):
+                    parsed.append(args)
+                    super().__init__(*args, **kwargs)
+            
+            font_cache.TTFont = CountingTTFont
+            try:
+                cached = FontCache(cache_dir).load_font('CacheVeraCached', vera)
+            finally:
+                font_cache.TTFont = ttfont
+            assert parsed == [], parsed
+            assert set(vars(cached)) == set(vars(fresh))
+            assert vars(cached.face) == vars(fresh.face)
+            assert all(type(value) is type(vars(fresh.face)[key]) for key, value in vars(cached.face).items())
+            print("✓ Second load rebuilds the font without parsing it")
+            
+            # Glyph subsetting happens when the PDF is saved
+            def render(font):
+                pdfmetrics.registerFont(font)
+                buffer = io.BytesIO()
+                pdf = canvas.Canvas(buffer, invariant=1)
+                pdf.setFont(font.fontName, 12)
+                pdf.drawString(72, 720, "Heritage site 123 \u00e9\u00e8")
+                pdf.save()
+                return buffer.getvalue().replace(font.fontName.encode(), b'F')
+            
+            assert render(cached) == render(TTFont('CacheVeraParsed', vera))
+            print("✓ Cached font subsets identically to a parsed font")
+            
+            # A damaged entry is ignored and replaced
+            cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+            with open(cache_file, 'wb') as f:
+                f.write(b'{"dict": [["name", {"bytes": 1}]')
+            damaged = FontCache(cache_dir)
+            damaged.load_font('CacheVeraDamaged', vera)
+            assert damaged.get_stats() == {'hits': 0, 'misses': 1}
+            FontCache(cache_dir).load_font('CacheVeraRepaired', vera)
+            print("✓ Damaged cache entry is parsed again and replaced")
+            
+            # Entries are data only: a pickle put in the shared folder is never run
+            class Payload:
+                def __reduce__(self):
+                    return exec, ("import os; os.environ['FONT_CACHE_PAYLOAD_RAN'] = '1'",)
+            
+            with open(cache_file, 'wb') as f:
+                f.write(pickle.dumps(Payload()))
+            planted = FontCache(cache_dir)
+            planted.load_font('CacheVeraPlanted', vera)
+            assert 'FONT_CACHE_PAYLOAD_RAN' not in os.environ
+            assert planted.get_stats() == {'hits': 0, 'misses': 1}
+            print("✓ Code planted in a cache entry is not run")
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        
+        print("\n✓ Font cache test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Font cache test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def test_streaming_build():
+    """Test that streamed entries are laid out one at a time and released afterwards"""
+    print("\n" + "="*60)
+    print("Testing Streaming PDF Build")
+    print("="*60)
+    
+    try:
+        import io
+        import csv
+        import gc
+        import shutil
+        import weakref
+        from unittest import mock
+        from PIL import Image as PILImage
+        from reportlab.platypus import Paragraph
+        import report_generator
+        from pdf_builder import PDFBuilder
+        from report_generator import ReportGenerator
+        from constants import PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD
+        
+        work_dir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(work_dir, "streamed.pdf")
+            builder = PDFBuilder(output_path)
+            alive = []
+            
+            def entries():
+                for i in range(4):
+                    image_path = os.path.join(work_dir, f"entry_{i}.jpg")
+                    with open(image_path, 'wb') as f:
+                        f.write(create_test_jpeg((400 + i, 300)))
+                    if i:
+                        builder.add_page_break()
+                    builder.add_section(f"Entry {i}", {"Name": f"Site {i}", "Notes": "text " * 300})
+                    builder.add_images_section([image_path], [image_path], None)
+                    refs = [weakref.ref(flowable) for flowable in builder.story]
+                    yield None
+                    
+                    gc.collect()
+                    alive.append(sum(1 for ref in refs if ref() is not None))
+                # Entries can also be given as flowables
+                yield [Paragraph("End of compendium", builder.styles['Normal'])]
+            
+            assert builder.generate_streaming(entries())
+            with open(output_path, 'rb') as f:
+                pages = f.read().count(b'/Type /Page\n')
+            assert builder.stats['entries'] == 5 and pages >= 4, (builder.stats, pages)
+            # reportlab holds on to the last flowable it drew until it takes the next one
+            assert alive and max(alive) <= 1, alive
+            assert len(builder.embedded_images) == 4 and not builder.story
+            print(f"✓ {builder.stats['entries']} entries on {pages} pages, each released once laid out")
+            
+            # The same photo under a new name in every entry is still embedded once
+            output_path = os.path.join(work_dir, "repeated.pdf")
+            builder = PDFBuilder(output_path)
+            buffer = io.BytesIO()
+            PILImage.effect_noise((320, 240), 40).convert('RGB').save(buffer, 'PNG')
+            photo = buffer.getvalue()
+            
+            def repeated_entries():
+                for i in range(3):
+                    image_path = os.path.join(work_dir, f"repeated_{i}.png")
+                    with open(image_path, 'wb') as f:
+                        f.write(photo)
+                    builder.add_section(f"Entry {i}", {"Name": f"Site {i}"})
+                    builder.add_images_section([image_path], [], None)
+                    yield None
+            
+            assert builder.generate_streaming(repeated_entries())
+            with open(output_path, 'rb') as f:
+                xobjects = f.read().count(b'/Subtype /Image')
+            assert xobjects == 1, xobjects
+            assert builder.stats['images_embedded'] == 1 and builder.stats['duplicate_images'] == 2, builder.stats
+            # Only undrawn templates are remembered, without decoded pixels
+            assert all('_img' not in template.__dict__ for template, _ in builder.embedded_images.values())
+            print("✓ Photo repeated across entries embedded once")
+            
+            data = create_test_jpeg((400, 300))
+            files = {}
+            csv_path = os.path.join(work_dir, "assessments.csv")
+            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Date of Assessment', PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD])
+                # Every row also shows one site plan, downloaded once and kept until the last row
+                shared_id = "compendium_shared_0123456789abcdef"
+                files[shared_id] = (create_test_jpeg((420, 300)), 'image/jpeg')
+                for i in range(3):
+                    ids = [f"compendium_{i}_{j}_0123456789abcdef" for j in range(2)] + [shared_id]
+                    files.update({file_id: (data, 'image/jpeg') for file_id in ids[:2]})
+                    writer.writerow([f'2024/01/1{i}', ids[0], ', '.join(ids[1:])])
+            
+            with LocalTestServer(files) as server, \
+                    mock.patch.object(report_generator, 'IMAGE_CACHE_DIR', os.path.join(work_dir, "cache")):
+                generator = ReportGenerator(csv_path, size_budget_mb=0)
+                generator.image_handler.download_url = server.url
+                generator.image_handler.thumbnail_url = None
+                try:
+                    stats = generator.generate_compendium(os.path.join(work_dir, "compendium.pdf"))
+                    assert stats['entries'] == 3 and stats['total_images'] == 9, stats
+                    shared_downloads = [request for request in server.requests if request[0] == shared_id]
+                    assert len(shared_downloads) == 1, server.requests
+                    assert not generator.image_handler.downloaded_images
+                    if generator.image_processor:
+                        assert not generator.image_processor.prepared_images
+                finally:
+                    generator.cleanup()
+            print("✓ Compendium of every row built, images used by several rows downloaded once and then released")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        
+        print("\n✓ Streaming build test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Streaming build test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
 def test_pdf_builder():
     """Test the PDF builder module"""
     print("\n" + "="*60)
@@ -128,7 +2062,8 @@ def test_utils():
     print("="*60)
     
     try:
-        from utils import extract_drive_file_id, parse_image_links, safe_str
+        import shutil
+        from utils import extract_drive_file_id, parse_image_links, safe_str, atomic_write
         
         # Test URL extraction
         test_urls = [
@@ -152,6 +2087,25 @@ def test_utils():
         print(f"  None → '{safe_str(None)}'")
         print(f"  '  test  ' → '{safe_str('  test  ')}'")
         
+        # Atomic writes replace the file only when the block succeeds
+        work_dir = tempfile.mkdtemp()
+        path = os.path.join(work_dir, "state.json")
+        with atomic_write(path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write("old")
+        try:
+            with atomic_write(path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    f.write("partial")
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        with open(path) as f:
+            assert f.read() == "old"
+        assert os.listdir(work_dir) == ["state.json"], os.listdir(work_dir)
+        shutil.rmtree(work_dir)
+        print("\n✓ Interrupted atomic write left the old file and no partial file")
+        
         print("\n✓ Utils test passed!")
         
     except Exception as e:
@@ -160,6 +2114,47 @@ def test_utils():
         traceback.print_exc()
 
 
+def test_link_index():
+    """Test that the link index finds every file once with all its references"""
+    print("\n" + "="*60)
+    print("Testing Link Index")
+    print("="*60)
+    
+    try:
+        from link_index import LinkIndex
+        from constants import PRIMARY_IMAGE_FIELD, ADDITIONAL_IMAGES_FIELD
+        
+        a = "1BxiMVs0XRA5nFMdKvBdBZjgmUUqptlbs"
+        b = "2CyjNWt1YSB6oGNeLwCeCakhnVVrqumct"
+        rows = [
+            {PRIMARY_IMAGE_FIELD: f"https://drive.google.com/open?id={a}",
+             ADDITIONAL_IMAGES_FIELD: f"https://drive.google.com/file/d/{b}/view, not a link!"},
+            {PRIMARY_IMAGE_FIELD: b, ADDITIONAL_IMAGES_FIELD: f" , {a}"},
+            {PRIMARY_IMAGE_FIELD: ''}
+        ]
+        
+        index = LinkIndex(rows)
+        print(f"Index: {index.get_stats()}")
+        assert index.file_ids() == [a, b]
+        assert index.get_stats() == {'rows': 3, 'files': 2, 'references': 4, 'unparsed': 1}
+        assert index.slots_for(a) == [(0, PRIMARY_IMAGE_FIELD, 0), (1, ADDITIONAL_IMAGES_FIELD, 0)]
+        assert index.rows_for(b) == [0, 1]
+        print("✓ Each file listed once with every row and slot referencing it")
+        
+        assert list(index.links_for_row(1)) == [b, a]
+        assert list(index.links_for_row(0, ADDITIONAL_IMAGES_FIELD)) == [b]
+        assert index.links_for_row(2) == {}
+        print("✓ Links of a single row in column order")
+        
+        print("\n✓ Link index test passed!")
+        
+    except Exception as e:
+        print(f"\n✗ Link index test failed: {e}")
+        import traceback
+        traceback.print_exc()
+        raise
+
+
 def main():
     """Main test menu"""
     print("Heritage Report Generator - Module Testing")
@@ -171,10 +2166,11 @@ def main():
         print("2. ImageHandler (Image downloading)")
         print("3. PDFBuilder (PDF generation)")
         print("4. Utils (Utility functions)")
-        print("5. Run all tests")
+        print("5. Downloads (local test server)")
+        print("6. Run all tests")
         print("0. Exit")
         
-        choice = input("\nEnter choice (0-5): ").strip()
+        choice = input("\nEnter choice (0-6): ").strip()
         
         if choice == '0':
             break
@@ -184,13 +2180,62 @@ def main():
             test_image_handler()
         elif choice == '3':
             test_pdf_builder()
+            test_style_registry()
+            test_font_cache()
+            test_streaming_build()
+            test_image_preprocessing()
+            test_derivative_cache()
+            test_parallel_preprocessing()
+            test_header_probes()
+            test_image_deduplication()
+            test_bounded_decoding()
+            test_size_budget()
+            test_contact_sheets()
         elif choice == '4':
             test_utils()
+            test_link_index()
         elif choice == '5':
+            test_resumable_download()
+            test_prefetch_during_load()
+            test_download_planning()
+            test_bandwidth_limit()
+            test_download_control()
+            test_hedged_downloads()
+            test_image_sources()
+            test_failed_link_cache()
+            test_thumbnail_download()
+            test_shared_cache()
+            test_cache_warming()
+            test_image_export()
+        elif choice == '6':
             test_utils()
+            test_link_index()
             test_data_loader()
             test_image_handler()
+            test_resumable_download()
+            test_prefetch_during_load()
+            test_download_planning()
+            test_bandwidth_limit()
+            test_download_control()
+            test_hedged_downloads()
+            test_image_sources()
+            test_failed_link_cache()
+            test_thumbnail_download()
+            test_shared_cache()
+            test_cache_warming()
+            test_image_export()
             test_pdf_builder()
+            test_style_registry()
+            test_font_cache()
+            test_streaming_build()
+            test_image_preprocessing()
+            test_derivative_cache()
+            test_parallel_preprocessing()
+            test_header_probes()
+            test_image_deduplication()
+            test_bounded_decoding()
+            test_size_budget()
+            test_contact_sheets()
         else:
             print("Invalid choice!")
         
@@ -4,9 +4,12 @@ Utility functions for Heritage Report Generator
 
 import os
 import re
+import tempfile
+import functools
+import contextlib
 from datetime import datetime
 import logging
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Iterator
 
 from constants import GOOGLE_DRIVE_PATTERNS
 
@@ -14,6 +17,35 @@ from constants import GOOGLE_DRIVE_PATTERNS
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Files being written carry this suffix until they are renamed into place
+TEMP_SUFFIX = '.tmp'
+
+
+def _fuse_patterns(patterns: List[str]) -> re.Pattern:
+    """
+    Combine file ID patterns into one regex that keeps their priority
+
+    Each alternative scans the whole string before the next one is tried,
+    so the result is the same as trying the patterns one after another.
+    """
+    alternatives = []
+    for pattern in patterns:
+        if pattern.startswith('^'):
+            alternatives.append(f'(?:{pattern[1:]})')
+        else:
+            alternatives.append(f'(?:.*?{pattern})')
+    return re.compile('^(?:' + '|'.join(alternatives) + ')', re.DOTALL)
+
+
+DRIVE_FILE_ID_REGEX = _fuse_patterns(GOOGLE_DRIVE_PATTERNS)
+
+
+@functools.lru_cache(maxsize=4096)
+def match_drive_file_id(url: str) -> Optional[str]:
+    """Get the file ID of a stripped link, or None, without logging"""
+    match = DRIVE_FILE_ID_REGEX.match(url)
+    return match.group(match.lastindex) if match else None
+
 
 def setup_logging(log_file: Optional[str] = None, log_level: str = 'INFO'):
     """
@@ -101,12 +133,10 @@ def extract_drive_file_id(url: str) -> Optional[str]:
     
     url = str(url).strip()
     
-    for pattern in GOOGLE_DRIVE_PATTERNS:
-        match = re.search(pattern, url)
-        if match:
-            file_id = match.group(1)
-            logger.debug(f"Extracted file ID: {file_id} from URL: {url}")
-            return file_id
+    file_id = match_drive_file_id(url)
+    if file_id:
+        logger.debug(f"Extracted file ID: {file_id} from URL: {url}")
+        return file_id
     
     logger.warning(f"Could not extract file ID from URL: {url}")
     return None
@@ -242,6 +272,33 @@ def get_file_size_mb(filepath: str) -> float:
         return 0.0
 
 
+@contextlib.contextmanager
+def atomic_write(path: str, prefix: Optional[str] = None) -> Iterator[str]:
+    """
+    Write a file so readers see its old or its new contents, never a partial file
+    
+    The block writes to a temporary file next to path, which is renamed over
+    path when the block ends. If the block raises, the temporary file is
+    removed and path is left as it was.
+    
+    Args:
+        path: File to write
+        prefix: Start of the temporary file's name
+        
+    Yields:
+        str: Path to write the contents to
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=prefix, suffix=TEMP_SUFFIX)
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def ensure_directory_exists(directory: str) -> bool:
     """
     Ensure directory exists, create if not